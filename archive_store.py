@@ -0,0 +1,205 @@
+"""Content addressed, compressed store of processed exports with a JSON lines index"""
+import os
+import re
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+from datetime import datetime
+from typing import BinaryIO
+from data_parser import sniff_parser
+
+ARCHIVE_FOLDER = "historic"
+OBJECT_FOLDER = "objects"
+INDEX_FILE = "index.jsonl"
+# older archives named files <export>-<newest date><ext>
+LEGACY_NAME_DATE = re.compile(r"-(\d{4}-\d{2}-\d{2})\.[^.]+$")
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class ArchiveEntry:
+    """One archived export as listed in the index"""
+    def __init__(self, file_hash:str, account:str, institute:str|None, file_name:str,
+                 first_date:str|None, last_date:str|None, rows:int|None, compression:str,
+                 archived_at:str, legacy:bool=False):
+        self.file_hash = file_hash
+        self.account = account
+        self.institute = institute
+        self.file_name = file_name
+        self.first_date = first_date
+        self.last_date = last_date
+        self.rows = rows
+        self.compression = compression
+        self.archived_at = archived_at
+        self.legacy = legacy
+
+    def object_path(self, archive_folder:str=ARCHIVE_FOLDER)->str:
+        """Where the compressed copy of the export is kept"""
+        return object_path(self.file_hash, self.compression, archive_folder)
+
+    def overlaps(self, start:str|None, end:str|None)->bool:
+        """Whether the export holds any dates between start and end, unknown ranges match"""
+        if start and self.last_date and self.last_date < start:
+            return False
+        if end and self.first_date and self.first_date > end:
+            return False
+        return True
+
+def object_path(file_hash:str, compression:str, archive_folder:str=ARCHIVE_FOLDER)->str:
+    """Objects are spread over folders named by the first two characters of their hash"""
+    ext = ".zst" if compression == "zstd" else ".gz"
+    return os.path.join(archive_folder, OBJECT_FOLDER, file_hash[:2], file_hash + ext)
+
+def hash_file(file:str)->str:
+    """SHA-256 of a file's contents"""
+    with open(file, "rb") as stream:
+        return hashlib.file_digest(stream, "sha256").hexdigest()
+
+def read_index(archive_folder:str=ARCHIVE_FOLDER)->list[ArchiveEntry]:
+    """Every entry of the archive index, oldest first"""
+    index_file = os.path.join(archive_folder, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return []
+    with open(index_file, encoding="utf-8") as file:
+        return [ArchiveEntry(**json.loads(line)) for line in file if line.strip()]
+
+def find_entries(account:str|None=None, institute:str|None=None, start:str|None=None,
+                 end:str|None=None, archive_folder:str=ARCHIVE_FOLDER)->list[ArchiveEntry]:
+    """Entries for an account and institute that hold dates between start and end"""
+    return [entry for entry in read_index(archive_folder)
+            if (account is None or entry.account == account)
+            and (institute is None or entry.institute == institute)
+            and entry.overlaps(start, end)]
+
+def compress_file(file:str, destination:str)->str:
+    """Write a compressed copy of file, zstd when it is installed, returns the codec"""
+    folder = os.path.dirname(destination)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    # write beside the final name first so a crash never leaves half an object behind
+    partial = destination + ".partial"
+    with open(file, "rb") as source:
+        if zstandard is not None:
+            with open(partial, "wb") as target:
+                zstandard.ZstdCompressor(level=10).copy_stream(source, target)
+            compression = "zstd"
+        else:
+            with gzip.open(partial, "wb", compresslevel=9) as target:
+                shutil.copyfileobj(source, target)
+            compression = "gzip"
+    os.replace(partial, destination)
+    return compression
+
+def store_file(file:str, account:str, archive_folder:str=ARCHIVE_FOLDER,
+               file_hash:str|None=None, legacy:bool=False)->ArchiveEntry:
+    """Add an export to the store and index it, identical content is only kept once"""
+    file_hash = file_hash or hash_file(file)
+    entries = read_index(archive_folder)
+    for entry in entries:
+        if entry.file_hash == file_hash and entry.account == account:
+            return entry
+    stored = next((entry for entry in entries if entry.file_hash == file_hash), None)
+    if stored is not None and os.path.exists(stored.object_path(archive_folder)):
+        compression = stored.compression
+    else:
+        codec = "zstd" if zstandard is not None else "gzip"
+        compression = compress_file(file, object_path(file_hash, codec, archive_folder))
+
+    institute, rows, first_date, last_date = None, None, None, None
+    plugin = sniff_parser(file)
+    if plugin is not None:
+        institute = plugin.institute.name
+        rows, first_date, last_date = plugin.summarize(file)
+    file_name = os.path.basename(file)
+    if last_date is None and LEGACY_NAME_DATE.search(file_name):
+        last_date = datetime.strptime(LEGACY_NAME_DATE.search(file_name).group(1), "%Y-%m-%d")
+    entry = ArchiveEntry(
+        file_hash=file_hash,
+        account=account,
+        institute=institute,
+        file_name=file_name,
+        first_date=first_date.strftime("%Y-%m-%d") if first_date else None,
+        last_date=last_date.strftime("%Y-%m-%d") if last_date else None,
+        rows=rows,
+        compression=compression,
+        archived_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        legacy=legacy
+    )
+    with open(os.path.join(archive_folder, INDEX_FILE), "a", encoding="utf-8") as index:
+        index.write(json.dumps(vars(entry)) + "\n")
+    return entry
+
+def archive_file(file:str, account:str, file_hash:str|None=None,
+                 archive_folder:str=ARCHIVE_FOLDER)->ArchiveEntry:
+    """Move a processed export into the store"""
+    entry = store_file(file, account, archive_folder, file_hash)
+    os.remove(file)
+    return entry
+
+def open_entry(entry:ArchiveEntry, archive_folder:str=ARCHIVE_FOLDER)->BinaryIO:
+    """Stream the original bytes of an archived export back"""
+    if entry.compression == "zstd":
+        if zstandard is None:
+            print("zstandard is needed to read", entry.file_name)
+            sys.exit()
+        # pylint: disable-next=consider-using-with
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(entry.object_path(archive_folder), "rb"), closefd=True)
+    return gzip.open(entry.object_path(archive_folder), "rb")
+
+def extract_entry(entry:ArchiveEntry, destination_folder:str,
+                  archive_folder:str=ARCHIVE_FOLDER)->str:
+    """Write an archived export out under its original name and hash, returns the path"""
+    if not os.path.exists(destination_folder):
+        os.makedirs(destination_folder)
+    # banks reuse export names, the hash keeps every pull apart
+    name, ext = os.path.splitext(entry.file_name)
+    destination = os.path.join(destination_folder, f"{name}-{entry.file_hash[:12]}{ext}")
+    with open_entry(entry, archive_folder) as source, open(destination, "wb") as target:
+        shutil.copyfileobj(source, target)
+    return destination
+
+def import_legacy(archive_folder:str=ARCHIVE_FOLDER)->list[ArchiveEntry]:
+    """Move files from the old historic/<account>/ folders into the store"""
+    entries = []
+    if not os.path.isdir(archive_folder):
+        return entries
+    for account in sorted(os.listdir(archive_folder)):
+        account_folder = os.path.join(archive_folder, account)
+        if account == OBJECT_FOLDER or not os.path.isdir(account_folder):
+            continue
+        for file_name in sorted(os.listdir(account_folder)):
+            file = os.path.join(account_folder, file_name)
+            entries.append(store_file(file, account, archive_folder, legacy=True))
+            os.remove(file)
+            print("--------Archived", file)
+        if not os.listdir(account_folder):
+            os.rmdir(account_folder)
+    return entries
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="List and extract archived exports")
+    parser.add_argument("-a", "--account", help='Only exports of this account')
+    parser.add_argument("-i", "--institute", help='Only exports of this institute')
+    parser.add_argument("-s", "--start", help='Only exports holding dates from YYYY-MM-DD')
+    parser.add_argument("-e", "--end", help='Only exports holding dates up to YYYY-MM-DD')
+    parser.add_argument("-x", "--extract", help='Write the matching exports into this folder')
+    parser.add_argument("--import-legacy", action="store_true",
+                        help='Move files from historic/<account>/ folders into the store')
+    args = parser.parse_args()
+    if args.import_legacy:
+        import_legacy()
+    for entry in find_entries(args.account, args.institute, args.start, args.end):
+        print(f"{entry.file_hash[:12]}  {entry.account:<16}{entry.institute or '-':<16}"
+              f"{entry.first_date or '?':>10} - {entry.last_date or '?':<10}"
+              f"{entry.rows if entry.rows is not None else '?':>9}  {entry.file_name}")
+        if args.extract:
+            extract_entry(entry, os.path.join(args.extract, entry.account))
+
+if __name__ == "__main__":
+    main()
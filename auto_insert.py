@@ -1,34 +1,244 @@
 """Scrapes All Bank transactions from PDF File and inserts into DB"""
 import os
-import shutil
+import sys
+import json
 import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
 from dotenv import load_dotenv
-from data_parser import data_parser
-from db_classes import get_account
+from data_parser import detect_parser, ImportCutoff, CHUNK_SIZE
+from db_classes import (Account, Record, get_account, find_account, insert_records,
+                        categorize_by_business, get_balance_drift, BatchResult)
+from db_migrations import migrate, get_schema_version, SCHEMA_VERSION
+from db_helper import get_connection, db_session
+from staging import write_staged
+from archive_store import ArchiveEntry, hash_file, archive_file, import_legacy, read_index
+from instrumentation import PROFILER, timed_iterator, print_report, write_report
+
+INGEST_OVERLAP_DAYS = 7
+
+def load_manifest(manifest_file:str, directory:str|None)->list[tuple[str, str|None, str]]:
+    """Files listed in a manifest as (path, institute, account), missing files are skipped"""
+    with open(manifest_file, encoding="utf-8") as file:
+        manifest = json.load(file)
+    base_folder = directory or os.path.dirname(os.path.abspath(manifest_file))
+    jobs = []
+    for entry in manifest["files"]:
+        path = os.path.join(base_folder, entry["file"])
+        if not os.path.exists(path):
+            print("Skipping, file not found:", path)
+            continue
+        jobs.append((path, entry.get("institute"), entry["account"]))
+    return jobs
+
+def parse_file(job:tuple[str, str|None, Account, ImportCutoff|None])->tuple[list[Record], int]:
+    """Parse one export in a worker process, oldest record first, and rows left out"""
+    file, institute, account, cutoff = job
+    transactions = []
+    for records in detect_parser(file, institute).stream(file, account, CHUNK_SIZE, cutoff):
+        transactions.extend(records)
+    return transactions, 0 if cutoff is None else cutoff.dropped
+
+def legacy_entries(account:Account)->list[ArchiveEntry]:
+    """Exports of the account archived before file hashes were kept, not yet remembered"""
+    state = account.get_ingest_state()
+    return [entry for entry in read_index() if entry.legacy and entry.account == account.account
+            and entry.file_hash not in state.file_hashes]
+
+def register_archive(account:Account)->None:
+    """Remember exports that were archived before file hashes were kept as imported"""
+    state = account.get_ingest_state()
+    with db_session():
+        for entry in legacy_entries(account):
+            state.add_file(entry.file_hash, entry.file_name, None)
+
+def import_window(file:str, account:Account, full:bool, overlap_days:int,
+                  dry_run:bool=False)->tuple[str, ImportCutoff|None]|None:
+    """Hash of a file and where to read it from, None if the same file was imported before"""
+    file_hash = hash_file(file)
+    if full:
+        return file_hash, None
+    state = account.get_ingest_state()
+    if dry_run:
+        # a preview checks the old archive without remembering it
+        imported = {entry.file_hash for entry in legacy_entries(account)}
+    else:
+        register_archive(account)
+        imported = set()
+    if file_hash in state.file_hashes or file_hash in imported:
+        print("Skipping, already imported:", file)
+        return None
+    since = state.cutoff(overlap_days)
+    return file_hash, None if since is None else ImportCutoff(since, state.last_imported_date)
+
+def record_ingest(account:Account, entry:ArchiveEntry, result:BatchResult,
+                  newest_date:datetime|None, cutoff:ImportCutoff|None=None)->None:
+    """Move the account's watermark, and remember the file once every row of it is in"""
+    state = account.get_ingest_state()
+    if cutoff is not None and cutoff.dropped:
+        print(cutoff)
+    with db_session():
+        if result.failed:
+            # the next import has to reach back to the oldest row that did not make it in
+            oldest_failed = min(record.transaction_date for record in result.failed)
+            if state.last_imported_date is None or oldest_failed < state.last_imported_date:
+                state.set_watermark(oldest_failed)
+            return
+        if newest_date and (state.last_imported_date is None
+                            or newest_date > state.last_imported_date):
+            state.set_watermark(newest_date)
+        # rows left out by the cutoff are only read again if the file is not skipped later
+        if cutoff is None or not cutoff.dropped:
+            state.add_file(entry.file_hash, entry.file_name, newest_date)
+
+def write_records(chunks:Iterable[list[Record]], group_prompts:bool, staged:bool=False,
+                  dry_run:bool=False)->tuple[BatchResult, datetime]:
+    """Categorize and insert chunks of records, returns the result and newest date"""
+    if staged:
+        # the whole export is staged in memory and merged with a few set based statements
+        result, newest_date = write_staged(timed_iterator("parse", chunks), group_prompts,
+                                           dry_run)
+        if dry_run:
+            return result, newest_date
+    else:
+        result, newest_date = BatchResult(), None
+        for records in timed_iterator("parse", chunks):
+            if group_prompts:
+                categorize_by_business(records)
+            else:
+                for record in records:
+                    record.get_category()
+            result.merge(insert_records(records))
+            newest_date = records[-1].transaction_date if records else newest_date
+    print(result)
+    for record in result.failed:
+        print("Failed:", record.transaction_date.date(), record.amount, record.business,
+              record.note)
+    return result, newest_date
+
+def insert_manifest(jobs:list[tuple[str, str|None, str]], workers:int|None,
+                    group_prompts:bool, full:bool, overlap_days:int, staged:bool=False,
+                    dry_run:bool=False)->None:
+    """Parse every listed file in parallel and write them one after another"""
+    # reject misrouted files before any worker starts parsing
+    for file, institute, _ in jobs:
+        detect_parser(file, institute)
+    accounts = {}
+    for _, _, account in jobs:
+        if account not in accounts:
+            accounts[account] = find_account(account)
+    parse_jobs = []
+    file_hashes = []
+    for file, institute, account in jobs:
+        window = import_window(file, accounts[account], full, overlap_days, dry_run)
+        if window is not None:
+            file_hashes.append(window[0])
+            parse_jobs.append((file, institute, accounts[account], window[1]))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed_files = timed_iterator("parse (waiting on workers)",
+                                      executor.map(parse_file, parse_jobs))
+        for (file, _, account, cutoff), file_hash, (transactions, dropped) in zip(
+                parse_jobs, file_hashes, parsed_files):
+            print(f"--------{file} -> {account.account}")
+            for record in transactions:
+                # records come back with their own copy of the account, share ours again
+                record.account = account
+                if record.changed_asset.account:
+                    record.changed_asset.account = account
+            if cutoff is not None:
+                # the worker counted on its own copy of the cutoff
+                cutoff.dropped = dropped
+            result, newest_date = write_records([transactions], group_prompts, staged, dry_run)
+            if dry_run:
+                if dropped:
+                    print(cutoff)
+                continue
+            entry = archive_file(file, account.account, file_hash)
+            record_ingest(account, entry, result, newest_date, cutoff)
 
 def main()->None:
     """Main Driver"""
     parser = argparse.ArgumentParser(description="Insert PDF and CSV data")
     parser.add_argument("-b", "--book", help='Book ID', required=False)
-    parser.add_argument("-f", "--file", help='Transaction File Name', required=True)
-    parser.add_argument("-i", "--institute", help='Institute of the transactions', required=True)
+    parser.add_argument("-f", "--file", help='Transaction File Name')
+    parser.add_argument("-i", "--institute",
+                        help='Institute of the transactions, detected from the file if left out')
+    parser.add_argument("-m", "--manifest",
+                        help='JSON file listing files with their institute and account')
+    parser.add_argument("-d", "--directory",
+                        help='Folder of downloaded files, uses its manifest.json by default')
+    parser.add_argument("-w", "--workers", type=int,
+                        help='Processes parsing files in parallel with a manifest')
+    parser.add_argument("-g", "--group-prompts", action="store_true",
+                        help='Categorize known rows first, then ask once per unknown business')
+    parser.add_argument("-v", "--verify", action="store_true",
+                        help='Compare account totals with records and assets after inserting')
+    parser.add_argument("-c", "--chunk-size", type=int, default=CHUNK_SIZE,
+                        help='Rows parsed and committed together')
+    parser.add_argument("-o", "--overlap-days", type=int, default=INGEST_OVERLAP_DAYS,
+                        help='Days before the last import to read again for late postings')
+    parser.add_argument("-s", "--staged", action="store_true",
+                        help='Merge each file through an in memory staging area')
+    parser.add_argument("--dry-run", action="store_true",
+                        help='Stage each file and show what would change without writing it')
+    parser.add_argument("--full", action="store_true",
+                        help='Read every row even if the file or its dates were imported before')
+    parser.add_argument("-p", "--profile", nargs="?", const="-", metavar="PATH",
+                        help='Report time per phase and statement, as JSON if given a PATH')
+    parser.add_argument("-e", "--explain", action="store_true",
+                        help='Add query plans of the slowest statements to the profile')
     args = parser.parse_args()
+    if not (args.manifest or args.directory or args.file):
+        parser.error("give a --file, --manifest or --directory")
     load_dotenv()
-    account = get_account()
-    transactions = data_parser(account, args.institute, args.file)
-
-    for record in reversed(transactions):
-        record.get_category()
-        record.insert_record()
-
-    name, ext = os.path.splitext(args.file)
-    new_filename = f"{name}-{transactions[0].transaction_date.date()}{ext}"
-    storage_folder = os.path.join("historic", account.account)
-    if not os.path.exists(storage_folder):
-        os.makedirs(storage_folder)
-    destination = os.path.join(storage_folder, new_filename)
-    shutil.copy(args.file, destination)
-    os.remove(args.file)
+    if args.profile:
+        PROFILER.enable()
+    try:
+        if args.dry_run:
+            # a preview leaves the schema and the archive folders as they are
+            if get_schema_version() < SCHEMA_VERSION:
+                print("DB schema is out of date, run once without --dry-run to migrate it")
+                sys.exit()
+        else:
+            migrate()
+            import_legacy()
+        if args.manifest or args.directory:
+            manifest = args.manifest or os.path.join(args.directory, "manifest.json")
+            jobs = load_manifest(manifest, args.directory)
+            if not jobs:
+                print("No files to insert")
+                sys.exit()
+            insert_manifest(jobs, args.workers, args.group_prompts, args.full,
+                            args.overlap_days, args.staged or args.dry_run, args.dry_run)
+        else:
+            parser_plugin = detect_parser(args.file, args.institute)
+            account = get_account()
+            window = import_window(args.file, account, args.full, args.overlap_days,
+                                   args.dry_run)
+            if window is not None:
+                file_hash, cutoff = window
+                chunks = parser_plugin.stream(args.file, account, args.chunk_size, cutoff)
+                result, newest_date = write_records(chunks, args.group_prompts,
+                                                    args.staged or args.dry_run, args.dry_run)
+                if not args.dry_run:
+                    entry = archive_file(args.file, account.account, file_hash)
+                    record_ingest(account, entry, result, newest_date, cutoff)
+                elif cutoff is not None and cutoff.dropped:
+                    print(cutoff)
+
+        if args.verify:
+            for name, cash_drift, investment_drift in get_balance_drift():
+                print(f"{name}: cash off by {cash_drift}, investments off by {investment_drift}")
+    finally:
+        # a run that exits early is often the one worth profiling
+        if args.profile:
+            report = PROFILER.report(get_connection() if args.explain else None)
+            if args.profile == "-":
+                print_report(report)
+            else:
+                write_report(report, args.profile)
+                print("Profile written to", args.profile)
 
 if __name__ == "__main__":
     main()
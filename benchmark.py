@@ -0,0 +1,185 @@
+"""Benchmarks parse, insert and end to end ingest on synthetic exports"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+from synthetic_exports import EXPORT_FORMATS, write_export
+
+BENCHMARK_SIZES = (1_000, 100_000, 1_000_000)
+BENCHMARK_PHASES = ("parse", "insert", "ingest")
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "finance_db_schema.sql")
+INCOME_WORDS = ("PAYROLL", "ZELLE", "INTEREST", "DEPOSIT", "DIVIDEND", "CONTRIBUTION", "REBATE")
+
+def build_db(db_file:str)->None:
+    """Fresh DB from finance_db_schema.sql holding one empty account"""
+    with open(SCHEMA_FILE, encoding="utf-8") as file:
+        schema = file.read()
+    db_connection = sqlite3.connect(db_file)
+    db_connection.executescript(schema)
+    db_connection.execute("INSERT INTO books (book_id, book) VALUES (1, 'Benchmark');")
+    db_connection.execute("INSERT INTO accounts VALUES (1, 1, 'Benchmark', 'Benchmark', 0, 0, 0);")
+    db_connection.commit()
+    db_connection.close()
+
+def peak_rss_mb()->float|None:
+    """Peak resident memory of this process in MB"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None # no portable way to read it on Windows without psutil
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def benchmark_category(business:str, note:str, traded:bool)->tuple[str, str]:
+    """Category and change type the benchmark account has on file for a row"""
+    text = f"{business} {note}".upper()
+    if traded:
+        if "SELL" in text or "EXCHANGE OUT" in text:
+            return "Investing", "SELL_ASSET"
+        return "Investing", "BUY_ASSET"
+    if any(word in text for word in INCOME_WORDS):
+        return "Income", "DEBIT_ACCOUNT"
+    return "Spending", "CREDIT_ACCOUNT"
+
+def seed_categories(file:str)->int:
+    """Give the account a categorized history for every business and note in the file"""
+    from data_parser import data_parser  # pylint: disable=import-outside-toplevel
+    from db_classes import Account  # pylint: disable=import-outside-toplevel
+    from db_helper import sql_insert_many, db_session  # pylint: disable=import-outside-toplevel
+    history = {}
+    for record in data_parser(Account(1), None, file):
+        key = (record.business, record.note, record.changed_asset.account is not None)
+        history.setdefault(key, benchmark_category(*key))
+    sql_statement = "INSERT INTO records \
+        (account_id, amount, business, category, change_type, note, transaction_date) \
+        VALUES (1, 0, ?, ?, ?, ?, '1990-01-01');"
+    with db_session():
+        sql_insert_many(sql_statement, [[business, category, change_type, note]
+                                        for (business, note, _), (category, change_type)
+                                        in history.items()])
+    return len(history)
+
+def run_phase(phase:str, file:str)->dict:
+    """Run one phase in this process and measure it"""
+    # the modules under test are imported here so their import time is part of the run
+    statements = [0]
+    def count_statement(_:str)->None:
+        statements[0] += 1
+
+    started = time.perf_counter()
+    from data_parser import data_parser, detect_parser  # pylint: disable=import-outside-toplevel
+    from db_classes import (Account, insert_records,  # pylint: disable=import-outside-toplevel
+                            categorize_by_business)
+    from db_helper import get_connection  # pylint: disable=import-outside-toplevel
+    get_connection().set_trace_callback(count_statement)
+    account = Account(1)
+    rows, failed = 0, 0
+    with open(os.devnull, "w", encoding="utf-8") as devnull, redirect_stdout(devnull):
+        if phase == "parse":
+            rows = len(data_parser(account, None, file))
+        elif phase == "insert":
+            records = data_parser(account, None, file)
+            records.reverse()
+            categorize_by_business(records)
+            statements[0] = 0
+            started = time.perf_counter()
+            result = insert_records(records)
+            rows, failed = len(records), len(result.failed)
+        else:
+            from auto_insert import write_records  # pylint: disable=import-outside-toplevel
+            chunks = detect_parser(file).stream(file, account)
+            result, _ = write_records(chunks, True)
+            rows = result.inserted + result.skipped + len(result.failed)
+            failed = len(result.failed)
+    seconds = time.perf_counter() - started
+    return {"rows": rows, "seconds": seconds, "rows_per_second": rows / seconds if seconds else 0,
+            "peak_rss_mb": peak_rss_mb(), "statements_per_record": statements[0] / max(rows, 1),
+            "failed": failed}
+
+def run_case(phase:str, file:str, db_file:str)->dict:
+    """Run a phase in its own process so peak memory belongs to that phase alone"""
+    build_db(db_file)
+    environment = dict(os.environ, DB_NAME=db_file)
+    command = [sys.executable, os.path.abspath(__file__), "--case", phase, file]
+    if phase != "parse":
+        subprocess.run(command[:2] + ["--case", "seed", file], env=environment, check=True,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    # stdin is closed so a row that would prompt for a category fails instead of hanging
+    completed = subprocess.run(command, env=environment, check=True, stdin=subprocess.DEVNULL,
+                               capture_output=True, text=True)
+    return json.loads(completed.stdout.splitlines()[-1])
+
+def print_result(export_format:str, phase:str, result:dict)->None:
+    """One line of the results table"""
+    peak = "-" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.0f}"
+    print(f"{export_format:<18}{result['rows']:>10}  {phase:<8}{result['seconds']:>9.2f}"
+          f"{result['rows_per_second']:>12.0f}{peak:>10}{result['statements_per_record']:>10.2f}"
+          + (f"  {result['failed']} failed" if result["failed"] else ""))
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Benchmark parsing and inserting exports")
+    parser.add_argument("-s", "--size", type=int, action="append",
+                        help='Rows per export, 1k, 100k and 1M if left out')
+    parser.add_argument("-f", "--format", action="append", choices=list(EXPORT_FORMATS),
+                        help='Export format, all of them if left out')
+    parser.add_argument("-p", "--phase", action="append", choices=BENCHMARK_PHASES,
+                        help='Phase to time, all of them if left out')
+    parser.add_argument("-w", "--work-dir", help='Keeps generated exports here between runs')
+    parser.add_argument("-o", "--output", help='Write the results as JSON to this file')
+    parser.add_argument("--case", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        phase, file = args.case
+        if phase == "seed":
+            seed_categories(file)
+        else:
+            print(json.dumps(run_phase(phase, file)))
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="finance_benchmark_")
+    db_folder = tempfile.mkdtemp(prefix="finance_benchmark_db_")
+    results = []
+    print(f"{'format':<18}{'rows':>10}  {'phase':<8}{'seconds':>9}{'rows/s':>12}"
+          f"{'peak MB':>10}{'sql/row':>10}")
+    try:
+        for export_format in args.format or EXPORT_FORMATS:
+            for size in args.size or BENCHMARK_SIZES:
+                _, file_name, _ = EXPORT_FORMATS[export_format]
+                name, ext = os.path.splitext(file_name)
+                file = os.path.join(work_dir, f"{name}-{size}-0{ext}")
+                if not os.path.exists(file):
+                    try:
+                        file = write_export(export_format, work_dir, size)
+                    except ImportError as error:
+                        print(f"Skipping {export_format}, {error}")
+                        break
+                for phase in args.phase or BENCHMARK_PHASES:
+                    db_file = os.path.join(db_folder, f"{export_format}-{size}-{phase}.db")
+                    result = run_case(phase, file, db_file)
+                    print_result(export_format, phase, result)
+                    results.append(dict(result, format=export_format, size=size, phase=phase))
+    finally:
+        shutil.rmtree(db_folder, ignore_errors=True)
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+
+if __name__ == "__main__":
+    main()
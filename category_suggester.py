@@ -0,0 +1,91 @@
+"""Suggests categories for unknown merchants by character n-gram similarity to known ones"""
+import re
+import numpy as np
+
+NGRAM = 3
+# n-grams are hashed into 2 ** FEATURE_BITS columns instead of keeping a vocabulary
+FEATURE_BITS = 10
+TOP_SUGGESTIONS = 3
+# a best match this close is taken without asking
+AUTO_ACCEPT_SIMILARITY = 0.8
+# unless the runner up is this close behind it
+AUTO_ACCEPT_MARGIN = 0.1
+# Knuth's multiplicative hash spreads trigram codes over the columns
+HASH_MULTIPLIER = np.uint32(2654435761)
+
+def merchant_text(business:str, note:str)->str:
+    """Business and note without store numbers, reference codes or punctuation"""
+    text = re.sub(r"[^A-Z&]+", " ", f"{business} {note}".upper())
+    return f" {' '.join(text.split())} "
+
+def ngram_counts(texts:list[str])->np.ndarray:
+    """Row per text of hashed character n-gram counts"""
+    rows, columns = [], []
+    for row, text in enumerate(texts):
+        data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8).astype(np.uint32)
+        if len(data) < NGRAM:
+            continue
+        codes = data[:1 - NGRAM] if NGRAM > 1 else data
+        for offset in range(1, NGRAM):
+            end = len(data) - NGRAM + 1 + offset
+            codes = (codes << np.uint32(8)) | data[offset:end]
+        columns.append((codes * HASH_MULTIPLIER) >> np.uint32(32 - FEATURE_BITS))
+        rows.append(np.full(len(codes), row))
+    counts = np.zeros((len(texts), 1 << FEATURE_BITS), dtype=np.float32)
+    if rows:
+        np.add.at(counts, (np.concatenate(rows), np.concatenate(columns)), 1)
+    return counts
+
+def normalize_rows(matrix:np.ndarray)->np.ndarray:
+    """Scale every row to unit length so dot products are cosine similarities"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+class CategorySuggester:
+    """TF-IDF matrix of an account's categorized merchants, one row per distinct merchant"""
+    def __init__(self, history:dict[tuple[str, str], tuple[str, str]]):
+        # store numbers collapse many rows into one merchant, keep each merchant once per choice
+        self.documents = dict.fromkeys((merchant_text(business, note), choice)
+                                       for (business, note), choice in history.items())
+        self.choices = list(dict.fromkeys(choice for _, choice in self.documents))
+        choice_index = {choice: index for index, choice in enumerate(self.choices)}
+        self.choice_rows = np.array([choice_index[choice] for _, choice in self.documents],
+                                    dtype=int)
+        counts = ngram_counts([text for text, _ in self.documents])
+        frequency = np.count_nonzero(counts, axis=0)
+        self.idf = (np.log((1 + len(self.documents)) / (1 + frequency)) + 1).astype(np.float32)
+        self.matrix = normalize_rows(counts * self.idf)
+        self.group_rows()
+
+    def group_rows(self)->None:
+        """Order of rows grouped by choice so the best row of each is taken with one reduceat"""
+        self.row_order = np.argsort(self.choice_rows, kind="stable")
+        self.choice_starts = np.searchsorted(self.choice_rows[self.row_order],
+                                             np.arange(len(self.choices)))
+
+    def learn(self, business:str, note:str, choice:tuple[str, str])->None:
+        """Add one categorized merchant without a rebuild, the idf weights stay as they were"""
+        document = (merchant_text(business, note), choice)
+        if document in self.documents:
+            return
+        self.documents[document] = None
+        if choice not in self.choices:
+            self.choices.append(choice)
+        self.matrix = np.vstack([self.matrix,
+                                 normalize_rows(ngram_counts([document[0]]) * self.idf)])
+        self.choice_rows = np.append(self.choice_rows, self.choices.index(choice))
+        self.group_rows()
+
+    def suggest(self, merchants:list[tuple[str, str]],
+                top:int=TOP_SUGGESTIONS)->list[list[tuple[tuple[str, str], float]]]:
+        """Most similar known choices and their similarity for each (business, note), best first"""
+        if not self.choices or not merchants:
+            return [[] for _ in merchants]
+        queries = normalize_rows(ngram_counts([merchant_text(business, note)
+                                               for business, note in merchants]) * self.idf)
+        similarity = queries @ self.matrix.T
+        best = np.maximum.reduceat(similarity[:, self.row_order], self.choice_starts, axis=1)
+        ranked = np.argsort(-best, axis=1)[:, :top]
+        return [[(self.choices[column], float(best[row, column])) for column in columns
+                 if best[row, column] > 0]
+                for row, columns in enumerate(ranked)]
@@ -1,10 +1,15 @@
 """Different Data Parsers and a general flow mechanism"""
+import io
+import gc
+import re
 import csv
 import sys
+from array import array
 from enum import Enum
 from datetime import datetime
-import re
-import pandas as pd
+from itertools import compress, repeat
+from operator import contains, itemgetter, not_
+from typing import Callable, Iterable, Iterator, Sequence
 from db_classes import Record, Account, Asset
 
 class SupportedInstitute(Enum):
@@ -14,6 +19,14 @@ class SupportedInstitute(Enum):
     T_ROWE_PRICE = "T Rowe Price"
     OPTUM = "Optum"
 
+CHUNK_SIZE = 5000
+MONEY_MARKERS = str.maketrans("", "", "$,()")
+OPTUM_DATED_ACTIVITY = r'^(\d{4}[-/]\d{2}[-/]\d{2})|(\d{2}[-/]\d{2}[-/]\d{4})'
+SNIFF_BYTES = 4096
+# xls files are OLE2 compound documents, xlsx files are zip archives
+WORKBOOK_MAGIC = (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", b"PK\x03\x04")
+US_DATE = re.compile(r"\d{2}/\d{2}/\d{4}")
+
 def strip_financial_markers(amount_string:str)->float:
     """Remove currency makers, symbols and commas"""
     return abs(float(
@@ -24,155 +37,406 @@ def strip_financial_markers(amount_string:str)->float:
         .replace(")", "")
     ))
 
-def parse_optum_hsa_xls(xls_file:str, account:Account)->list[Record]:
-    """Parses all transaction info from Optum for HSA account"""
-    transactions = []
-    df = pd.read_excel(xls_file, sheet_name="Transaction Detail Report")
-    for _, row in df.iterrows():
-        if not "Settled" in row["Status"]:
-            continue
-        business = row["Activity"]
-        if re.match(r'^(\d{4}[-/]\d{2}[-/]\d{2})|(\d{2}[-/]\d{2}[-/]\d{4})', row["Activity"]):
-            business = row["Activity"][11:]
-        record = Record(
-            account=account,
-            amount=strip_financial_markers(row["Amount"]),
-            business= business,
-            note=f"{row["Type"]} - {row["Account"]}",
-            transaction_date=datetime.strptime(row["Date"], "%m/%d/%Y")
-        )
-        transactions.append(record)
-    return transactions
-
-def parse_t_rowe_price_401k_csv(csv_file:str, account:Account)->list[Record]:
-    """Parses all transaction info from T Rowe Price for 401k data"""
-    transactions = []
-    with open(csv_file, encoding="utf-8") as file:
+def read_csv_columns(csv_file:str, skip_rows:int, columns:tuple[int, ...])->list[tuple]:
+    """Reads the wanted columns of a csv file as parallel tuples"""
+    with open(csv_file, encoding="utf-8", newline="") as file:
         reader = csv.reader(file, delimiter=',')
-        next(reader) # must burn 4 rows for dead row values
-        next(reader)
-        next(reader)
-        next(reader)
-        for row in reader:
-            transfer_in_record = None
-            activity_type = row[1].strip()
-            if activity_type in "Market Fluctuation":
-                continue
-            if activity_type in "Fee":
-                if row[4][1] != '-':
-                    activity_type = "Rebate"
-                else:
-                    print(row)
-                    print("Handle Fee Event -No data Right now")
-                    sys.exit()
-
-            if activity_type in ("Contribution", "Rebate"):
-                transfer_in_record = Record(
-                    account=account,
-                    amount=strip_financial_markers(row[4]),
-                    business=row[3],
-                    note=f"{activity_type} to account",
-                    transaction_date=datetime.strptime(row[0], "%m/%d/%Y")
-                )
-                activity_type = "Exchange In"
+        for _ in range(skip_rows):
+            next(reader)
+        return _columns_of(reader, columns)
+
+def _columns_of(reader:Iterable[list[str]], columns:tuple[int, ...])->list[tuple]:
+    """Transpose the wanted columns of csv rows into parallel tuples"""
+    if len(columns) == 1:
+        # itemgetter of a single index returns the value rather than a 1-tuple
+        return [tuple(map(itemgetter(columns[0]), filter(None, reader)))]
+    table = list(zip(*map(itemgetter(*columns), filter(None, reader))))
+    return table if table else [() for _ in columns]
+
+def index_csv_rows(csv_file:str, skip_rows:int)->array:
+    """Byte offset where each data row starts, plus the end of the file"""
+    offsets = array("q")
+    position = 0
+    in_quotes = False
+    with open(csv_file, "rb") as file:
+        for line in file:
+            if not in_quotes:
+                offsets.append(position)
+            position += len(line)
+            # a newline inside a quoted field does not start a new row
+            if line.count(b'"') % 2:
+                in_quotes = not in_quotes
+    offsets.append(position)
+    return offsets[skip_rows:]
+
+def iter_csv_chunks(csv_file:str, skip_rows:int, columns:tuple[int, ...],
+                    chunk_size:int=CHUNK_SIZE, from_top:bool=False,
+                    offsets:array|None=None)->Iterator[list[tuple]]:
+    """Columns of the csv in chunks of rows, last chunk of the file first unless from_top"""
+    if offsets is None:
+        offsets = index_csv_rows(csv_file, skip_rows)
+    last_row = len(offsets) - 1
+    if from_top:
+        bounds = ((start, min(start + chunk_size, last_row))
+                  for start in range(0, last_row, chunk_size))
+    else:
+        bounds = ((max(end - chunk_size, 0), end) for end in range(last_row, 0, -chunk_size))
+    with open(csv_file, "rb") as file:
+        for start, end in bounds:
+            file.seek(offsets[start])
+            text = file.read(offsets[end] - offsets[start]).decode("utf-8")
+            yield _columns_of(csv.reader(io.StringIO(text, newline=""), delimiter=','), columns)
+
+class ImportCutoff:
+    """Date an export is read from when it reaches past the watermark, and the rows left out"""
+    def __init__(self, since:datetime, watermark:datetime):
+        self.since = since
+        self.watermark = watermark
+        self.dropped = 0
+
+    def applies(self, newest:datetime)->bool:
+        """Only an export newer than the last import is cut, an older one is read whole"""
+        return newest > self.watermark
+
+    def __str__(self)->str:
+        return (f"{self.dropped} rows dated before {self.since.date()} left out, "
+                f"imported up to {self.watermark.date()} before")
+
+class CsvLayout:
+    """Where an export keeps its rows and how its columns become Records"""
+    def __init__(self, skip_rows:int, columns:tuple[int, ...],
+                 to_records:Callable[[list[tuple], Account], list[Record]]):
+        self.skip_rows = skip_rows
+        self.columns = columns
+        self.to_records = to_records
+
+    def parse(self, csv_file:str, account:Account)->list[Record]:
+        """Every record in file order"""
+        return self.to_records(read_csv_columns(csv_file, self.skip_rows, self.columns), account)
 
+    def stream(self, csv_file:str, account:Account, chunk_size:int=CHUNK_SIZE,
+               cutoff:ImportCutoff|None=None)->Iterator[list[Record]]:
+        """Chunks of records in insert order, only ones from the cutoff on if it applies"""
+        if cutoff is not None:
+            yield from self.stream_since(csv_file, account, chunk_size, cutoff)
+            return
+        for table in iter_csv_chunks(csv_file, self.skip_rows, self.columns, chunk_size):
+            records = self.to_records(table, account)
+            records.reverse()
+            yield records
+
+    def summarize(self, csv_file:str)->tuple[int, datetime|None, datetime|None]:
+        """Row count and oldest and newest date, read from the date column alone"""
+        # every layout lists the transaction date first
+        dates = read_csv_columns(csv_file, self.skip_rows, self.columns[:1])[0]
+        distinct = {date[:10] for date in dates}
+        parsed = [datetime.strptime(date, "%m/%d/%Y") for date in distinct
+                  if US_DATE.fullmatch(date)]
+        return len(dates), min(parsed, default=None), max(parsed, default=None)
+
+    def stream_since(self, csv_file:str, account:Account, chunk_size:int,
+                     cutoff:ImportCutoff)->Iterator[list[Record]]:
+        """Read newest first and stop at the first chunk reaching back past the cutoff"""
+        offsets = index_csv_rows(csv_file, self.skip_rows)
+        chunks = []
+        read_rows = 0
+        for table in iter_csv_chunks(csv_file, self.skip_rows, self.columns, chunk_size,
+                                     from_top=True, offsets=offsets):
+            read_rows += chunk_size
+            records = self.to_records(table, account)
+            if records and not chunks and not cutoff.applies(
+                    max(record.transaction_date for record in records)):
+                # exports list the newest rows first, this one ends before the last import
+                yield from self.stream(csv_file, account, chunk_size)
+                return
+            recent = [record for record in records if record.transaction_date >= cutoff.since]
+            if recent:
+                chunks.append(recent)
+            # everything further down is older, its rows are counted from the index unparsed
+            if len(recent) < len(records):
+                cutoff.dropped += len(records) - len(recent)
+                cutoff.dropped += max(len(offsets) - 1 - read_rows, 0)
+                break
+        for records in reversed(chunks):
+            records.reverse()
+            yield records
+
+def parse_dates(values:Sequence[str], date_format:str)->list[datetime]:
+    """Parse a column of dates, each distinct date string is only parsed once"""
+    parsed = {value: datetime.strptime(value, date_format) for value in set(values)}
+    return list(map(parsed.__getitem__, values))
+
+def clean_numbers(values:Iterable[str])->list[float]:
+    """Parse a column of numbers that may carry currency markers and commas"""
+    return list(map(float, map(str.translate, values, repeat(MONEY_MARKERS))))
+
+def clean_amounts(values:Iterable[str])->list[float]:
+    """strip_financial_markers for a whole column"""
+    return list(map(abs, clean_numbers(values)))
+
+def build_records(account:Account, transaction_dates:Sequence[datetime],
+                  amounts:Sequence[float], businesses:Sequence[str], notes:Sequence[str],
+                  assets:Sequence[tuple|None]=None)->list[Record]:
+    """Turn parallel columns into Records, assets hold (asset, quantity, value, note)"""
+    transactions = []
+    # records hold no reference cycles, collector passes over them are wasted time
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for transaction_date, amount, business, note, asset in zip(
+                transaction_dates, amounts, businesses, notes, assets or repeat(None)):
             record = Record(
                 account=account,
-                amount=strip_financial_markers(row[4]),
-                business=row[3],
-                note=f"{activity_type} {row[2]}",
-                transaction_date=datetime.strptime(row[0], "%m/%d/%Y")
+                amount=amount,
+                business=business,
+                note=note,
+                transaction_date=transaction_date
             )
-            if activity_type in ("Exchange Out", "Exchange In"):
+            if asset is not None:
                 record.add_changed_asset(Asset(
                     account=account,
-                    asset= row[2],
-                    quantity= float(row[5]),
-                    market_value= strip_financial_markers(row[6]),
-                    note= row[3]
+                    asset=asset[0],
+                    quantity=asset[1],
+                    market_value=asset[2],
+                    note=asset[3]
                 ))
             transactions.append(record)
-            if transfer_in_record:
-                transactions.append(transfer_in_record)
+    finally:
+        if collecting:
+            gc.enable()
     return transactions
 
+def parse_optum_hsa_xls(xls_file:str, account:Account)->list[Record]:
+    """Parses all transaction info from Optum for HSA account"""
+    # pandas and xlrd take most of a cold start, only pay for them on Optum sheets
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+    df = pd.read_excel(xls_file, sheet_name="Transaction Detail Report", dtype=str)
+    df = df[df["Status"].str.contains("Settled", regex=False, na=False)]
+    activity = df["Activity"]
+    business = activity.where(~activity.str.match(OPTUM_DATED_ACTIVITY), activity.str[11:])
+    amounts = df["Amount"].str.replace(r"[$,()]", "", regex=True).astype(float).abs()
+    # a blank cell reads as NaN, the row-wise parser wrote it as "nan" and so did fingerprints
+    notes = df["Type"].fillna("nan") + " - " + df["Account"].fillna("nan")
+    dates = pd.to_datetime(df["Date"], format="%m/%d/%Y")
+    return build_records(account, list(dates.dt.to_pydatetime()), amounts.tolist(),
+                         business.tolist(), notes.tolist())
+
+def t_rowe_price_401k_records(columns:list[tuple], account:Account)->list[Record]:
+    """Records from the columns of a T Rowe Price 401k csv"""
+    activities = list(map(str.strip, columns[1]))
+    keep = list(map(not_, map(contains, repeat("Market Fluctuation"), activities)))
+    dates, _, funds, sources, amounts, quantities, values = (
+        list(compress(column, keep)) for column in columns)
+    activities = list(compress(activities, keep))
+    transaction_dates = parse_dates(dates, "%m/%d/%Y")
+    cleaned_amounts = clean_amounts(amounts)
+
+    record_dates, record_amounts, businesses, notes, assets = [], [], [], [], []
+    def add_row(index:int, note:str, asset:tuple|None)->None:
+        record_dates.append(transaction_dates[index])
+        record_amounts.append(cleaned_amounts[index])
+        businesses.append(sources[index])
+        notes.append(note)
+        assets.append(asset)
+
+    for index, activity_type in enumerate(activities):
+        if activity_type in "Fee":
+            if amounts[index][1] != '-':
+                activity_type = "Rebate"
+            else:
+                print([dates[index], activity_type, funds[index], sources[index],
+                       amounts[index], quantities[index], values[index]])
+                print("Handle Fee Event -No data Right now")
+                sys.exit()
+
+        transfer_in_note = None
+        if activity_type in ("Contribution", "Rebate"):
+            transfer_in_note = f"{activity_type} to account"
+            activity_type = "Exchange In"
+        asset = None
+        if activity_type in ("Exchange Out", "Exchange In"):
+            asset = (funds[index], float(quantities[index]),
+                     strip_financial_markers(values[index]), sources[index])
+        add_row(index, f"{activity_type} {funds[index]}", asset)
+        if transfer_in_note:
+            add_row(index, transfer_in_note, None)
+    return build_records(account, record_dates, record_amounts, businesses, notes, assets)
+
+# must burn 4 rows for dead row values
+T_ROWE_PRICE_401K_CSV = CsvLayout(4, (0, 1, 2, 3, 4, 5, 6), t_rowe_price_401k_records)
+
+def parse_t_rowe_price_401k_csv(csv_file:str, account:Account)->list[Record]:
+    """Parses all transaction info from T Rowe Price for 401k data"""
+    return T_ROWE_PRICE_401K_CSV.parse(csv_file, account)
+
+def navy_federal_records(columns:list[tuple], account:Account)->list[Record]:
+    """Records from the columns of a Navy Federal csv"""
+    dates, amounts, businesses, notes = columns
+    return build_records(account, parse_dates(dates, "%m/%d/%Y"), list(map(float, amounts)),
+                         businesses, notes)
+
+NAVY_FEDERAL_CSV = CsvLayout(1, (1, 2, 10, 11), navy_federal_records)
+
 def parse_navy_federal_csv(csv_file:str, account:Account)->list[Record]:
     """Parses all transaction info from credit card csv"""
-    transactions = []
-    with open(csv_file, encoding="utf-8") as file:
-        reader = csv.reader(file, delimiter=',')
-        next(reader)
-        for row in reader:
-            transactions.append(Record(
-                account=account,
-                amount=float(row[2]),
-                business=row[10],
-                note=row[11],
-                transaction_date=datetime.strptime(row[1], "%m/%d/%Y")
-            ))
-    return transactions
+    return NAVY_FEDERAL_CSV.parse(csv_file, account)
+
+def charles_schwab_investment_records(columns:list[tuple], account:Account)->list[Record]:
+    """Records from the columns of a charles swab brokerage csv"""
+    dates, actions, symbols, descriptions, quantities, prices, amounts = (
+        list(compress(column, columns[6])) for column in columns)
+    notes = [f"{description} {symbol}" for description, symbol in zip(descriptions, symbols)]
+    traded = list(map(contains, repeat(("Buy", "Reinvest Shares", "Sell")), actions))
+    traded_quantities = clean_numbers(compress(quantities, traded))
+    traded_prices = clean_amounts(compress(prices, traded))
+    assets = [None] * len(actions)
+    for offset, index in enumerate(compress(range(len(actions)), traded)):
+        assets[index] = (descriptions[index], traded_quantities[offset], traded_prices[offset],
+                         symbols[index])
+    return build_records(account, parse_dates([date[:10] for date in dates], "%m/%d/%Y"),
+                         clean_amounts(amounts), actions, notes, assets)
+
+CHARLES_SCHWAB_INVESTMENT_CSV = CsvLayout(1, (0, 1, 2, 3, 4, 5, 7),
+                                          charles_schwab_investment_records)
 
 def parse_charles_schwab_investment_csv(csv_file:str, account:Account)->list[Record]:
     """Parses all transaction info from charles swab csv"""
-    transactions = []
-    with open(csv_file, encoding="utf-8") as file:
-        reader = csv.reader(file, delimiter=',')
-        next(reader)
-        for row in reader:
-            if row[7] == "":
-                continue
-            record = Record(
-                account=account,
-                amount=abs(float(row[7].replace("$", ""))),
-                business=row[1],
-                note=f"{row[3]} {row[2]}",
-                transaction_date=datetime.strptime(row[0][:10], "%m/%d/%Y")
-            )
-            if "Buy" == row[1] or "Reinvest Shares" == row[1] or "Sell" == row[1]:
-                record.add_changed_asset(Asset(
-                    account=account,
-                    asset= row[3],
-                    quantity= float(row[4]),
-                    market_value= float(row[5][1:]),
-                    note= row[2]
-                ))
-            transactions.append(record)
-    return transactions
+    return CHARLES_SCHWAB_INVESTMENT_CSV.parse(csv_file, account)
+
+def charles_schwab_checking_records(columns:list[tuple], account:Account)->list[Record]:
+    """Records from the columns of a charles swab checking csv"""
+    posted = list(map(contains, columns[1], repeat("Posted")))
+    dates, _, notes, businesses, withdrawals, deposits = (
+        list(compress(column, posted)) for column in columns)
+    amounts = clean_amounts([deposit or withdrawal
+                             for deposit, withdrawal in zip(deposits, withdrawals)])
+    return build_records(account, parse_dates(dates, "%m/%d/%Y"), amounts, businesses, notes)
+
+CHARLES_SCHWAB_CHECKING_CSV = CsvLayout(1, (0, 1, 2, 4, 5, 6), charles_schwab_checking_records)
 
 def parse_charles_schwab_checking_csv(csv_file:str, account:Account)->list[Record]:
     """Parses all transaction info from charles swab csv"""
-    transactions = []
-    with open(csv_file, encoding="utf-8") as file:
-        reader = csv.reader(file, delimiter=',')
-        next(reader)
-        for row in reader:
-            if "Posted" not in row[1]:
-                continue
-            amount = float((row[6][1:] if row[6] != "" else row[5][1:]).replace(",", ""))
-            transactions.append(Record(
-                account=account,
-                amount=amount,
-                business=row[4],
-                note=row[2],
-                transaction_date=datetime.strptime(row[0], "%m/%d/%Y")
-            ))
-    return transactions
+    return CHARLES_SCHWAB_CHECKING_CSV.parse(csv_file, account)
+
+def summarize_optum_hsa_xls(xls_file:str)->tuple[int, datetime|None, datetime|None]:
+    """Row count and oldest and newest date of an Optum sheet"""
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+    df = pd.read_excel(xls_file, sheet_name="Transaction Detail Report", dtype=str)
+    dates = pd.to_datetime(df["Date"], format="%m/%d/%Y", errors="coerce").dropna()
+    if dates.empty:
+        return len(df), None, None
+    return len(df), dates.min().to_pydatetime(), dates.max().to_pydatetime()
+
+def stream_optum_hsa_xls(xls_file:str, account:Account, chunk_size:int=CHUNK_SIZE,
+                         cutoff:ImportCutoff|None=None)->Iterator[list[Record]]:
+    """Optum records in insert order, xls sheets are small so the sheet is read whole"""
+    transactions = parse_optum_hsa_xls(xls_file, account)
+    if cutoff is not None and transactions and cutoff.applies(
+            max(record.transaction_date for record in transactions)):
+        recent = [record for record in transactions if record.transaction_date >= cutoff.since]
+        cutoff.dropped += len(transactions) - len(recent)
+        transactions = recent
+    for end in range(len(transactions), 0, -chunk_size):
+        chunk = transactions[max(end - chunk_size, 0):end]
+        chunk.reverse()
+        yield chunk
+
+class ParserPlugin:
+    """A parser the registry picks for a file by sniffing its first bytes"""
+    def __init__(self, name:str, institute:SupportedInstitute, sniff:Callable[[bytes], bool],
+                 parse:Callable[[str, Account], list[Record]],
+                 stream:Callable[[str, Account, int, ImportCutoff|None],
+                                 Iterator[list[Record]]],
+                 summarize:Callable[[str], tuple[int, datetime|None, datetime|None]]):
+        self.name = name
+        self.institute = institute
+        self.sniff = sniff
+        self.parse = parse
+        self.stream = stream
+        self.summarize = summarize
+
+PARSERS:list[ParserPlugin] = []
 
-def data_parser(account:Account, institute:str, file:str)->list[Record]:
+def register_parser(plugin:ParserPlugin)->ParserPlugin:
+    """Add a parser to the registry, earlier parsers are sniffed first"""
+    PARSERS.append(plugin)
+    return plugin
+
+def head_rows(head:bytes, rows:int)->list[list[str]]:
+    """The first csv rows found in the start of a file"""
+    text = head.decode("utf-8-sig", errors="replace")
+    if len(head) == SNIFF_BYTES:
+        # the last line was likely cut off by the read
+        text = text[:text.rfind("\n") + 1]
+    reader = csv.reader(io.StringIO(text, newline=""), delimiter=',')
+    return [list(map(str.strip, row)) for _, row in zip(range(rows), reader)]
+
+def header_has(*columns:str)->Callable[[bytes], bool]:
+    """Sniff for a csv whose first row names all the columns"""
+    def sniff(head:bytes)->bool:
+        rows = head_rows(head, 1)
+        return bool(rows) and set(columns).issubset(rows[0])
+    return sniff
+
+def dated_row_after(skip_rows:int, width:int)->Callable[[bytes], bool]:
+    """Sniff for a csv whose first data row starts with a date after some dead rows"""
+    def sniff(head:bytes)->bool:
+        rows = head_rows(head, skip_rows + 1)
+        return (len(rows) > skip_rows and len(rows[skip_rows]) >= width
+                and US_DATE.fullmatch(rows[skip_rows][0]) is not None)
+    return sniff
+
+def is_workbook(head:bytes)->bool:
+    """Sniff for an excel workbook"""
+    return head.startswith(WORKBOOK_MAGIC)
+
+register_parser(ParserPlugin(
+    "Navy Federal csv", SupportedInstitute.NAVY_FEDERAL,
+    header_has("Transaction Date", "Amount", "Credit Debit Indicator", "Description"),
+    NAVY_FEDERAL_CSV.parse, NAVY_FEDERAL_CSV.stream, NAVY_FEDERAL_CSV.summarize))
+register_parser(ParserPlugin(
+    "Charles Schwab checking csv", SupportedInstitute.CHARLES_SCHWAB,
+    header_has("Date", "Status", "Description", "Withdrawal", "Deposit"),
+    CHARLES_SCHWAB_CHECKING_CSV.parse, CHARLES_SCHWAB_CHECKING_CSV.stream,
+    CHARLES_SCHWAB_CHECKING_CSV.summarize))
+register_parser(ParserPlugin(
+    "Charles Schwab brokerage csv", SupportedInstitute.CHARLES_SCHWAB,
+    header_has("Date", "Action", "Symbol", "Description", "Quantity", "Price", "Amount"),
+    CHARLES_SCHWAB_INVESTMENT_CSV.parse, CHARLES_SCHWAB_INVESTMENT_CSV.stream,
+    CHARLES_SCHWAB_INVESTMENT_CSV.summarize))
+register_parser(ParserPlugin(
+    "Optum HSA sheet", SupportedInstitute.OPTUM, is_workbook,
+    parse_optum_hsa_xls, stream_optum_hsa_xls, summarize_optum_hsa_xls))
+# has no header to go by, so it is sniffed after every csv that does
+register_parser(ParserPlugin(
+    "T Rowe Price 401k csv", SupportedInstitute.T_ROWE_PRICE,
+    dated_row_after(T_ROWE_PRICE_401K_CSV.skip_rows, len(T_ROWE_PRICE_401K_CSV.columns)),
+    T_ROWE_PRICE_401K_CSV.parse, T_ROWE_PRICE_401K_CSV.stream,
+    T_ROWE_PRICE_401K_CSV.summarize))
+
+def sniff_parser(file:str)->ParserPlugin|None:
+    """The registered parser whose sniff matches the start of a file, if any"""
+    with open(file, "rb") as stream:
+        head = stream.read(SNIFF_BYTES)
+    return next((plugin for plugin in PARSERS if plugin.sniff(head)), None)
+
+def detect_parser(file:str, institute:str|None=None)->ParserPlugin:
+    """The registered parser for a file, rejects files that do not match the institute"""
+    plugin = sniff_parser(file)
+    if plugin is None:
+        print("Not a valid File")
+        print(file)
+        sys.exit()
+    if institute and plugin.institute != SupportedInstitute[institute]:
+        print(f"{file} looks like a {plugin.name}, not a {SupportedInstitute[institute].value} file")
+        sys.exit()
+    return plugin
+
+def data_parser(account:Account, institute:str|None, file:str)->list[Record]:
     """Main Flow data Parser"""
-    if (SupportedInstitute[institute] == SupportedInstitute.NAVY_FEDERAL
-            and ".csv" in file):
-        return parse_navy_federal_csv(file, account)
-    if SupportedInstitute[institute] == SupportedInstitute.CHARLES_SCHWAB:
-        if "Checking" in file:
-            return parse_charles_schwab_checking_csv(file, account)
-        if "Individual" in file or "Roth" in file:
-            return parse_charles_schwab_investment_csv(file, account)
-    if (SupportedInstitute[institute] == SupportedInstitute.T_ROWE_PRICE
-            and ".csv" in file):
-        return parse_t_rowe_price_401k_csv(file, account)
-    if (SupportedInstitute[institute] == SupportedInstitute.OPTUM
-            and ".xls" in file):
-        return parse_optum_hsa_xls(file, account)
-    print("Not a valid File")
-    sys.exit()
+    return detect_parser(file, institute).parse(file, account)
+
+def stream_records(account:Account, institute:str|None, file:str, chunk_size:int=CHUNK_SIZE,
+                   cutoff:ImportCutoff|None=None)->Iterator[list[Record]]:
+    """Records in chunks, oldest first, without holding the whole file in memory"""
+    return detect_parser(file, institute).stream(file, account, chunk_size, cutoff)
@@ -1,8 +1,14 @@
 """Database Classes, structures and helpers"""
+import re
 import sys
+import hashlib
 from enum import Enum
-from datetime import datetime
-from db_helper import sql_get, sql_insert, sql_update
+from datetime import datetime, timedelta
+from contextlib import contextmanager, ExitStack
+from typing import Iterator
+from db_helper import (sql_get, sql_insert, sql_update, sql_insert_many, sql_update_many,
+                       db_session, DatabaseError)
+from instrumentation import timed_phase
 
 class RecordChangeType(Enum):
     """Types of changes that records embody"""
@@ -12,6 +18,119 @@ class RecordChangeType(Enum):
     SELL_ASSET = "Sell Asset"
 
 RECORD_CHANGE_TYPES = [change_type for change_type in RecordChangeType]
+INSERT_RECORD_STATEMENT = "INSERT INTO records \
+    (account_id, asset_id, liability_id, amount, business, category, quantity, \
+    change_type, note, transaction_date, fingerprint) \
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+LAST_SNAPSHOT_DAY = "9999-12-31"
+UPSERT_ROLLUP_STATEMENT = "INSERT INTO monthly_rollups \
+    (account_id, month, category, change_type, total, record_count) \
+    VALUES (?, ?, ?, ?, ?, ?) \
+    ON CONFLICT (account_id, month, category, change_type) DO UPDATE \
+    SET total = total + excluded.total, record_count = record_count + excluded.record_count;"
+# a changed day starts from the balance of the day before it, or the opening balance
+INSERT_SNAPSHOT_STATEMENT = "INSERT OR IGNORE INTO balance_snapshots \
+        (account_id, as_of, cash_funds, investment_worth, debt_total) \
+    SELECT account_id, ?, cash_funds, investment_worth, debt_total FROM balance_snapshots \
+    WHERE account_id = ? AND as_of = COALESCE( \
+        (SELECT MAX(as_of) FROM balance_snapshots WHERE account_id = ? AND as_of < ?), \
+        (SELECT MIN(as_of) FROM balance_snapshots WHERE account_id = ?));"
+SHIFT_SNAPSHOTS_STATEMENT = "UPDATE balance_snapshots \
+    SET cash_funds = ROUND(cash_funds + ?, 2), investment_worth = ROUND(investment_worth + ?, 2) \
+    WHERE account_id = ? AND as_of >= ? AND as_of < ?;"
+# hot lookups, db_migrations checks that each of these is answered from an index
+SELECT_RECORD_ID_STATEMENT = "SELECT record_id FROM records WHERE fingerprint = ?;"
+SELECT_FINGERPRINTS_STATEMENT = "SELECT fingerprint FROM records \
+    WHERE account_id = ? AND fingerprint IS NOT NULL;"
+SELECT_CATEGORY_HISTORY_STATEMENT = "SELECT business, note, category, change_type \
+    FROM records WHERE account_id = ? \
+    GROUP BY business, note, category, change_type ORDER BY MIN(record_id);"
+SELECT_POSITIONS_STATEMENT = "SELECT asset_id, asset, quantity, market_value, note \
+    FROM assets WHERE account_id = ? ORDER BY asset_id;"
+SELECT_PRICE_STATEMENT = "SELECT price FROM prices WHERE asset = ? AND as_of <= ? \
+    ORDER BY as_of DESC LIMIT 1;"
+# quantities move by what this run traded, the price is the one of its last trade
+ADD_TO_POSITION_STATEMENT = "UPDATE assets SET quantity = quantity + ?, market_value = ? \
+    WHERE asset_id = ? RETURNING quantity;"
+# totals move by what this run changed, other writers may have moved them since it read them
+ADD_TO_TOTALS_STATEMENT = "UPDATE accounts \
+    SET cash_funds = ROUND(cash_funds + ?, 2), investment_worth = ROUND(investment_worth + ?, 2) \
+    WHERE account_id = ? RETURNING cash_funds, investment_worth;"
+
+def record_fingerprint(account_id:int, transaction_date, amount:float, business:str,
+                       note:str, change_type:str)->str:
+    """Stable hash of the fields that make a record unique"""
+    if isinstance(transaction_date, datetime):
+        transaction_date = transaction_date.strftime("%Y-%m-%d")
+    fields = [str(account_id), str(transaction_date)[:10], f"{float(amount):.2f}",
+              str(business), str(note), str(change_type)]
+    return hashlib.sha1("\x1f".join(fields).encode("utf-8")).hexdigest()
+
+def normalize_symbol(asset:str)->str:
+    """Asset name as the position ledger keys it"""
+    return " ".join(str(asset).upper().split())
+
+def normalize_business(business:str)->str:
+    """Merchant name without store numbers, reference codes and punctuation"""
+    tokens = re.split(r"[^A-Z0-9&]+", str(business).upper())
+    return " ".join(token for token in tokens if token and not re.search(r"\d", token))
+
+class CategoryIndex:
+    """In memory copy of how an account's records have been categorized"""
+    @timed_phase("load category index")
+    def __init__(self, account_id:int):
+        self.account_id = account_id
+        self.exact = {}
+        self.by_business = {}
+        self.categories = []
+        self.suggester = None
+        # each distinct categorization once, in the order it was first used
+        for business, note, category, change_type in sql_get(SELECT_CATEGORY_HISTORY_STATEMENT,
+                                                             [account_id]):
+            self.learn(business, note, category, change_type)
+
+    def learn(self, business:str, note:str, category:str, change_type:str)->None:
+        """Remember a categorization, first one seen for a business and note wins"""
+        choice = (category, change_type)
+        # LIKE without wildcards matched case-insensitively, keep that behaviour
+        key = (str(business).lower(), str(note).lower())
+        if key not in self.exact:
+            self.exact[key] = choice
+            if self.suggester is not None:
+                self.suggester.learn(business, note, choice)
+        merchant = normalize_business(business)
+        if not merchant:
+            pass
+        elif merchant not in self.by_business:
+            self.by_business[merchant] = choice
+        elif self.by_business[merchant] != choice:
+            self.by_business[merchant] = None # merchant used for several categories, ask
+        if choice not in self.categories:
+            self.categories.append(choice)
+
+    @timed_phase("suggest categories")
+    def suggest(self, merchants:list[tuple[str, str]])->list[list[tuple[tuple[str, str], float]]]:
+        """Known categories most like each (business, note) with their similarity, best first"""
+        if self.suggester is None:
+            # numpy is only paid for when a merchant is not known already
+            # pylint: disable-next=import-outside-toplevel
+            from category_suggester import CategorySuggester
+            self.suggester = CategorySuggester(self.exact)
+        return self.suggester.suggest(merchants)
+
+    def is_ambiguous(self, business:str)->bool:
+        """Merchant has been filed under more than one category"""
+        merchant = normalize_business(business)
+        return bool(merchant) and merchant in self.by_business \
+            and self.by_business[merchant] is None
+
+    def lookup(self, business:str, note:str)->tuple[str, str]|None:
+        """Known category and change type name for a business and note"""
+        choice = self.exact.get((str(business).lower(), str(note).lower()))
+        merchant = normalize_business(business)
+        if choice is None and merchant:
+            choice = self.by_business.get(merchant)
+        return choice
 
 class Account:
     """Account Structure matching DB"""
@@ -29,32 +148,160 @@ class Account:
         self.cash_funds = results[0][4]
         self.investment_worth = results[0][5]
         self.debt_total = results[0][6]
+        self.written_totals = (self.cash_funds, self.investment_worth)
+        self.fingerprints = None
+        self.category_index = None
+        self.position_ledger = None
+        self.ingest_state = None
+        self.deferred = False
+        self.balance_changes = []
+
+    def get_category_index(self)->CategoryIndex:
+        """Categorization history of this account, loaded once per run"""
+        if self.category_index is None:
+            self.category_index = CategoryIndex(self.account_id)
+        return self.category_index
+
+    def get_fingerprints(self)->set[str]:
+        """Fingerprints of every record in this account, loaded once per run"""
+        if self.fingerprints is None:
+            self.fingerprints = self.load_fingerprints()
+        return self.fingerprints
+
+    @timed_phase("load fingerprints")
+    def load_fingerprints(self)->set[str]:
+        """Read the fingerprints of every record in this account"""
+        results = sql_get(SELECT_FINGERPRINTS_STATEMENT, [self.account_id])
+        return {row[0] for row in results}
+
+    def get_position_ledger(self)->"PositionLedger":
+        """Asset positions of this account, loaded once per run"""
+        if self.position_ledger is None:
+            self.position_ledger = PositionLedger(self)
+        return self.position_ledger
+
+    def get_ingest_state(self)->"IngestState":
+        """Watermark and imported file hashes of this account, loaded once per run"""
+        if self.ingest_state is None:
+            self.ingest_state = IngestState(self)
+        return self.ingest_state
+
+    def checkpoint(self)->tuple:
+        """In memory state to return to if the changes that follow are rolled back"""
+        positions = self.position_ledger.checkpoint() if self.position_ledger else None
+        return (self.cash_funds, self.investment_worth, self.debt_total, self.written_totals,
+                positions, len(self.balance_changes))
+
+    def rollback_to(self, checkpoint:tuple)->None:
+        """Undo in memory changes made since checkpoint"""
+        (self.cash_funds, self.investment_worth, self.debt_total, self.written_totals,
+         positions, changes) = checkpoint
+        if self.position_ledger:
+            self.position_ledger.rollback_to(positions)
+        del self.balance_changes[changes:]
+
+    @contextmanager
+    def defer_updates(self)->Iterator[None]:
+        """Keep running totals in memory and write them once when the block finishes"""
+        if self.deferred:
+            yield
+            return
+        self.deferred = True
+        if self.position_ledger:
+            # the batch holds the write lock, positions read now stay true until it commits
+            self.position_ledger.sync()
+        try:
+            yield
+        finally:
+            self.deferred = False
+        if self.position_ledger:
+            self.position_ledger.flush()
+        self.flush_totals()
 
-    def update_cash_funds(self, amount:float, change_type:RecordChangeType)->None:
+    @timed_phase("flush account totals")
+    def flush_totals(self)->None:
+        """Write the running totals to the DB"""
+        self.write_totals()
+        self.flush_snapshots()
+
+    def write_totals(self)->None:
+        """Add the change since the last write to the stored totals and read back the result"""
+        sql_params = [self.cash_funds - self.written_totals[0],
+                      self.investment_worth - self.written_totals[1], self.account_id]
+        results = sql_get(ADD_TO_TOTALS_STATEMENT, sql_params)
+        self.cash_funds, self.investment_worth = results[0]
+        self.written_totals = (self.cash_funds, self.investment_worth)
+
+    def refresh_totals(self)->None:
+        """Read the stored totals again after they were changed outside this object"""
+        sql_statement = "SELECT cash_funds, investment_worth FROM accounts WHERE account_id = ?;"
+        self.cash_funds, self.investment_worth = sql_get(sql_statement, [self.account_id])[0]
+        self.written_totals = (self.cash_funds, self.investment_worth)
+
+    @timed_phase("flush balance snapshots")
+    def flush_snapshots(self)->None:
+        """Apply the dated balance changes to balance_snapshots, later days shift with them"""
+        if not self.balance_changes:
+            return
+        changes = {}
+        for day, cash_change, investment_change in self.balance_changes:
+            change = changes.setdefault(day, [0.0, 0.0])
+            change[0] += cash_change
+            change[1] += investment_change
+        days = sorted(changes)
+        sql_statement = "SELECT 1 FROM balance_snapshots WHERE account_id = ? LIMIT 1;"
+        if sql_get(sql_statement, [self.account_id]) == []:
+            # first changes of the account, what it held before them is its opening balance
+            opening = datetime.strptime(days[0], "%Y-%m-%d") - timedelta(days=1)
+            sql_statement = "INSERT INTO balance_snapshots \
+                (account_id, as_of, cash_funds, investment_worth, debt_total) \
+                VALUES (?, ?, ?, ?, ?);"
+            sql_update(sql_statement, [
+                self.account_id, opening.strftime("%Y-%m-%d"),
+                round(self.cash_funds - sum(change[0] for change in changes.values()), 2),
+                round(self.investment_worth - sum(change[1] for change in changes.values()), 2),
+                self.debt_total])
+        sql_update_many(INSERT_SNAPSHOT_STATEMENT, [[day, self.account_id, self.account_id, day,
+                                                     self.account_id] for day in days])
+        # each snapshot is shifted once by every change dated on or before it
+        shifts, cash_change, investment_change = [], 0.0, 0.0
+        for day, next_day in zip(days, days[1:] + [LAST_SNAPSHOT_DAY]):
+            cash_change += changes[day][0]
+            investment_change += changes[day][1]
+            shifts.append([cash_change, investment_change, self.account_id, day, next_day])
+        sql_update_many(SHIFT_SNAPSHOTS_STATEMENT, shifts)
+        self.balance_changes.clear()
+
+    def record_balance_change(self, as_of:datetime|None, cash_change:float,
+                              investment_change:float)->None:
+        """Remember a change for the snapshot of its day, today when it has no date"""
+        day = (as_of or datetime.now()).strftime("%Y-%m-%d")
+        self.balance_changes.append((day, cash_change, investment_change))
+
+    def update_cash_funds(self, amount:float, change_type:RecordChangeType,
+                          as_of:datetime|None=None)->None:
         """Update total fund counter"""
         if change_type in (RecordChangeType.DEBIT_ACCOUNT, RecordChangeType.SELL_ASSET):
             self.cash_funds += amount
+            self.record_balance_change(as_of, amount, 0.0)
         elif change_type in (RecordChangeType.CREDIT_ACCOUNT, RecordChangeType.BUY_ASSET):
             self.cash_funds -= amount
+            self.record_balance_change(as_of, -amount, 0.0)
         else:
             print("Not a supported record change type", amount, change_type.name)
             sys.exit()
+        if self.deferred:
+            return
+        self.flush_totals()
 
-        sql_statement = "UPDATE accounts \
-            SET cash_funds = ? \
-            WHERE account_id = ?"
-        sql_params = [round(self.cash_funds, 2), self.account_id]
-        sql_update(sql_statement, sql_params)
-
-    def update_investment_worth(self, asset_value_change:float)->None:
+    def update_investment_worth(self, asset_value_change:float,
+                                as_of:datetime|None=None)->None:
         """Update total investment counter"""
         self.investment_worth += asset_value_change
-
-        sql_statement = "UPDATE accounts \
-            SET investment_worth = ? \
-            WHERE account_id = ?"
-        sql_params = [round(self.investment_worth, 2), self.account_id]
-        sql_update(sql_statement, sql_params)
+        self.record_balance_change(as_of, 0.0, asset_value_change)
+        if self.deferred:
+            return
+        self.flush_totals()
 
     def update_debt_total(self, amount:float, change_type:RecordChangeType)->None:
         """Update total debt counter"""
@@ -74,21 +321,10 @@ class Asset:
 
     def get_asset_id(self)->None:
         """Get asset from DB"""
-        sql_statement = "SELECT asset_id FROM assets WHERE account_id = ? AND asset LIKE ?;"
-        sql_params = [self.account.account_id, f"%{self.asset}%"]
-        results = sql_get(sql_statement, sql_params)
-        self.asset_id = None if results == [] else results[0][0]
-
-    def get_asset_values(self)->None:
-        """Get asset values from DB"""
-        sql_statement = "SELECT * FROM assets WHERE asset_id = ?;"
-        sql_params = [self.asset_id]
-        results = sql_get(sql_statement, sql_params)
-        self.asset = None if results == [] else results[0][2]
-        self.quantity = None if results == [] else results[0][3]
-        self.market_value = None if results == [] else results[0][4]
+        position = self.account.get_position_ledger().get(self.asset)
+        self.asset_id = None if position is None else position.asset_id
 
-    def insert_asset(self)->None:
+    def insert_asset(self, as_of:datetime|None=None)->None:
         """Insert New asset into DB"""
         if self.asset_id is not None:
             print("System error, asset exists cannot insert should update")
@@ -99,33 +335,168 @@ class Asset:
         sql_params = [self.account.account_id, self.asset, self.quantity, self.market_value,
                       self.note]
         self.asset_id = sql_insert(sql_statement, sql_params)
-        self.account.update_investment_worth(self.quantity * self.market_value)
+        self.account.get_position_ledger().add(self)
+        self.account.update_investment_worth(self.quantity * self.market_value, as_of)
         print("--------New Asset added to DB")
 
-    def update_asset(self, change_type:RecordChangeType)->None:
+    @timed_phase("asset update")
+    def update_asset(self, change_type:RecordChangeType, as_of:datetime|None=None)->None:
         """Update asset in DB"""
-        self.get_asset_id()
-        if self.asset_id is None:
-            self.insert_asset()
+        ledger = self.account.get_position_ledger()
+        with db_session():
+            ledger.sync()
+            position = ledger.get(self.asset)
+            if position is None:
+                self.insert_asset(as_of)
+                return
+            quantity_change = self.quantity
+            if change_type == RecordChangeType.SELL_ASSET:
+                quantity_change = -quantity_change
+
+            old_total_asset_value = position.quantity * position.market_value
+            position.quantity += quantity_change
+            position.market_value = self.market_value
+            asset_value_change = position.quantity * position.market_value - old_total_asset_value
+            self.asset_id = position.asset_id
+            self.asset = position.asset
+            self.quantity = position.quantity
+
+            ledger.save(position)
+            self.account.update_investment_worth(asset_value_change, as_of)
+            print("--------Updated Asset in DB")
+
+class PositionLedger:
+    """In memory positions of an account keyed by normalized asset name"""
+    @timed_phase("load position ledger")
+    def __init__(self, account:Account):
+        self.account = account
+        self.positions = {}
+        self.changed = set()
+        self.written = {}
+        self.data_version = None
+        self.load()
+
+    def load(self)->None:
+        """Read the account's positions, keeping the Asset objects already handed out"""
+        self.data_version = sql_get("PRAGMA data_version;", [])[0][0]
+        for asset_id, asset, quantity, market_value, note in sql_get(SELECT_POSITIONS_STATEMENT,
+                                                                     [self.account.account_id]):
+            symbol = normalize_symbol(asset)
+            if symbol in self.positions and self.positions[symbol].asset_id != asset_id:
+                continue
+            position = self.positions.setdefault(symbol, Asset(
+                asset_id=asset_id,
+                account=self.account,
+                asset=asset,
+                note=note
+            ))
+            position.quantity = quantity
+            position.market_value = market_value
+            self.written[symbol] = quantity
+
+    def sync(self)->None:
+        """Read the positions again if another connection committed since they were read"""
+        # positions changed in memory and not yet written are newer than anything stored
+        if self.changed or sql_get("PRAGMA data_version;", [])[0][0] == self.data_version:
+            return
+        self.load()
+
+    @timed_phase("asset lookup")
+    def get(self, asset:str)->Asset|None:
+        """Current position for an asset name"""
+        return self.positions.get(normalize_symbol(asset))
+
+    def add(self, asset:Asset)->None:
+        """Track a position that was just inserted"""
+        self.positions[normalize_symbol(asset.asset)] = Asset(
+            asset_id=asset.asset_id,
+            account=self.account,
+            asset=asset.asset,
+            quantity=asset.quantity,
+            market_value=asset.market_value,
+            note=asset.note
+        )
+        self.written[normalize_symbol(asset.asset)] = asset.quantity
+
+    def save(self, position:Asset)->None:
+        """Write a changed position now, or at flush while the account defers updates"""
+        symbol = normalize_symbol(position.asset)
+        if self.account.deferred:
+            self.changed.add(symbol)
+            return
+        self.write(symbol)
+
+    def write(self, symbol:str)->None:
+        """Add the quantity traded since the last write to the stored one and read it back"""
+        position = self.positions[symbol]
+        sql_params = [position.quantity - self.written[symbol], position.market_value,
+                      position.asset_id]
+        position.quantity = sql_get(ADD_TO_POSITION_STATEMENT, sql_params)[0][0]
+        self.written[symbol] = position.quantity
+
+    @timed_phase("flush positions")
+    def flush(self)->None:
+        """Write every position changed while updates were deferred"""
+        for symbol in self.changed:
+            self.write(symbol)
+        self.changed.clear()
+
+    def checkpoint(self)->tuple:
+        """Copy of the positions to return to if the changes that follow are rolled back"""
+        values = {symbol: (position.quantity, position.market_value)
+                  for symbol, position in self.positions.items()}
+        return (values, set(self.changed), dict(self.written), self.data_version)
+
+    def rollback_to(self, checkpoint:tuple|None)->None:
+        """Undo in memory position changes made since checkpoint"""
+        if checkpoint is None:
+            self.positions.clear()
+            self.changed.clear()
+            self.account.position_ledger = None
             return
-        quantity_change = self.quantity
-        current_market_value = self.market_value
-        if change_type == RecordChangeType.SELL_ASSET:
-            quantity_change = -quantity_change
-
-        self.get_asset_values()
-        old_total_asset_value = self.quantity * self.market_value
-        self.quantity += quantity_change
-        self.market_value = current_market_value
-        asset_value_change = self.quantity * self.market_value - old_total_asset_value
-
-        sql_statement = "UPDATE assets \
-            SET quantity = ?, market_value = ? \
-            WHERE asset_id = ?"
-        sql_params = [self.quantity, self.market_value, self.asset_id]
-        sql_update(sql_statement, sql_params)
-        self.account.update_investment_worth(asset_value_change)
-        print("--------Updated Asset in DB")
+        values, changed, self.written, self.data_version = checkpoint
+        for symbol in list(self.positions):
+            if symbol not in values:
+                del self.positions[symbol]
+                continue
+            self.positions[symbol].quantity, self.positions[symbol].market_value = values[symbol]
+        self.changed = changed
+
+class IngestState:
+    """How far an account has been imported and which export files it has seen"""
+    @timed_phase("load ingest state")
+    def __init__(self, account:Account):
+        self.account = account
+        sql_statement = "SELECT last_imported_date FROM ingest_state WHERE account_id = ?;"
+        results = sql_get(sql_statement, [account.account_id])
+        self.last_imported_date = (None if results == [] else
+                                   datetime.strptime(results[0][0][:10], "%Y-%m-%d"))
+        sql_statement = "SELECT file_hash, file_name FROM ingested_files WHERE account_id = ?;"
+        results = sql_get(sql_statement, [account.account_id])
+        self.file_hashes = {row[0] for row in results}
+        self.file_names = {row[1] for row in results}
+
+    def cutoff(self, overlap_days:int)->datetime|None:
+        """Oldest transaction date worth reading again, None when nothing was imported yet"""
+        if self.last_imported_date is None:
+            return None
+        return self.last_imported_date - timedelta(days=overlap_days)
+
+    def add_file(self, file_hash:str, file_name:str, newest_date:datetime|None)->None:
+        """Remember an export whose rows are all in the DB"""
+        sql_statement = "INSERT OR IGNORE INTO ingested_files \
+            (account_id, file_hash, file_name, newest_date) VALUES (?, ?, ?, ?);"
+        sql_insert(sql_statement, [self.account.account_id, file_hash, file_name, newest_date])
+        self.file_hashes.add(file_hash)
+        self.file_names.add(file_name)
+
+    def set_watermark(self, last_imported_date:datetime)->None:
+        """Move the date imports resume from"""
+        sql_statement = "INSERT INTO ingest_state (account_id, last_imported_date) \
+            VALUES (?, ?) ON CONFLICT (account_id) \
+            DO UPDATE SET last_imported_date = excluded.last_imported_date;"
+        sql_update(sql_statement, [self.account.account_id, last_imported_date])
+        self.last_imported_date = last_imported_date
 
 class Liability:
     """Liability Structure matching DB"""
@@ -187,58 +558,100 @@ class Record:
         self.note = note
         self.transaction_date = transaction_date
 
+    @timed_phase("dedup lookup")
     def get_record_id(self)->None:
         """Get record from DB"""
-        sql_statement = "SELECT * FROM records WHERE account_id = ? AND amount = ? AND \
-            business = ? AND category = ? AND change_type = ? AND note = ? AND \
-            transaction_date = ?;"
-        sql_params = [self.account.account_id, self.amount, self.business, self.category,
-                      self.change_type.name, self.note, self.transaction_date]
-        results = sql_get(sql_statement, sql_params)
+        results = sql_get(SELECT_RECORD_ID_STATEMENT, [self.get_fingerprint()])
         self.record_id = None if results == [] else results[0][0]
 
-    def insert_record(self)->None:
-        """Insert record into DB"""
-        self.get_record_id()
-        if self.record_id is not None:
-            return
-        if self.changed_asset.account:
-            self.changed_asset.update_asset(self.change_type)
-        if self.changed_liability.account:
-            self.changed_liability.update_liability(self.change_type)
-        sql_statement = "INSERT INTO records \
-            (account_id, asset_id, liability_id, amount, business, category, quantity, \
-            change_type, note, transaction_date) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
-        sql_params = [self.account.account_id, self.changed_asset.asset_id,
-                      self.changed_liability.liability_id, self.amount, self.business,
-                      self.category, self.quantity, self.change_type.name,
-                      self.note, self.transaction_date]
-        self.record_id = sql_insert(sql_statement, sql_params)
-        self.account.update_cash_funds(self.amount, self.change_type)
+    def get_fingerprint(self)->str:
+        """Hash used to spot this record in the DB"""
+        return record_fingerprint(self.account.account_id, self.transaction_date, self.amount,
+                                  self.business, self.note, self.change_type.name)
+
+    def get_insert_params(self)->list:
+        """Values for INSERT_RECORD_STATEMENT"""
+        return [self.account.account_id, self.changed_asset.asset_id,
+                self.changed_liability.liability_id, self.amount, self.business,
+                self.category, self.quantity, self.change_type.name,
+                self.note, self.transaction_date, self.get_fingerprint()]
+
+    @timed_phase("insert record")
+    def insert_record(self)->bool:
+        """Insert record into DB, returns False when it was already there"""
+        with db_session():
+            self.get_record_id()
+            if self.record_id is not None:
+                return False
+            if self.changed_asset.account:
+                self.changed_asset.update_asset(self.change_type, self.transaction_date)
+            if self.changed_liability.account:
+                self.changed_liability.update_liability(self.change_type)
+            self.record_id = sql_insert(INSERT_RECORD_STATEMENT, self.get_insert_params())
+            add_to_rollups([self])
+            self.account.update_cash_funds(self.amount, self.change_type, self.transaction_date)
+        if self.account.fingerprints is not None:
+            self.account.fingerprints.add(self.get_fingerprint())
         print("--------Record added to DB")
+        return True
 
     def get_category(self)->None:
         """Gets the category of the transaction"""
-        sql_statement = "SELECT category, change_type FROM records \
-            WHERE account_id = ? AND business LIKE ? AND note LIKE ?;"
-        results = sql_get(sql_statement, [self.account.account_id, self.business, self.note])
-        if results != []:
-            self.category = results[0][0]
-            self.change_type = RecordChangeType[results[0][1]]
+        if self.auto_categorize():
             return
+        category_index = self.account.get_category_index()
+        suggestions = category_index.suggest([(self.business, self.note)])[0]
+        if not self.accept_suggestion(suggestions):
+            self.prompt_category(category_index, suggestions=suggestions)
+        category_index.learn(self.business, self.note, self.category, self.change_type.name)
+
+    @timed_phase("category lookup")
+    def auto_categorize(self)->bool:
+        """Set the category from the account's history, returns False if it is unknown"""
+        known = self.account.get_category_index().lookup(self.business, self.note)
+        if known is None:
+            return False
+        self.category = known[0]
+        self.change_type = RecordChangeType[known[1]]
+        return True
+
+    def accept_suggestion(self, suggestions:list[tuple[tuple[str, str], float]])->bool:
+        """Take the best suggestion when it is close and clearly ahead, returns False if not"""
+        # pylint: disable-next=import-outside-toplevel
+        from category_suggester import AUTO_ACCEPT_SIMILARITY, AUTO_ACCEPT_MARGIN
+        if not suggestions or suggestions[0][1] < AUTO_ACCEPT_SIMILARITY:
+            return False
+        # a merchant already filed under several categories is asked about however alike it is
+        if self.account.get_category_index().is_ambiguous(self.business):
+            return False
+        if len(suggestions) > 1 and suggestions[0][1] - suggestions[1][1] < AUTO_ACCEPT_MARGIN:
+            return False
+        (self.category, change_type), similarity = suggestions[0]
+        self.change_type = RecordChangeType[change_type]
+        print(f"--------{self.business} - {self.note} is {self.category} "
+              f"({similarity:.0%} like a known merchant)")
+        return True
 
-        sql_statement = "SELECT DISTINCT category, change_type FROM records WHERE account_id = ?;"
-        categories = sql_get(sql_statement, [self.account.account_id])
+    @timed_phase("waiting on input")
+    def prompt_category(self, category_index:CategoryIndex, matching_rows:int=1,
+                        suggestions:list[tuple[tuple[str, str], float]]|None=None)->None:
+        """Ask the user to pick or create the category of the transaction"""
+        suggested = [choice for choice, _ in suggestions or []]
+        # the closest known categories are listed first
+        categories = suggested + [choice for choice in category_index.categories
+                                  if choice not in suggested]
         while True:
             try:
                 index = 0
                 for category, change_type in categories:
                     index += 1
-                    print(f"{index}: {category} - {RecordChangeType[change_type].value}")
+                    print(f"{index}: {category} - {RecordChangeType[change_type].value}"
+                          + (" (suggested)" if index <= len(suggested) else ""))
                 print("0: Create new category")
                 print(f"{self.transaction_date.date()}" +
                       f" ${self.amount}: {self.business} - {self.note}")
+                if matching_rows > 1:
+                    print(f"Applies to all {matching_rows} rows from {self.business}")
                 user_choice = int(input("Select category - "))
                 if user_choice == 0:
                     break
@@ -267,6 +680,155 @@ class Record:
         self.changed_asset = changed_asset
         self.quantity = changed_asset.quantity if changed_asset else None
 
+@timed_phase("categorize")
+def categorize_by_business(records:list[Record])->None:
+    """Categorize from history first, then from similar merchants, then ask once per business"""
+    unknown = {}
+    for record in records:
+        if not record.auto_categorize():
+            unknown.setdefault((record.account.account_id, record.business), []).append(record)
+    # every unknown merchant of an account is scored against its history in one pass
+    suggestions = {}
+    for account_id in {account_id for account_id, _ in unknown}:
+        keys = [key for key in unknown if key[0] == account_id]
+        category_index = unknown[keys[0]][0].account.get_category_index()
+        merchants = [(unknown[key][0].business, unknown[key][0].note) for key in keys]
+        suggestions.update(zip(keys, category_index.suggest(merchants)))
+    for key, group in unknown.items():
+        # an earlier answer may have taught the index this merchant already
+        group = [record for record in group if not record.auto_categorize()]
+        if not group:
+            continue
+        category_index = group[0].account.get_category_index()
+        if not group[0].accept_suggestion(suggestions[key]):
+            group[0].prompt_category(category_index, len(group), suggestions[key])
+        for record in group:
+            record.category = group[0].category
+            record.change_type = group[0].change_type
+            category_index.learn(record.business, record.note, record.category,
+                                 record.change_type.name)
+
+class BatchResult:
+    """Outcome of inserting a batch of records"""
+    def __init__(self):
+        self.inserted = 0
+        self.skipped = 0
+        self.failed = []
+
+    def merge(self, other:"BatchResult")->None:
+        """Add the counts of another batch to this one"""
+        self.inserted += other.inserted
+        self.skipped += other.skipped
+        self.failed.extend(other.failed)
+
+    def __str__(self)->str:
+        return (f"{self.inserted} records inserted, {self.skipped} duplicates skipped, "
+                f"{len(self.failed)} failed")
+
+def add_to_rollups(records:list[Record])->None:
+    """Add inserted records to monthly_rollups, one upsert per month and category"""
+    rollups = {}
+    for record in records:
+        key = (record.account.account_id, record.transaction_date.strftime("%Y-%m"),
+               record.category, record.change_type.name)
+        total, record_count = rollups.get(key, (0.0, 0))
+        rollups[key] = (total + record.amount, record_count + 1)
+    sql_update_many(UPSERT_ROLLUP_STATEMENT, [[*key, total, record_count]
+                                              for key, (total, record_count) in rollups.items()])
+
+def _insert_each(records:list[Record], result:BatchResult)->None:
+    """Insert records one at a time, each in its own savepoint so a bad row is rolled back"""
+    for record in records:
+        checkpoint = record.account.checkpoint()
+        try:
+            if record.insert_record():
+                result.inserted += 1
+            else:
+                result.skipped += 1
+        except DatabaseError:
+            record.account.rollback_to(checkpoint)
+            if record.account.fingerprints is not None:
+                record.account.fingerprints.discard(record.get_fingerprint())
+            result.failed.append(record)
+
+@timed_phase("batch insert")
+def _flush_pending(pending:list[Record], result:BatchResult)->None:
+    """Insert plain records with one executemany, falling back to row by row on error"""
+    if not pending:
+        return
+    try:
+        with db_session():
+            last_id = sql_insert_many(INSERT_RECORD_STATEMENT,
+                                      [record.get_insert_params() for record in pending])
+            add_to_rollups(pending)
+    except DatabaseError:
+        print("--------Batch insert failed, retrying records one at a time")
+        _insert_each(pending, result)
+    else:
+        first_id = last_id - len(pending) + 1
+        for offset, record in enumerate(pending):
+            record.record_id = first_id + offset
+            record.account.update_cash_funds(record.amount, record.change_type,
+                                             record.transaction_date)
+        result.inserted += len(pending)
+    pending.clear()
+
+@timed_phase("insert records")
+def insert_records(records:list[Record])->BatchResult:
+    """Insert records in order within one transaction, skipping ones already in the DB"""
+    result = BatchResult()
+    pending = []
+    accounts = list({record.account.account_id: record.account for record in records}.values())
+    checkpoints = [account.checkpoint() for account in accounts]
+    try:
+        with db_session(), ExitStack() as deferred:
+            for account in accounts:
+                deferred.enter_context(account.defer_updates())
+            for record in records:
+                if record.category is None or record.change_type is None:
+                    result.failed.append(record)
+                    continue
+                fingerprints = record.account.get_fingerprints()
+                fingerprint = record.get_fingerprint()
+                if fingerprint in fingerprints:
+                    result.skipped += 1
+                    continue
+                if record.changed_asset.account or record.changed_liability.account:
+                    # asset rows need the asset_id from their update, keep them in order
+                    _flush_pending(pending, result)
+                    _insert_each([record], result)
+                    continue
+                fingerprints.add(fingerprint)
+                pending.append(record)
+            _flush_pending(pending, result)
+    except BaseException:
+        for account, checkpoint in zip(accounts, checkpoints):
+            account.rollback_to(checkpoint)
+            # rows of the batch were added to the cache before it rolled back, load it again
+            account.fingerprints = None
+        raise
+    return result
+
+def get_balance_drift()->list[tuple[str, float, float]]:
+    """Stored account totals minus the totals recomputed from records and assets
+
+    Cash drift also holds any opening balance that was entered without a record.
+    """
+    sql_statement = "SELECT accounts.account, \
+            ROUND(accounts.cash_funds - COALESCE(cash.total, 0), 2), \
+            ROUND(accounts.investment_worth - COALESCE(holdings.total, 0), 2) \
+        FROM accounts \
+        LEFT JOIN (SELECT account_id, SUM(CASE \
+                WHEN change_type IN ('DEBIT_ACCOUNT', 'SELL_ASSET') THEN amount \
+                ELSE -amount END) AS total \
+            FROM records GROUP BY account_id) AS cash \
+            ON cash.account_id = accounts.account_id \
+        LEFT JOIN (SELECT account_id, SUM(quantity * market_value) AS total \
+            FROM assets GROUP BY account_id) AS holdings \
+            ON holdings.account_id = accounts.account_id \
+        ORDER BY accounts.account_id;"
+    return sql_get(sql_statement, [])
+
 def get_account()->Account:
     """Get account id from account name"""
     sql_statement = "SELECT * FROM accounts;"
@@ -281,3 +843,14 @@ def get_account()->Account:
         if 0 < int(choice) and int(choice) <= index:
             break
     return Account(account_id=accounts[int(choice)-1][0])
+
+def find_account(account:str|int)->Account:
+    """Get account from its id or its name"""
+    if isinstance(account, int) or str(account).isdigit():
+        return Account(account_id=int(account))
+    sql_statement = "SELECT account_id FROM accounts WHERE account = ?;"
+    results = sql_get(sql_statement, [account])
+    if results == []:
+        print("No account named", account)
+        sys.exit()
+    return Account(account_id=results[0][0])
@@ -1,60 +1,212 @@
 """Helper file for DB interactions"""
 import os
-import sys
+import time
+import atexit
+import random
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Callable, Iterator, TypeVar
+from instrumentation import timed_phase, timed_statement
 sqlite3.register_adapter(datetime, lambda dt: dt.strftime("%Y-%m-%d"))
 
+STATEMENT_CACHE_SIZE = 256
+# how long a statement waits on another connection's write lock, DB_BUSY_TIMEOUT_MS overrides it
+BUSY_TIMEOUT_MS = 5000
+# a lock still held after the timeout is tried again this many times with growing pauses
+BUSY_RETRIES = 4
+BUSY_BACKOFF_SECONDS = 0.1
+CONNECTION_PRAGMAS = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+)
+
+_local = threading.local()
+T = TypeVar("T")
+
+class DatabaseError(Exception):
+    """Error is raised when a statement fails, after its transaction was rolled back"""
+    def __init__(self, message="Statement failed"):
+        super().__init__(message)
+
+def busy_timeout_ms()->int:
+    """Milliseconds to wait on a locked DB, from DB_BUSY_TIMEOUT_MS when it is set"""
+    try:
+        return int(os.getenv("DB_BUSY_TIMEOUT_MS", str(BUSY_TIMEOUT_MS)))
+    except ValueError as error:
+        raise DatabaseError("DB_BUSY_TIMEOUT_MS is not a number of milliseconds") from error
+
+def is_busy(error:sqlite3.Error)->bool:
+    """Error is another connection holding a lock, not a bad statement"""
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error))
+
+def with_retry(run:Callable[[], T])->T:
+    """Run again with backoff while the DB stays locked past the busy timeout"""
+    for attempt in range(BUSY_RETRIES + 1):
+        try:
+            return run()
+        except sqlite3.OperationalError as error:
+            if attempt == BUSY_RETRIES or not is_busy(error):
+                raise
+            # jitter keeps writers that gave up together from trying again together
+            time.sleep(BUSY_BACKOFF_SECONDS * 2 ** attempt * (1 + random.random()))
+    raise AssertionError("unreachable")
+
+def get_connection()->sqlite3.Connection:
+    """Gets the connection for this thread, opening it on first use"""
+    db_connection = getattr(_local, "db_connection", None)
+    if db_connection is not None:
+        return db_connection
+    return _open_connection()
+
+@timed_phase("open connection")
+def _open_connection()->sqlite3.Connection:
+    """Opens and tunes the connection for this thread"""
+    try:
+        # autocommit at the driver level, transactions are opened by db_session
+        db_connection = sqlite3.connect(os.getenv("DB_NAME"), isolation_level=None,
+                                        timeout=busy_timeout_ms() / 1000,
+                                        cached_statements=STATEMENT_CACHE_SIZE)
+    except sqlite3.Error as error:
+        print("Could not connect to DB")
+        raise DatabaseError(str(error)) from error
+    try:
+        for pragma in CONNECTION_PRAGMAS:
+            with_retry(lambda pragma=pragma: db_connection.execute(pragma))
+    except sqlite3.Error as error:
+        # a DB still locked past every retry is left for the next get_connection to try
+        db_connection.close()
+        print("Could not connect to DB")
+        raise DatabaseError(str(error)) from error
+    _local.db_connection = db_connection
+    _local.session_depth = 0
+    return db_connection
+
+def close_connection()->None:
+    """Closes the connection for this thread if one is open"""
+    db_connection = getattr(_local, "db_connection", None)
+    if db_connection is None:
+        return
+    db_connection.close()
+    _local.db_connection = None
+    _local.session_depth = 0
+
+atexit.register(close_connection)
+
+@contextmanager
+def db_session()->Iterator[sqlite3.Connection]:
+    """Runs the enclosed statements as one transaction, nested sessions become savepoints"""
+    db_connection = get_connection()
+    depth = _local.session_depth
+    savepoint = f"session_{depth}"
+    if depth == 0:
+        # the write lock is taken up front, a reader turning writer mid transaction could
+        # find its snapshot stale and fail without waiting
+        try:
+            with_retry(lambda: db_connection.execute("BEGIN IMMEDIATE"))
+        except sqlite3.Error as error:
+            _handle_error("Could not start a transaction", error, "BEGIN IMMEDIATE", [])
+    else:
+        db_connection.execute(f"SAVEPOINT {savepoint}")
+    _local.session_depth = depth + 1
+    try:
+        yield db_connection
+    except BaseException as error:
+        if depth == 0:
+            # some errors end the transaction themselves, there is nothing left to roll back
+            if db_connection.in_transaction:
+                db_connection.execute("ROLLBACK")
+            if isinstance(error, DatabaseError):
+                print("All changes in this transaction were rolled back")
+        else:
+            db_connection.execute(f"ROLLBACK TO {savepoint}")
+            db_connection.execute(f"RELEASE {savepoint}")
+        raise
+    else:
+        if depth > 0:
+            db_connection.execute(f"RELEASE {savepoint}")
+            return
+        try:
+            db_connection.execute("COMMIT")
+        except sqlite3.Error as error:
+            if db_connection.in_transaction:
+                db_connection.execute("ROLLBACK")
+            print("All changes in this transaction were rolled back")
+            _handle_error("Transaction was not committed", error, "COMMIT", [])
+    finally:
+        _local.session_depth = depth
+
+def _handle_error(message:str, error:sqlite3.Error, sql_statement:str,
+                  sql_parameters:list)->None:
+    """Report a failed statement and raise so the caller's session rolls back"""
+    print(message)
+    print(error)
+    print(sql_statement)
+    print(sql_parameters)
+    raise DatabaseError(str(error)) from error
+
+def _execute(run:Callable[[], T])->T:
+    """Run a statement, one outside a session is its own transaction and safe to try again"""
+    if getattr(_local, "session_depth", 0) > 0:
+        return run()
+    return with_retry(run)
+
+@timed_statement()
 def sql_get(sql_statement:str, sql_parameters:list)->list:
     """Gets data from sql db"""
     rows = []
     try:
-        db_connection = sqlite3.connect(os.getenv("DB_NAME"))
-        cursor = db_connection.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON')
-        cursor.execute(sql_statement, sql_parameters)
-        rows = cursor.fetchall()
-        db_connection.commit()
-        db_connection.close()
+        db_connection = get_connection()
+        rows = _execute(lambda: db_connection.execute(sql_statement, sql_parameters).fetchall())
     except sqlite3.Error as error:
-        print("Data was not retrieved from DB")
-        print(error)
-        print(sql_statement)
-        print(sql_parameters)
-        sys.exit()
+        _handle_error("Data was not retrieved from DB", error, sql_statement, sql_parameters)
     return rows
 
+@timed_statement()
 def sql_insert(sql_statement:str, sql_parameters:list)->int:
     """Inserts single row into sql db and returns id"""
     insert_id = 0
     try:
-        db_connection = sqlite3.connect(os.getenv("DB_NAME"))
-        cursor = db_connection.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON')
-        cursor.execute(sql_statement, sql_parameters)
-        insert_id = cursor.lastrowid
-        db_connection.commit()
-        db_connection.close()
+        db_connection = get_connection()
+        insert_id = _execute(lambda: db_connection.execute(sql_statement,
+                                                           sql_parameters).lastrowid)
     except sqlite3.Error as error:
-        print("Data was not inserted into DB")
-        print(error)
-        print(sql_statement)
-        print(sql_parameters)
-        sys.exit()
+        _handle_error("Data was not inserted into DB", error, sql_statement, sql_parameters)
     return insert_id
 
+@timed_statement()
 def sql_update(sql_statement:str, sql_parameters:list)->None:
     """Updates sql db"""
     try:
-        db_connection = sqlite3.connect(os.getenv("DB_NAME"))
-        cursor = db_connection.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON')
-        cursor.execute(sql_statement, sql_parameters)
-        db_connection.commit()
-        db_connection.close()
+        db_connection = get_connection()
+        _execute(lambda: db_connection.execute(sql_statement, sql_parameters))
+    except sqlite3.Error as error:
+        _handle_error("Data was not inserted into DB", error, sql_statement, sql_parameters)
+
+@timed_statement(many=True)
+def sql_insert_many(sql_statement:str, sql_parameters:list[list])->int:
+    """Inserts many rows with one prepared statement and returns the last id"""
+    insert_id = 0
+    try:
+        # rows run outside a session commit one by one, so they are not tried again
+        db_connection = get_connection()
+        db_connection.executemany(sql_statement, sql_parameters)
+        insert_id = db_connection.execute("SELECT last_insert_rowid();").fetchone()[0]
+    except sqlite3.Error as error:
+        _handle_error("Data was not inserted into DB", error, sql_statement,
+                      [f"{len(sql_parameters)} rows"])
+    return insert_id
+
+@timed_statement(many=True)
+def sql_update_many(sql_statement:str, sql_parameters:list[list])->None:
+    """Runs one update statement for every parameter set"""
+    try:
+        get_connection().executemany(sql_statement, sql_parameters)
     except sqlite3.Error as error:
-        print("Data was not inserted into DB")
-        print(error)
-        print(sql_statement)
-        print(sql_parameters)
-        sys.exit()
+        _handle_error("Data was not inserted into DB", error, sql_statement,
+                      [f"{len(sql_parameters)} rows"])
@@ -0,0 +1,200 @@
+"""Versioned schema upgrades tracked with PRAGMA user_version"""
+import os
+import sys
+import argparse
+from typing import Callable
+from dotenv import load_dotenv
+from db_helper import sql_get, sql_update, sql_update_many, db_session
+from reports import (rebuild_rollups, rebuild_snapshots, SELECT_MONTH_STATEMENT,
+                     SELECT_CATEGORY_STATEMENT, SELECT_SNAPSHOTS_STATEMENT,
+                     SELECT_BALANCE_BEFORE_STATEMENT)
+from db_classes import (record_fingerprint, SELECT_RECORD_ID_STATEMENT,
+                        SELECT_FINGERPRINTS_STATEMENT, SELECT_CATEGORY_HISTORY_STATEMENT,
+                        SELECT_POSITIONS_STATEMENT, INSERT_SNAPSHOT_STATEMENT,
+                        SELECT_PRICE_STATEMENT)
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "finance_db_schema.sql")
+HOT_QUERIES = (
+    ("dedup lookup", SELECT_RECORD_ID_STATEMENT, ["0" * 40]),
+    ("fingerprint load", SELECT_FINGERPRINTS_STATEMENT, [1]),
+    ("category history load", SELECT_CATEGORY_HISTORY_STATEMENT, [1]),
+    ("position ledger load", SELECT_POSITIONS_STATEMENT, [1]),
+    ("month summary", SELECT_MONTH_STATEMENT, ["2024-01", None, None]),
+    ("category by month", SELECT_CATEGORY_STATEMENT,
+     ["Groceries", "2024-01", "2024-12", None, None]),
+    ("snapshot start", INSERT_SNAPSHOT_STATEMENT, ["2024-01-01", 1, 1, "2024-01-01", 1]),
+    ("net worth range", SELECT_SNAPSHOTS_STATEMENT, ["2024-01", "2024-12-31", None, None]),
+    ("balance before", SELECT_BALANCE_BEFORE_STATEMENT, [1, "2024-01"]),
+    ("latest price", SELECT_PRICE_STATEMENT, ["VTI", "2024-01-01"]),
+)
+
+def create_tables()->None:
+    """Create any table of finance_db_schema.sql the DB is missing"""
+    with open(SCHEMA_FILE, encoding="utf-8") as file:
+        statements = [statement.strip() for statement in file.read().split(";")]
+    # indexes can name columns older tables do not have yet, later migrations add them
+    for statement in statements:
+        if statement.upper().startswith("CREATE TABLE"):
+            sql_update(statement + ";", [])
+
+def add_record_fingerprints()->None:
+    """Fingerprint column on records, backfilled, with a unique index for dedup"""
+    columns = [column[1] for column in sql_get("PRAGMA table_info(records);", [])]
+    if "fingerprint" not in columns:
+        sql_update("ALTER TABLE records ADD COLUMN fingerprint TEXT;", [])
+    sql_statement = "SELECT fingerprint FROM records WHERE fingerprint IS NOT NULL;"
+    existing = {row[0] for row in sql_get(sql_statement, [])}
+    sql_statement = "SELECT record_id, account_id, transaction_date, amount, business, \
+        note, change_type FROM records WHERE fingerprint IS NULL ORDER BY record_id;"
+    updates = []
+    for record_id, *fields in sql_get(sql_statement, []):
+        fingerprint = record_fingerprint(*fields)
+        if fingerprint in existing:
+            continue # older rows that only differed by category stay unfingerprinted
+        existing.add(fingerprint)
+        updates.append([fingerprint, record_id])
+    if updates:
+        sql_update_many("UPDATE records SET fingerprint = ? WHERE record_id = ?;", updates)
+    sql_update("CREATE UNIQUE INDEX IF NOT EXISTS records_fingerprint \
+        ON records (fingerprint);", [])
+
+def add_asset_index()->None:
+    """Index for finding an account's asset by name"""
+    sql_update("CREATE INDEX IF NOT EXISTS assets_account_asset \
+        ON assets (account_id, asset);", [])
+
+def add_record_lookup_indexes()->None:
+    """Covering indexes for the per account category and fingerprint loads"""
+    sql_update("CREATE INDEX IF NOT EXISTS records_account_business \
+        ON records (account_id, business, note, category, change_type);", [])
+    sql_update("CREATE INDEX IF NOT EXISTS records_account_category \
+        ON records (account_id, category, change_type);", [])
+    sql_update("CREATE INDEX IF NOT EXISTS records_account_fingerprint \
+        ON records (account_id, fingerprint);", [])
+
+def add_ingest_state()->None:
+    """Per account import watermark and hashes of export files already imported"""
+    sql_update("CREATE TABLE IF NOT EXISTS ingest_state ( \
+        account_id          INTEGER     PRIMARY KEY, \
+        last_imported_date  DATETIME    NOT NULL, \
+        FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE);", [])
+    sql_update("CREATE TABLE IF NOT EXISTS ingested_files ( \
+        account_id          INTEGER     NOT NULL, \
+        file_hash           TEXT        NOT NULL, \
+        file_name           TEXT        NOT NULL, \
+        newest_date         DATETIME, \
+        PRIMARY KEY (account_id, file_hash), \
+        FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE);", [])
+
+def add_monthly_rollups()->None:
+    """Totals per account, month, category and change type"""
+    sql_update("CREATE TABLE IF NOT EXISTS monthly_rollups ( \
+        account_id          INTEGER     NOT NULL, \
+        month               TEXT        NOT NULL, \
+        category            TEXT        NOT NULL, \
+        change_type         TEXT        NOT NULL, \
+        total               FLOAT       NOT NULL, \
+        record_count        INTEGER     NOT NULL, \
+        PRIMARY KEY (account_id, month, category, change_type), \
+        FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE \
+        ) WITHOUT ROWID;", [])
+    sql_update("CREATE INDEX IF NOT EXISTS monthly_rollups_month \
+        ON monthly_rollups (month, account_id);", [])
+    sql_update("CREATE INDEX IF NOT EXISTS monthly_rollups_category \
+        ON monthly_rollups (category, month);", [])
+
+def add_balance_snapshots()->None:
+    """Per account balances on every day they changed"""
+    sql_update("CREATE TABLE IF NOT EXISTS balance_snapshots ( \
+        account_id          INTEGER     NOT NULL, \
+        as_of               DATE        NOT NULL, \
+        cash_funds          FLOAT       NOT NULL, \
+        investment_worth    FLOAT       NOT NULL, \
+        debt_total          FLOAT       NOT NULL, \
+        PRIMARY KEY (account_id, as_of), \
+        FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE \
+        ) WITHOUT ROWID;", [])
+    sql_update("CREATE INDEX IF NOT EXISTS balance_snapshots_as_of \
+        ON balance_snapshots (as_of);", [])
+
+def add_prices()->None:
+    """Price of each asset by day, loaded from quote files"""
+    sql_update("CREATE TABLE IF NOT EXISTS prices ( \
+        asset               TEXT        NOT NULL, \
+        as_of               DATE        NOT NULL, \
+        price               FLOAT       NOT NULL, \
+        PRIMARY KEY (asset, as_of) \
+        ) WITHOUT ROWID;", [])
+
+# a migration's number is its position in this list, only ever append to it
+MIGRATIONS:list[tuple[str, Callable[[], None]]] = [
+    ("tables from finance_db_schema.sql", create_tables),
+    ("record fingerprints", add_record_fingerprints),
+    ("asset lookup index", add_asset_index),
+    ("record lookup indexes", add_record_lookup_indexes),
+    ("ingest watermarks and file hashes", add_ingest_state),
+    ("monthly rollups", add_monthly_rollups),
+    ("daily balance snapshots", add_balance_snapshots),
+    ("asset price history", add_prices),
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+# tables filled from records by today's report code, so only once every migration is in
+BACKFILLS:list[tuple[Callable[[], None], Callable[[], None]]] = [
+    (add_monthly_rollups, rebuild_rollups),
+    (add_balance_snapshots, rebuild_snapshots),
+]
+
+def get_schema_version()->int:
+    """Migration the DB was last brought up to"""
+    return sql_get("PRAGMA user_version;", [])[0][0]
+
+def migrate()->int:
+    """Run every migration the DB has not had yet and their backfills in one transaction"""
+    version = get_schema_version()
+    if version > SCHEMA_VERSION:
+        print(f"DB is at schema version {version}, this code only knows {SCHEMA_VERSION}")
+        sys.exit()
+    if version == SCHEMA_VERSION:
+        return SCHEMA_VERSION
+    with db_session():
+        # another process starting at the same time may have run some while this one waited
+        version = get_schema_version()
+        applied = list(enumerate(MIGRATIONS[version:], version + 1))
+        for number, (_, migration) in applied:
+            migration()
+            sql_update(f"PRAGMA user_version = {number};", [])
+        ran = {migration for _, (_, migration) in applied}
+        for migration, backfill in BACKFILLS:
+            if migration in ran:
+                backfill()
+    for number, (description, _) in applied:
+        print(f"--------Migrated DB to version {number}: {description}")
+    return SCHEMA_VERSION
+
+def check_query_plans()->list[str]:
+    """Hot queries the planner would answer with a full scan, empty when all use indexes"""
+    problems = []
+    for name, sql_statement, sql_parameters in HOT_QUERIES:
+        for row in sql_get("EXPLAIN QUERY PLAN " + sql_statement, sql_parameters):
+            if row[-1].startswith("SCAN"):
+                problems.append(f"{name}: {row[-1]}")
+    return problems
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Upgrade the DB schema in place")
+    parser.add_argument("-c", "--check", action="store_true",
+                        help='Fail if a hot query would scan a whole table')
+    args = parser.parse_args()
+    load_dotenv()
+    print(f"DB at schema version {migrate()}")
+    if args.check:
+        problems = check_query_plans()
+        for problem in problems:
+            print("Full scan in", problem)
+        if problems:
+            sys.exit(1)
+        print("Every hot query uses an index")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Columnar Parquet copy of the ledger, partitioned by account and year, and its loader"""
+import os
+import sys
+import json
+import time
+import argparse
+from dotenv import load_dotenv
+from db_helper import sql_get
+from db_migrations import migrate
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_FOLDER = "ledger_parquet"
+RECORDS_FOLDER = "records"
+STATE_FILE = "export_state.json"
+COMPRESSION = "zstd"
+# whole-table copies, small enough to rewrite on every export
+SMALL_TABLES = {
+    "accounts": ("account_id", "book_id", "account", "purpose", "cash_funds", "investment_worth",
+                 "debt_total"),
+    "assets": ("asset_id", "account_id", "asset", "quantity", "market_value", "note"),
+}
+SELECT_TOUCHED_STATEMENT = "SELECT DISTINCT account_id, substr(transaction_date, 1, 4) \
+    FROM records WHERE record_id > ?;"
+SELECT_PARTITIONS_STATEMENT = "SELECT record_id, account_id, asset_id, liability_id, amount, \
+        business, category, quantity, change_type, note, substr(transaction_date, 1, 10), \
+        fingerprint \
+    FROM records \
+    WHERE account_id = ? AND transaction_date >= ? AND transaction_date < ? \
+    ORDER BY transaction_date, record_id;"
+
+def record_schema()->"pa.Schema":
+    """Arrow types of an exported record, dates are kept as days"""
+    return pa.schema([
+        ("record_id", pa.int64()),
+        ("account_id", pa.int64()),
+        ("asset_id", pa.int64()),
+        ("liability_id", pa.int64()),
+        ("amount", pa.float64()),
+        ("business", pa.string()),
+        ("category", pa.string()),
+        ("quantity", pa.float64()),
+        ("change_type", pa.string()),
+        ("note", pa.string()),
+        ("transaction_date", pa.date32()),
+        ("fingerprint", pa.string()),
+    ])
+
+def partition_path(folder:str, account_id:int, year:str)->str:
+    """Parquet file holding one account's records of one year"""
+    return os.path.join(folder, RECORDS_FOLDER, str(account_id), f"{year}.parquet")
+
+def read_state(folder:str)->dict:
+    """Record id high-water mark and row counts of the last export"""
+    state_file = os.path.join(folder, STATE_FILE)
+    if not os.path.exists(state_file):
+        return {"record_id": 0, "records": 0, "partitions": {}}
+    with open(state_file, encoding="utf-8") as file:
+        return json.load(file)
+
+def write_table(table:"pa.Table", destination:str)->None:
+    """Write a Parquet file beside its final name and swap it in so readers never see half"""
+    folder = os.path.dirname(destination)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    partial = destination + ".partial"
+    pq.write_table(table, partial, compression=COMPRESSION)
+    os.replace(partial, destination)
+
+def columns_to_table(rows:list[tuple], schema:"pa.Schema")->"pa.Table":
+    """Turn DB rows into an Arrow table one column at a time"""
+    columns = list(zip(*rows)) if rows else [[] for _ in schema]
+    arrays = []
+    for values, field in zip(columns, schema):
+        if pa.types.is_date32(field.type):
+            arrays.append(pa.array(values, pa.string()).cast(field.type))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def export_partitions(folder:str, account_id:int, years:list[str])->dict[str, int]:
+    """Rewrite an account's partitions for the given years, returns rows per partition"""
+    schema = record_schema()
+    counts = {}
+    # one read per account covers every touched year, rows arrive grouped by year
+    rows = sql_get(SELECT_PARTITIONS_STATEMENT,
+                   [account_id, f"{min(years)}-01-01", f"{int(max(years)) + 1:04d}-01-01"])
+    by_year = {year: [] for year in years}
+    for row in rows:
+        if row[10][:4] in by_year:
+            by_year[row[10][:4]].append(row)
+    for year, year_rows in by_year.items():
+        destination = partition_path(folder, account_id, year)
+        if not year_rows:
+            if os.path.exists(destination):
+                os.remove(destination)
+            continue
+        write_table(columns_to_table(year_rows, schema), destination)
+        counts[f"{account_id}/{year}"] = len(year_rows)
+    return counts
+
+def export_ledger(folder:str=EXPORT_FOLDER, full:bool=False)->tuple[int, int]:
+    """Bring the Parquet copy up to date, returns partitions and rows written"""
+    state = read_state(folder)
+    high_water, total = sql_get("SELECT COALESCE(MAX(record_id), 0), COUNT(*) FROM records;",
+                                [])[0]
+    new_rows = sql_get("SELECT COUNT(*) FROM records WHERE record_id > ?;",
+                       [state["record_id"]])[0][0]
+    # rows only ever get added, anything else means the DB was rebuilt or edited by hand
+    if high_water < state["record_id"] or state["records"] + new_rows != total:
+        full = True
+    if full:
+        state = {"record_id": 0, "records": 0, "partitions": {}}
+    touched = {}
+    for account_id, year in sql_get(SELECT_TOUCHED_STATEMENT, [state["record_id"]]):
+        touched.setdefault(account_id, set()).add(year)
+    partitions = dict(state["partitions"])
+    written_rows = 0
+    for account_id, years in sorted(touched.items()):
+        for year in years:
+            partitions.pop(f"{account_id}/{year}", None)
+        counts = export_partitions(folder, account_id, sorted(years))
+        partitions.update(counts)
+        written_rows += sum(counts.values())
+    if full:
+        remove_stale(folder, partitions)
+    for table_name, columns in SMALL_TABLES.items():
+        rows = sql_get(f"SELECT {', '.join(columns)} FROM {table_name} ORDER BY {columns[0]};",
+                       [])
+        table = pa.table({column: [row[index] for row in rows]
+                          for index, column in enumerate(columns)})
+        write_table(table, os.path.join(folder, f"{table_name}.parquet"))
+    state = {"record_id": high_water, "records": total, "partitions": partitions}
+    with open(os.path.join(folder, STATE_FILE), "w", encoding="utf-8") as file:
+        json.dump(state, file, indent=1, sort_keys=True)
+    return sum(len(years) for years in touched.values()), written_rows
+
+def remove_stale(folder:str, partitions:dict[str, int])->None:
+    """Delete partition files a full export did not write"""
+    records_folder = os.path.join(folder, RECORDS_FOLDER)
+    if not os.path.isdir(records_folder):
+        return
+    for account_id in os.listdir(records_folder):
+        account_folder = os.path.join(records_folder, account_id)
+        for file_name in os.listdir(account_folder):
+            year = file_name.split(".")[0]
+            if f"{account_id}/{year}" not in partitions:
+                os.remove(os.path.join(account_folder, file_name))
+        if not os.listdir(account_folder):
+            os.rmdir(account_folder)
+
+def load_ledger(folder:str=EXPORT_FOLDER, account_ids:list[int]|None=None,
+                years:list[int]|None=None, columns:list[str]|None=None)->"pa.Table":
+    """Records of the exported ledger as one Arrow table, files are memory mapped not copied"""
+    if pa is None:
+        print("pyarrow is needed to read the Parquet ledger")
+        sys.exit()
+    tables = []
+    for partition in sorted(read_state(folder)["partitions"]):
+        account_id, year = partition.split("/")
+        if account_ids is not None and int(account_id) not in account_ids:
+            continue
+        if years is not None and int(year) not in years:
+            continue
+        tables.append(pq.read_table(partition_path(folder, int(account_id), year),
+                                    columns=columns, memory_map=True))
+    if not tables:
+        schema = record_schema()
+        return schema.empty_table() if columns is None else pa.schema(
+            [schema.field(column) for column in columns]).empty_table()
+    return pa.concat_tables(tables)
+
+def load_table(table_name:str, folder:str=EXPORT_FOLDER)->"pa.Table":
+    """Exported accounts or assets table"""
+    return pq.read_table(os.path.join(folder, f"{table_name}.parquet"), memory_map=True)
+
+def load_frame(folder:str=EXPORT_FOLDER, account_ids:list[int]|None=None,
+               years:list[int]|None=None, columns:list[str]|None=None)->"pandas.DataFrame":
+    """Exported records as a pandas DataFrame"""
+    return load_ledger(folder, account_ids, years, columns).to_pandas(date_as_object=False)
+
+def load_arrays(folder:str=EXPORT_FOLDER, account_ids:list[int]|None=None,
+                years:list[int]|None=None,
+                columns:list[str]|None=None)->dict[str, "numpy.ndarray"]:
+    """Exported records as NumPy arrays by column name"""
+    table = load_ledger(folder, account_ids, years, columns)
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Export the ledger to partitioned Parquet")
+    parser.add_argument("-o", "--output", default=EXPORT_FOLDER, help='Folder of the export')
+    parser.add_argument("--full", action="store_true",
+                        help='Rewrite every partition, not just ones with new records')
+    args = parser.parse_args()
+    if pa is None:
+        print("pyarrow is needed to export the ledger")
+        sys.exit()
+    load_dotenv()
+    started = time.perf_counter()
+    migrate()
+    partitions, rows = export_ledger(args.output, args.full)
+    print(f"--------Wrote {partitions} partitions ({rows} records) to {args.output} "
+          f"in {time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
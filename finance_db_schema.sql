@@ -26,11 +26,17 @@ CREATE TABLE IF NOT EXISTS records (
     change_type         TEXT        NOT NULL,
     note                TEXT,
     transaction_date    DATETIME    NOT NULL,
+    fingerprint         TEXT,
     FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE
     FOREIGN KEY (asset_id) REFERENCES assets (asset_id)
     FOREIGN KEY (liability_id) REFERENCES liabilities (liability_id)
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS records_fingerprint ON records (fingerprint);
+CREATE INDEX IF NOT EXISTS records_account_business ON records (account_id, business, note, category, change_type);
+CREATE INDEX IF NOT EXISTS records_account_category ON records (account_id, category, change_type);
+CREATE INDEX IF NOT EXISTS records_account_fingerprint ON records (account_id, fingerprint);
+
 CREATE TABLE IF NOT EXISTS assets (
     asset_id            INTEGER     PRIMARY KEY,
     account_id          INTEGER     NOT NULL,
@@ -41,6 +47,8 @@ CREATE TABLE IF NOT EXISTS assets (
     FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE
 );
 
+CREATE INDEX IF NOT EXISTS assets_account_asset ON assets (account_id, asset);
+
 CREATE TABLE IF NOT EXISTS liabilities (
     liability_id        INTEGER     PRIMARY KEY,
     account_id          INTEGER     NOT NULL,
@@ -50,3 +58,53 @@ CREATE TABLE IF NOT EXISTS liabilities (
     note                TEXT,
     FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE
 );
+
+CREATE TABLE IF NOT EXISTS ingest_state (
+    account_id          INTEGER     PRIMARY KEY,
+    last_imported_date  DATETIME    NOT NULL,
+    FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS ingested_files (
+    account_id          INTEGER     NOT NULL,
+    file_hash           TEXT        NOT NULL,
+    file_name           TEXT        NOT NULL,
+    newest_date         DATETIME,
+    PRIMARY KEY (account_id, file_hash),
+    FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS monthly_rollups (
+    account_id          INTEGER     NOT NULL,
+    month               TEXT        NOT NULL,
+    category            TEXT        NOT NULL,
+    change_type         TEXT        NOT NULL,
+    total               FLOAT       NOT NULL,
+    record_count        INTEGER     NOT NULL,
+    PRIMARY KEY (account_id, month, category, change_type),
+    FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS monthly_rollups_month ON monthly_rollups (month, account_id);
+CREATE INDEX IF NOT EXISTS monthly_rollups_category ON monthly_rollups (category, month);
+
+CREATE TABLE IF NOT EXISTS balance_snapshots (
+    account_id          INTEGER     NOT NULL,
+    as_of               DATE        NOT NULL,
+    cash_funds          FLOAT       NOT NULL,
+    investment_worth    FLOAT       NOT NULL,
+    debt_total          FLOAT       NOT NULL,
+    PRIMARY KEY (account_id, as_of),
+    FOREIGN KEY (account_id) REFERENCES accounts (account_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS balance_snapshots_as_of ON balance_snapshots (as_of);
+
+CREATE TABLE IF NOT EXISTS prices (
+    asset               TEXT        NOT NULL,
+    as_of               DATE        NOT NULL,
+    price               FLOAT       NOT NULL,
+    PRIMARY KEY (asset, as_of)
+) WITHOUT ROWID;
+
+PRAGMA user_version = 8;
@@ -0,0 +1,192 @@
+"""Resident ingester that imports exports as they land in an inbox folder"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from fnmatch import fnmatch
+from dotenv import load_dotenv
+from data_parser import sniff_parser, CHUNK_SIZE
+from db_classes import Account, find_account
+from db_migrations import migrate
+from archive_store import archive_file, import_legacy
+from auto_insert import import_window, write_records, record_ingest, INGEST_OVERLAP_DAYS
+
+INBOX_FOLDER = "inbox"
+REJECTED_FOLDER = "rejected"
+MANIFEST_FILE = "manifest.json"
+POLL_SECONDS = 0.05
+# names browsers and editors give files that are still being written
+PARTIAL_SUFFIXES = (".crdownload", ".part", ".partial", ".tmp", ".download")
+
+class InboxRoute:
+    """Account and institute for exports whose name matches a pattern of the manifest"""
+    def __init__(self, pattern:str, account:str, institute:str|None=None):
+        self.pattern = pattern
+        self.account = account
+        self.institute = institute
+
+def load_routes(manifest_file:str)->list[InboxRoute]:
+    """Routes from a manifest, a file entry may be a pattern such as checking-*.csv"""
+    with open(manifest_file, encoding="utf-8") as file:
+        manifest = json.load(file)
+    return [InboxRoute(entry["file"], entry["account"], entry.get("institute"))
+            for entry in manifest["files"]]
+
+class IngestDaemon:
+    """Keeps the DB connection, parsers and account caches warm between exports"""
+    def __init__(self, inbox:str, routes:list[InboxRoute], group_prompts:bool=True,
+                 overlap_days:int=INGEST_OVERLAP_DAYS):
+        self.inbox = inbox
+        self.routes = routes
+        self.group_prompts = group_prompts
+        self.overlap_days = overlap_days
+        self.accounts = {}
+        self.sizes = {}
+        self.ignored = set()
+
+    def get_account(self, name:str)->Account:
+        """Account of a route, looked up once and then kept with its caches"""
+        if name not in self.accounts:
+            self.accounts[name] = find_account(name)
+        return self.accounts[name]
+
+    def warm_up(self)->None:
+        """Load every routed account's caches before the first export arrives"""
+        for route in self.routes:
+            if not route.account:
+                continue
+            account = self.get_account(route.account)
+            account.get_category_index()
+            account.get_fingerprints()
+            account.get_ingest_state()
+        if any(route.institute == "OPTUM" for route in self.routes):
+            # Optum sheets need pandas, the first one should not wait for the import
+            import pandas  # pylint: disable=import-outside-toplevel,unused-import
+
+    def route(self, file_name:str)->InboxRoute|None:
+        """First route whose pattern matches the file name"""
+        for route in self.routes:
+            if route.account and fnmatch(file_name.lower(), route.pattern.lower()):
+                return route
+        return None
+
+    def settled_files(self)->list[str]:
+        """Files that kept the same size and modified time since the last poll"""
+        settled = []
+        seen = {}
+        with os.scandir(self.inbox) as entries:
+            for entry in entries:
+                if (not entry.is_file() or entry.name.startswith((".", "~$"))
+                        or entry.name.lower().endswith(PARTIAL_SUFFIXES)
+                        or entry.name == MANIFEST_FILE):
+                    continue
+                stat = entry.stat()
+                seen[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                if stat.st_size and self.sizes.get(entry.path) == seen[entry.path]:
+                    settled.append(entry.path)
+        self.sizes = seen
+        return sorted(settled, key=lambda path: seen[path][1])
+
+    def reject(self, file:str, reason:str)->None:
+        """Move a file the daemon cannot import out of the way"""
+        rejected_folder = os.path.join(self.inbox, REJECTED_FOLDER)
+        if not os.path.exists(rejected_folder):
+            os.makedirs(rejected_folder)
+        shutil.move(file, os.path.join(rejected_folder, os.path.basename(file)))
+        print(f"--------Rejected {os.path.basename(file)}, {reason}")
+
+    def ingest(self, file:str)->None:
+        """Import one settled export and archive it"""
+        started = time.perf_counter()
+        file_name = os.path.basename(file)
+        route = self.route(file_name)
+        if route is None:
+            if file not in self.ignored:
+                print("No route in the manifest for", file_name)
+                self.ignored.add(file)
+            return
+        try:
+            plugin = sniff_parser(file)
+            if plugin is None:
+                self.reject(file, "no parser recognises it")
+                return
+            if route.institute and plugin.institute.name != route.institute:
+                self.reject(file, f"it looks like {plugin.institute.name} not {route.institute}")
+                return
+            account = self.get_account(route.account)
+            window = import_window(file, account, False, self.overlap_days)
+            if window is None:
+                archive_file(file, account.account)
+                return
+            file_hash, cutoff = window
+            chunks = plugin.stream(file, account, CHUNK_SIZE, cutoff)
+            result, newest_date = write_records(chunks, self.group_prompts)
+            entry = archive_file(file, account.account, file_hash)
+            record_ingest(account, entry, result, newest_date, cutoff)
+        except (Exception, SystemExit) as error:  # pylint: disable=broad-exception-caught
+            # one bad export should not stop the daemon, its transaction was rolled back and
+            # its caches may hold those rows so they are loaded again
+            print(f"Could not import {file_name}: {type(error).__name__} {error}")
+            self.accounts.pop(route.account, None)
+            if os.path.exists(file):
+                self.reject(file, "it could not be imported")
+            return
+        print(f"--------{file_name} -> {account.account} "
+              f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def poll(self)->int:
+        """Import whatever has settled in the inbox, returns how many files were handled"""
+        files = self.settled_files()
+        for file in files:
+            self.ingest(file)
+        return len(files)
+
+    def run(self, poll_seconds:float=POLL_SECONDS)->None:
+        """Poll the inbox until interrupted"""
+        print(f"--------Watching {os.path.abspath(self.inbox)}")
+        try:
+            while True:
+                self.poll()
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            print("--------Stopped watching", self.inbox)
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Import exports as they land in a folder")
+    parser.add_argument("-d", "--inbox", default=INBOX_FOLDER, help='Folder to watch')
+    parser.add_argument("-m", "--manifest",
+                        help='JSON file routing file names to accounts, the inbox one by default')
+    parser.add_argument("-i", "--interval", type=float, default=POLL_SECONDS,
+                        help='Seconds between looks at the inbox')
+    parser.add_argument("-g", "--group-prompts", action="store_true",
+                        help='Categorize known rows first, then ask once per unknown business')
+    parser.add_argument("-o", "--overlap-days", type=int, default=INGEST_OVERLAP_DAYS,
+                        help='Days before the last import to read again for late postings')
+    parser.add_argument("--once", action="store_true",
+                        help='Import what is in the inbox now and exit')
+    args = parser.parse_args()
+    load_dotenv()
+    manifest = args.manifest or os.path.join(args.inbox, MANIFEST_FILE)
+    if not os.path.exists(manifest):
+        print("No manifest found at", manifest)
+        sys.exit()
+    if not os.path.exists(args.inbox):
+        os.makedirs(args.inbox)
+
+    migrate()
+    import_legacy()
+    daemon = IngestDaemon(args.inbox, load_routes(manifest), args.group_prompts,
+                          args.overlap_days)
+    daemon.warm_up()
+    if args.once:
+        # files already sitting in the inbox have settled, two polls take them in
+        daemon.settled_files()
+        daemon.poll()
+    else:
+        daemon.run(args.interval)
+
+if __name__ == "__main__":
+    main()
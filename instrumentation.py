@@ -0,0 +1,153 @@
+"""Counts and times DB statements and ingest phases for --profile reports"""
+import json
+import time
+import heapq
+import sqlite3
+from functools import wraps
+from typing import Callable, Iterable, Iterator
+
+SLOWEST_KEPT = 10
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+class Profiler:
+    """Call counts and latency of statements and phases, does nothing until enabled"""
+    def __init__(self):
+        self.enabled = False
+        self.started = 0.0
+        self.statements = {}
+        self.phases = {}
+        self.slowest = []
+        self.order = 0
+
+    def enable(self)->None:
+        """Start recording"""
+        self.enabled = True
+        self.started = time.perf_counter()
+
+    def add_statement(self, sql_statement:str, sql_parameters:list, seconds:float,
+                      rows:int=1)->None:
+        """Record one call of a statement, executemany calls cover several rows"""
+        sql_statement = " ".join(sql_statement.split())
+        stats = self.statements.setdefault(sql_statement, {"calls": 0, "rows": 0, "seconds": 0.0,
+                                                           "max_seconds": 0.0})
+        stats["calls"] += 1
+        stats["rows"] += rows
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        # order breaks ties so the heap never compares statements or parameters
+        self.order += 1
+        entry = (seconds, self.order, sql_statement, sql_parameters)
+        if len(self.slowest) < SLOWEST_KEPT:
+            heapq.heappush(self.slowest, entry)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def add_phase(self, name:str, seconds:float)->None:
+        """Record one pass through a phase"""
+        stats = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+
+    def report(self, db_connection:sqlite3.Connection|None=None)->dict:
+        """Everything recorded so far, slowest statements get query plans if given a connection"""
+        plans = {}
+        slowest = []
+        for seconds, _, sql_statement, sql_parameters in sorted(self.slowest, reverse=True):
+            entry = {"seconds": seconds, "sql": sql_statement, "parameters": sql_parameters}
+            if db_connection is not None and sql_statement.upper().startswith(EXPLAINABLE):
+                if sql_statement not in plans:
+                    plans[sql_statement] = explain(db_connection, sql_statement, sql_parameters)
+                entry["query_plan"] = plans[sql_statement]
+            slowest.append(entry)
+        statements = [dict(stats, sql=sql_statement)
+                      for sql_statement, stats in self.statements.items()]
+        phases = [dict(stats, phase=name) for name, stats in self.phases.items()]
+        return {
+            "wall_seconds": time.perf_counter() - self.started,
+            "phases": sorted(phases, key=lambda stats: stats["seconds"], reverse=True),
+            "statements": sorted(statements, key=lambda stats: stats["seconds"], reverse=True),
+            "slowest": slowest,
+        }
+
+PROFILER = Profiler()
+
+def explain(db_connection:sqlite3.Connection, sql_statement:str, sql_parameters:list)->list[str]:
+    """EXPLAIN QUERY PLAN lines of a statement"""
+    try:
+        rows = db_connection.execute("EXPLAIN QUERY PLAN " + sql_statement,
+                                     sql_parameters).fetchall()
+    except sqlite3.Error as error:
+        return [f"not explained: {error}"]
+    return [row[-1] for row in rows]
+
+def timed_statement(many:bool=False)->Callable:
+    """Decorate a sql helper taking (sql_statement, sql_parameters) so its calls are recorded"""
+    def decorator(function:Callable)->Callable:
+        @wraps(function)
+        def wrapper(sql_statement:str, sql_parameters:list):
+            if not PROFILER.enabled:
+                return function(sql_statement, sql_parameters)
+            started = time.perf_counter()
+            try:
+                return function(sql_statement, sql_parameters)
+            finally:
+                seconds = time.perf_counter() - started
+                if many:
+                    # the first parameter set stands in for the rest
+                    sample = sql_parameters[0] if sql_parameters else []
+                    PROFILER.add_statement(sql_statement, sample, seconds, len(sql_parameters))
+                else:
+                    PROFILER.add_statement(sql_statement, sql_parameters, seconds)
+        return wrapper
+    return decorator
+
+def timed_phase(name:str)->Callable:
+    """Decorate a function so the time spent in it is recorded under name"""
+    def decorator(function:Callable)->Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                PROFILER.add_phase(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def timed_iterator(name:str, iterable:Iterable)->Iterator:
+    """Yield from iterable, recording the time spent producing each item under name"""
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            if PROFILER.enabled:
+                PROFILER.add_phase(name, time.perf_counter() - started)
+        yield item
+
+def print_report(report:dict)->None:
+    """Readable form of a report"""
+    print(f"--------Profile, {report['wall_seconds']:.2f}s wall time")
+    print(f"{'phase':<36}{'calls':>10}{'seconds':>12}")
+    for stats in report["phases"]:
+        print(f"{stats['phase']:<36}{stats['calls']:>10}{stats['seconds']:>12.4f}")
+    print(f"{'calls':>10}{'rows':>10}{'seconds':>12}{'max ms':>10}  statement")
+    for stats in report["statements"]:
+        print(f"{stats['calls']:>10}{stats['rows']:>10}{stats['seconds']:>12.4f}"
+              f"{stats['max_seconds'] * 1000:>10.2f}  {stats['sql'][:100]}")
+    print("Slowest statements")
+    for entry in report["slowest"]:
+        print(f"{entry['seconds'] * 1000:>10.2f} ms  {entry['sql'][:100]}")
+        print(f"{'':>14}{entry['parameters']}")
+        for line in entry.get("query_plan", []):
+            print(f"{'':>14}{line}")
+
+def write_report(report:dict, report_file:str)->None:
+    """Dump a report as JSON"""
+    with open(report_file, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=4, default=str)
@@ -0,0 +1,255 @@
+"""Rebuilds the DB by replaying every export archived under historic/"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from archive_store import ARCHIVE_FOLDER, ArchiveEntry, read_index, extract_entry
+from auto_insert import parse_file, INGEST_OVERLAP_DAYS
+from db_classes import (Account, Record, CategoryIndex, RecordChangeType, record_fingerprint,
+                        insert_records, get_balance_drift, BatchResult)
+from db_helper import sql_get, close_connection
+from db_migrations import migrate, SCHEMA_FILE
+
+# copied over as they are, accounts are copied with their opening balances instead
+COPIED_TABLES = ("books", "liabilities", "ingest_state", "ingested_files", "prices")
+DIFF_EXAMPLES = 10
+
+class LiveHistory:
+    """How the live DB categorized each account's records, and what it held before them"""
+    def __init__(self):
+        self.accounts = {}
+        self.category_indexes = {}
+        self.categories = {}
+        self.opening = {}
+        for account_id, _, name, *_ in sql_get("SELECT * FROM accounts;", []):
+            self.accounts[name] = account_id
+            self.category_indexes[account_id] = CategoryIndex(account_id)
+        sql_statement = "SELECT account_id, transaction_date, amount, business, note, \
+            category, change_type FROM records ORDER BY record_id;"
+        for account_id, transaction_date, amount, business, note, category, change_type \
+                in sql_get(sql_statement, []):
+            key = (account_id, str(transaction_date)[:10], f"{float(amount):.2f}",
+                   str(business), str(note))
+            self.categories.setdefault(key, (category, change_type))
+        # totals that no record explains, such as a balance entered when the account was made
+        for name, cash_drift, investment_drift in get_balance_drift():
+            self.opening[name] = (cash_drift, investment_drift)
+
+    def categorize(self, record:Record)->bool:
+        """Give a record the category its live copy has, else what its business maps to"""
+        key = (record.account.account_id, record.transaction_date.strftime("%Y-%m-%d"),
+               f"{record.amount:.2f}", str(record.business), str(record.note))
+        known = self.categories.get(key)
+        if known is None:
+            return record.auto_categorize()
+        record.category = known[0]
+        record.change_type = RecordChangeType[known[1]]
+        return True
+
+def build_fresh_db(new_file:str, live_file:str, opening:dict[str, tuple[float, float]])->None:
+    """Empty DB from finance_db_schema.sql holding the live books, accounts and liabilities"""
+    for ext in ("", "-wal", "-shm"):
+        if os.path.exists(new_file + ext):
+            os.remove(new_file + ext)
+    with open(SCHEMA_FILE, encoding="utf-8") as file:
+        schema = file.read()
+    db_connection = sqlite3.connect(new_file)
+    db_connection.executescript(schema)
+    db_connection.execute("ATTACH DATABASE ? AS live;", [live_file])
+    for table in ("accounts",) + COPIED_TABLES:
+        columns = ", ".join(column[1] for column in
+                            db_connection.execute(f"PRAGMA main.table_info({table});"))
+        db_connection.execute(f"INSERT INTO main.{table} ({columns}) \
+            SELECT {columns} FROM live.{table};")
+    for name, (cash_funds, investment_worth) in opening.items():
+        db_connection.execute("UPDATE main.accounts SET cash_funds = ?, investment_worth = ? \
+            WHERE account = ?;", [cash_funds, investment_worth, name])
+    db_connection.commit()
+    db_connection.execute("DETACH DATABASE live;")
+    db_connection.close()
+
+def parse_archive(entries:list[ArchiveEntry], accounts:dict[str, Account], workers:int|None,
+                  extract_folder:str, archive_folder:str=ARCHIVE_FOLDER,
+                  overlap_days:int|None=INGEST_OVERLAP_DAYS)->dict[int, list[Record]]:
+    """Records of every entry, per account in chronological order, files parsed in parallel
+
+    Each export only adds rows from its account's watermark back overlap_days on, the way
+    they were imported, every row is kept when overlap_days is None.
+    """
+    # the index is appended to as exports are pulled, its order is the order they were imported
+    jobs = [(extract_entry(entry, extract_folder, archive_folder), entry.institute,
+             accounts[entry.account], None) for entry in entries]
+    timeline = {account.account_id: [] for account in accounts.values()}
+    watermarks = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for (_, _, account, _), transactions in zip(jobs, executor.map(parse_file, jobs)):
+            watermark = watermarks.get(account.account_id)
+            if overlap_days is not None and watermark is not None:
+                since = watermark - timedelta(days=overlap_days)
+                transactions = [record for record in transactions
+                                if record.transaction_date >= since]
+            for record in transactions:
+                # records come back with their own copy of the account, share ours again
+                record.account = account
+                if record.changed_asset.account:
+                    record.changed_asset.account = account
+            if transactions:
+                newest = max(record.transaction_date for record in transactions)
+                watermarks[account.account_id] = max(watermark or newest, newest)
+            timeline[account.account_id].extend(transactions)
+    for records in timeline.values():
+        records.sort(key=lambda record: record.transaction_date)
+    return timeline
+
+def replay(timeline:dict[int, list[Record]], accounts:dict[str, Account],
+           history:LiveHistory)->dict[str, tuple[BatchResult, list[Record], int]]:
+    """Categorize from history and insert each account's records in order"""
+    results = {}
+    for account in accounts.values():
+        records, uncategorized, seen, overlapping = [], [], set(), 0
+        for record in timeline[account.account_id]:
+            if not history.categorize(record):
+                uncategorized.append(record)
+                continue
+            # consecutive exports overlap, keep the first copy of every row
+            fingerprint = record.get_fingerprint()
+            if fingerprint in seen:
+                overlapping += 1
+                continue
+            seen.add(fingerprint)
+            records.append(record)
+        with open(os.devnull, "w", encoding="utf-8") as devnull, redirect_stdout(devnull):
+            result = insert_records(records)
+        results[account.account] = (result, uncategorized, overlapping)
+    return results
+
+def fingerprinted_records(db_connection:sqlite3.Connection, schema:str,
+                          account_id:int)->dict[str, str]:
+    """Category of every record of an account keyed by fingerprint"""
+    sql_statement = f"SELECT transaction_date, amount, business, note, change_type, category \
+        FROM {schema}.records WHERE account_id = ?;"
+    return {record_fingerprint(account_id, transaction_date, amount, business, note,
+                               change_type): category
+            for transaction_date, amount, business, note, change_type, category
+            in db_connection.execute(sql_statement, [account_id])}
+
+def diff_databases(live_file:str, new_file:str)->list[str]:
+    """Differences in records, totals and positions between the live and rebuilt DB"""
+    lines = []
+    db_connection = sqlite3.connect(live_file)
+    db_connection.execute("ATTACH DATABASE ? AS rebuilt;", [new_file])
+    sql_statement = "SELECT live.account_id, live.account, live.cash_funds, \
+            live.investment_worth, new.cash_funds, new.investment_worth \
+        FROM main.accounts AS live JOIN rebuilt.accounts AS new USING (account_id) \
+        ORDER BY live.account_id;"
+    for account_id, name, live_cash, live_worth, new_cash, new_worth \
+            in db_connection.execute(sql_statement).fetchall():
+        live = fingerprinted_records(db_connection, "main", account_id)
+        rebuilt = fingerprinted_records(db_connection, "rebuilt", account_id)
+        only_live = sorted(live.keys() - rebuilt.keys())
+        only_rebuilt = sorted(rebuilt.keys() - live.keys())
+        recategorized = sorted(fingerprint for fingerprint in live.keys() & rebuilt.keys()
+                               if live[fingerprint] != rebuilt[fingerprint])
+        lines.append(f"{name}: {len(live)} live records, {len(rebuilt)} rebuilt, "
+                     f"{len(only_live)} only live, {len(only_rebuilt)} only rebuilt, "
+                     f"{len(recategorized)} recategorized")
+        lines.append(f"    cash {round(live_cash, 2)} -> {round(new_cash, 2)}, "
+                     f"investments {round(live_worth, 2)} -> {round(new_worth, 2)}")
+        for label, schema, fingerprints in (("only live", "main", only_live),
+                                            ("only rebuilt", "rebuilt", only_rebuilt)):
+            for fingerprint in fingerprints[:DIFF_EXAMPLES]:
+                row = db_connection.execute(f"SELECT transaction_date, amount, business, note, \
+                    category FROM {schema}.records WHERE fingerprint = ?;",
+                                            [fingerprint]).fetchone()
+                lines.append(f"    {label}: {row if row else fingerprint[:12]}")
+        sql_statement = "SELECT asset, ROUND(quantity, 6), ROUND(market_value, 6) \
+            FROM {}.assets WHERE account_id = ? ORDER BY asset;"
+        live_assets = db_connection.execute(sql_statement.format("main"), [account_id]).fetchall()
+        new_assets = db_connection.execute(sql_statement.format("rebuilt"),
+                                           [account_id]).fetchall()
+        for asset in sorted(set(live_assets) ^ set(new_assets))[:DIFF_EXAMPLES]:
+            side = "live" if asset in live_assets else "rebuilt"
+            lines.append(f"    position only {side}: {asset}")
+    db_connection.close()
+    return lines
+
+def replace_live(live_file:str, new_file:str)->str:
+    """Swap the rebuilt DB in, keeping the live one as a backup, returns the backup path"""
+    close_connection()
+    for db_file in (live_file, new_file):
+        db_connection = sqlite3.connect(db_file)
+        db_connection.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        db_connection.close()
+    backup = f"{live_file}.{datetime.now().strftime('%Y%m%d%H%M%S')}.bak"
+    os.replace(live_file, backup)
+    for ext in ("-wal", "-shm"):
+        if os.path.exists(live_file + ext):
+            os.remove(live_file + ext)
+    os.replace(new_file, live_file)
+    return backup
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Rebuild the DB from archived exports")
+    parser.add_argument("-o", "--output", help='Rebuilt DB file, <DB_NAME>.rebuild by default')
+    parser.add_argument("-w", "--workers", type=int, help='Processes parsing exports')
+    parser.add_argument("--archive", default=ARCHIVE_FOLDER, help='Folder of the archive')
+    parser.add_argument("--full", action="store_true",
+                        help='Replay every row of every export, not just rows past watermarks')
+    parser.add_argument("--replace", action="store_true",
+                        help='Swap the rebuilt DB in for the live one, keeping a backup')
+    args = parser.parse_args()
+    load_dotenv()
+    started = time.perf_counter()
+    live_file = os.getenv("DB_NAME")
+    new_file = args.output or live_file + ".rebuild"
+
+    migrate()
+    history = LiveHistory()
+    close_connection()
+    entries = []
+    for entry in read_index(args.archive):
+        if entry.account not in history.accounts or entry.institute is None:
+            print("Skipping, no account or parser for:", entry.file_name, entry.account)
+            continue
+        entries.append(entry)
+    build_fresh_db(new_file, live_file, history.opening)
+
+    os.environ["DB_NAME"] = new_file
+    accounts = {}
+    for entry in entries:
+        if entry.account not in accounts:
+            account = Account(history.accounts[entry.account])
+            account.category_index = history.category_indexes[account.account_id]
+            accounts[entry.account] = account
+    with tempfile.TemporaryDirectory() as extract_folder:
+        timeline = parse_archive(entries, accounts, args.workers, extract_folder,
+                                 args.archive, None if args.full else INGEST_OVERLAP_DAYS)
+    results = replay(timeline, accounts, history)
+    close_connection()
+    print(f"--------Replayed {len(entries)} exports in {time.perf_counter() - started:.1f}s")
+    for name, (result, uncategorized, overlapping) in results.items():
+        print(f"{name}: {result}, {overlapping} rows repeated across exports, "
+              f"{len(uncategorized)} without a known category")
+        for record in uncategorized[:DIFF_EXAMPLES]:
+            print("    no category:", record.transaction_date.date(), record.amount,
+                  record.business, record.note)
+    for line in diff_databases(live_file, new_file):
+        print(line)
+
+    if args.replace:
+        if any(result.failed for result, _, _ in results.values()):
+            print("Some records failed to insert, the live DB was left in place")
+            sys.exit()
+        print("Live DB kept as", replace_live(live_file, new_file))
+    else:
+        print("Rebuilt DB written to", new_file)
+
+if __name__ == "__main__":
+    main()
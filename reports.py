@@ -0,0 +1,184 @@
+"""Month, category and net worth summaries answered from the rollup and snapshot tables"""
+import argparse
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from db_helper import sql_get, sql_update, sql_update_many, db_session
+from db_classes import find_account
+
+FIRST_MONTH = "0000-00"
+LAST_MONTH = "9999-99"
+# money coming into an account, everything else is money going out
+INCOME_CHANGE_TYPES = ("DEBIT_ACCOUNT", "SELL_ASSET")
+# each takes the account id twice so it can be left out with None
+SELECT_MONTH_STATEMENT = "SELECT accounts.account, category, change_type, \
+        ROUND(total, 2), record_count \
+    FROM monthly_rollups JOIN accounts USING (account_id) \
+    WHERE month = ? AND (? IS NULL OR account_id = ?) \
+    ORDER BY accounts.account, change_type, total DESC;"
+SELECT_CATEGORY_STATEMENT = "SELECT month, ROUND(SUM(total), 2), SUM(record_count) \
+    FROM monthly_rollups \
+    WHERE category = ? AND month BETWEEN ? AND ? AND (? IS NULL OR account_id = ?) \
+    GROUP BY month ORDER BY month;"
+SELECT_CASH_FLOW_STATEMENT = f"SELECT month, \
+        ROUND(SUM(CASE WHEN change_type IN {INCOME_CHANGE_TYPES} THEN total ELSE 0 END), 2), \
+        ROUND(SUM(CASE WHEN change_type IN {INCOME_CHANGE_TYPES} THEN 0 ELSE total END), 2) \
+    FROM monthly_rollups \
+    WHERE month BETWEEN ? AND ? AND (? IS NULL OR account_id = ?) \
+    GROUP BY month ORDER BY month;"
+SELECT_SNAPSHOTS_STATEMENT = "SELECT account_id, as_of, cash_funds, investment_worth, debt_total \
+    FROM balance_snapshots \
+    WHERE as_of BETWEEN ? AND ? AND (? IS NULL OR account_id = ?) \
+    ORDER BY as_of;"
+SELECT_BALANCE_BEFORE_STATEMENT = "SELECT cash_funds, investment_worth, debt_total \
+    FROM balance_snapshots WHERE account_id = ? AND as_of < ? \
+    ORDER BY as_of DESC LIMIT 1;"
+
+def rebuild_rollups()->None:
+    """Recompute every rollup from records, inserts keep them current after that"""
+    with db_session():
+        sql_update("DELETE FROM monthly_rollups;", [])
+        sql_update("INSERT INTO monthly_rollups \
+                (account_id, month, category, change_type, total, record_count) \
+            SELECT account_id, substr(transaction_date, 1, 7), category, change_type, \
+                SUM(amount), COUNT(*) \
+            FROM records GROUP BY 1, 2, 3, 4;", [])
+
+def rebuild_snapshots()->None:
+    """Recompute every account's daily balances from its records
+
+    Records do not keep the market value of a trade, positions are revalued at amount over
+    quantity, and whatever the stored totals hold beyond the records is the opening balance.
+    """
+    rows = []
+    # an account without records held its balance before the DB did, from the first day on
+    earliest = sql_get("SELECT MIN(substr(transaction_date, 1, 10)) FROM records;", [])[0][0]
+    first_record_day = (datetime.strptime(earliest, "%Y-%m-%d") if earliest
+                        else datetime.now())
+    for account_id, cash_funds, investment_worth, debt_total \
+            in sql_get("SELECT account_id, cash_funds, investment_worth, debt_total \
+                FROM accounts;", []):
+        changes, positions, cash, investments = {}, {}, 0.0, 0.0
+        sql_statement = "SELECT substr(transaction_date, 1, 10), amount, change_type, \
+                asset_id, quantity \
+            FROM records WHERE account_id = ? ORDER BY transaction_date, record_id;"
+        for day, amount, change_type, asset_id, quantity \
+                in sql_get(sql_statement, [account_id]):
+            cash_change = amount if change_type in INCOME_CHANGE_TYPES else -amount
+            investment_change = 0.0
+            if asset_id is not None:
+                price = amount / quantity if quantity else 0.0
+                if asset_id not in positions:
+                    # the first trade of an asset opens the position whatever its side
+                    positions[asset_id] = [quantity or 0.0, price]
+                    investment_change = (quantity or 0.0) * price
+                else:
+                    position = positions[asset_id]
+                    old_value = position[0] * position[1]
+                    position[0] += -quantity if change_type == "SELL_ASSET" else quantity
+                    position[1] = price or position[1]
+                    investment_change = position[0] * position[1] - old_value
+            change = changes.setdefault(day, [0.0, 0.0])
+            change[0] += cash_change
+            change[1] += investment_change
+            cash += cash_change
+            investments += investment_change
+        days = sorted(changes)
+        first_day = datetime.strptime(days[0], "%Y-%m-%d") if days else first_record_day
+        balance = [cash_funds - cash, investment_worth - investments]
+        rows.append([account_id, (first_day - timedelta(days=1)).strftime("%Y-%m-%d"),
+                     round(balance[0], 2), round(balance[1], 2), debt_total])
+        for day in days:
+            balance[0] += changes[day][0]
+            balance[1] += changes[day][1]
+            rows.append([account_id, day, round(balance[0], 2), round(balance[1], 2), debt_total])
+    with db_session():
+        sql_update("DELETE FROM balance_snapshots;", [])
+        sql_update_many("INSERT INTO balance_snapshots \
+            (account_id, as_of, cash_funds, investment_worth, debt_total) \
+            VALUES (?, ?, ?, ?, ?);", rows)
+
+def month_summary(month:str, account_id:int|None=None)->list[tuple[str, str, str, float, int]]:
+    """Total and count per account, category and change type for a YYYY-MM month"""
+    return sql_get(SELECT_MONTH_STATEMENT, [month, account_id, account_id])
+
+def category_history(category:str, start:str=FIRST_MONTH, end:str=LAST_MONTH,
+                     account_id:int|None=None)->list[tuple[str, float, int]]:
+    """Total and count of a category month by month"""
+    return sql_get(SELECT_CATEGORY_STATEMENT, [category, start, end, account_id, account_id])
+
+def cash_flow(start:str=FIRST_MONTH, end:str=LAST_MONTH,
+              account_id:int|None=None)->list[tuple[str, float, float]]:
+    """Money in and money out month by month"""
+    return sql_get(SELECT_CASH_FLOW_STATEMENT, [start, end, account_id, account_id])
+
+def net_worth_history(start:str=FIRST_MONTH, end:str=LAST_MONTH, account_id:int|None=None,
+                      monthly:bool=True)->list[tuple[str, float, float, float, float]]:
+    """Cash, investments, debt and net worth on every day balances changed, or each month end"""
+    if account_id is None:
+        account_ids = [row[0] for row in sql_get("SELECT account_id FROM accounts;", [])]
+    else:
+        account_ids = [account_id]
+    balances = {}
+    for account in account_ids:
+        results = sql_get(SELECT_BALANCE_BEFORE_STATEMENT, [account, start])
+        if results:
+            balances[account] = results[0]
+    history = []
+    for account, as_of, *balance in sql_get(SELECT_SNAPSHOTS_STATEMENT,
+                                            [start, end, account_id, account_id]):
+        balances[account] = balance
+        cash, investments, debt = (round(sum(balance[index] for balance in balances.values()), 2)
+                                   for index in range(3))
+        point = (as_of[:7] if monthly else as_of, cash, investments, debt,
+                 round(cash + investments - debt, 2))
+        if history and history[-1][0] == point[0]:
+            history[-1] = point
+        else:
+            history.append(point)
+    return history
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Spending and income summaries by month")
+    parser.add_argument("-a", "--account", help='Only this account, by name or id')
+    parser.add_argument("-m", "--month", help='Category totals of one YYYY-MM month')
+    parser.add_argument("-c", "--category", help='Month by month totals of one category')
+    parser.add_argument("-n", "--net-worth", action="store_true",
+                        help='Balances at the end of every month')
+    parser.add_argument("-d", "--daily", action="store_true",
+                        help='With --net-worth, balances on every day they changed')
+    parser.add_argument("-s", "--start", default=FIRST_MONTH, help='First YYYY-MM month shown')
+    parser.add_argument("-e", "--end", default=LAST_MONTH, help='Last YYYY-MM month shown')
+    parser.add_argument("--rebuild", action="store_true",
+                        help='Recompute rollups and balance snapshots from records')
+    args = parser.parse_args()
+    load_dotenv()
+    account_id = find_account(args.account).account_id if args.account else None
+
+    if args.rebuild:
+        rebuild_rollups()
+        rebuild_snapshots()
+        print("--------Rebuilt monthly rollups and balance snapshots")
+    if args.month:
+        print(f"{'account':<20}{'category':<24}{'change type':<16}{'total':>14}{'records':>9}")
+        for account, category, change_type, total, record_count \
+                in month_summary(args.month, account_id):
+            print(f"{account:<20}{category:<24}{change_type:<16}{total:>14.2f}{record_count:>9}")
+    elif args.net_worth:
+        print(f"{'date':<12}{'cash':>14}{'investments':>14}{'debt':>14}{'net worth':>14}")
+        # months compare below any day in them, the last month reaches to its last day
+        for as_of, cash, investments, debt, net_worth \
+                in net_worth_history(args.start, args.end + "-31", account_id, not args.daily):
+            print(f"{as_of:<12}{cash:>14.2f}{investments:>14.2f}{debt:>14.2f}{net_worth:>14.2f}")
+    elif args.category:
+        print(f"{'month':<10}{'total':>14}{'records':>9}")
+        for month, total, record_count \
+                in category_history(args.category, args.start, args.end, account_id):
+            print(f"{month:<10}{total:>14.2f}{record_count:>9}")
+    elif not args.rebuild:
+        print(f"{'month':<10}{'in':>14}{'out':>14}{'net':>14}")
+        for month, money_in, money_out in cash_flow(args.start, args.end, account_id):
+            print(f"{month:<10}{money_in:>14.2f}{money_out:>14.2f}{money_in - money_out:>14.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Marks asset positions to market from a local history of quotes"""
+import os
+import re
+import csv
+import sys
+import argparse
+from datetime import datetime
+import numpy as np
+from dotenv import load_dotenv
+from data_parser import MONEY_MARKERS
+from db_helper import sql_get, sql_update_many, db_session
+from db_classes import Account, normalize_symbol, SELECT_PRICE_STATEMENT, INSERT_SNAPSHOT_STATEMENT
+from db_migrations import migrate
+
+# header names quote files use, compared lowercased, earlier names are preferred
+DATE_HEADERS = ("date", "as of", "as_of", "trade date", "price date")
+SYMBOL_HEADERS = ("symbol", "ticker", "asset", "fund", "security")
+PRICE_HEADERS = ("close", "price", "nav", "closing price", "last", "adj close")
+QUOTE_DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%Y/%m/%d")
+# brokerages keep the description as the asset and the ticker in its note
+TICKER_PATTERN = re.compile(r"[A-Z][A-Z0-9.\-]{0,9}")
+UPSERT_PRICE_STATEMENT = "INSERT INTO prices (asset, as_of, price) VALUES (?, ?, ?) \
+    ON CONFLICT (asset, as_of) DO UPDATE SET price = excluded.price;"
+SELECT_HISTORY_STATEMENT = "SELECT as_of, price FROM prices WHERE asset = ? AND as_of <= ? \
+    ORDER BY as_of;"
+# what every position held on each trade day, sells take quantity away
+SELECT_TRADES_STATEMENT = "SELECT asset_id, substr(transaction_date, 1, 10), \
+        SUM(CASE WHEN change_type = 'SELL_ASSET' THEN -quantity ELSE quantity END) \
+    FROM records WHERE asset_id IS NOT NULL GROUP BY 1, 2;"
+
+def find_column(header:list[str], names:tuple[str, ...])->int|None:
+    """Index of the first of names found in a lowercased header"""
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+def parse_quote_date(value:str)->str|None:
+    """YYYY-MM-DD of a quote date in any of the formats quote files use"""
+    for date_format in QUOTE_DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip()[:10], date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+def load_quotes(quote_file:str)->int:
+    """Store the prices of a quote file, the file name is the symbol when it has no column"""
+    with open(quote_file, encoding="utf-8-sig", newline="") as file:
+        reader = csv.reader(file, delimiter=',')
+        header = [column.strip().lower() for column in next(reader, [])]
+        date_column = find_column(header, DATE_HEADERS)
+        price_column = find_column(header, PRICE_HEADERS)
+        symbol_column = find_column(header, SYMBOL_HEADERS)
+        if date_column is None or price_column is None:
+            print("No date or price column in", quote_file)
+            sys.exit()
+        file_symbol = normalize_symbol(os.path.splitext(os.path.basename(quote_file))[0])
+        rows = []
+        for row in filter(None, reader):
+            as_of = parse_quote_date(row[date_column])
+            try:
+                price = float(row[price_column].translate(MONEY_MARKERS))
+            except ValueError:
+                continue # holidays and missing closes show up as null or blank
+            if as_of is None:
+                continue
+            symbol = file_symbol if symbol_column is None else normalize_symbol(row[symbol_column])
+            rows.append([symbol, as_of, price])
+    with db_session():
+        sql_update_many(UPSERT_PRICE_STATEMENT, rows)
+    return len(rows)
+
+def quote_symbols(assets:list[str], notes:list[str|None])->list[str]:
+    """Symbol each position is quoted under, its ticker, or its name when only that has quotes"""
+    quoted = {row[0] for row in sql_get("SELECT DISTINCT asset FROM prices;", [])}
+    symbols = []
+    for asset, note in zip(assets, notes):
+        name = normalize_symbol(asset)
+        ticker = normalize_symbol(note) if note else ""
+        if TICKER_PATTERN.fullmatch(ticker) and (ticker in quoted or name not in quoted):
+            symbols.append(ticker)
+        else:
+            symbols.append(name)
+    return symbols
+
+def load_positions()->tuple[np.ndarray, np.ndarray, list[str], np.ndarray, np.ndarray]:
+    """Asset ids, account ids, quote symbols, quantities and market values of every position"""
+    rows = sql_get("SELECT asset_id, account_id, asset, note, quantity, market_value \
+        FROM assets ORDER BY asset_id;", [])
+    if not rows:
+        return np.array([], int), np.array([], int), [], np.array([]), np.array([])
+    asset_ids, account_ids, assets, notes, quantities, market_values = zip(*rows)
+    return (np.array(asset_ids), np.array(account_ids), quote_symbols(assets, notes),
+            np.array(quantities, dtype=float), np.array(market_values, dtype=float))
+
+def latest_prices(symbols:list[str], as_of:str)->np.ndarray:
+    """Newest quote on or before as_of of each symbol, NaN where there is none"""
+    distinct = sorted(set(symbols))
+    prices = np.full(len(distinct), np.nan)
+    for index, symbol in enumerate(distinct):
+        results = sql_get(SELECT_PRICE_STATEMENT, [symbol, as_of])
+        if results:
+            prices[index] = results[0][0]
+    return prices[np.searchsorted(distinct, symbols)] if symbols else prices
+
+def revalue(as_of:datetime)->list[tuple[int, float]]:
+    """Mark every position to its latest quote, returns the change of each account's worth"""
+    # positions are read under the write lock so no trade lands between reading and writing
+    with db_session():
+        asset_ids, account_ids, symbols, quantities, market_values = load_positions()
+        if not symbols:
+            return []
+        prices = latest_prices(symbols, as_of.strftime("%Y-%m-%d"))
+        # positions without a quote keep the price of their last trade
+        new_values = np.where(np.isnan(prices), market_values, prices)
+        accounts, account_index = np.unique(account_ids, return_inverse=True)
+        changes = np.bincount(account_index, weights=quantities * (new_values - market_values),
+                              minlength=len(accounts))
+        moved = np.flatnonzero(new_values != market_values)
+        sql_update_many("UPDATE assets SET market_value = ? WHERE asset_id = ?;",
+                        [[float(new_values[index]), int(asset_ids[index])] for index in moved])
+        for account_id, change in zip(accounts, changes):
+            if round(change, 2):
+                Account(int(account_id)).update_investment_worth(float(change), as_of)
+    return [(int(account_id), round(float(change), 2)) for account_id, change
+            in zip(accounts, changes)]
+
+def backfill(start:str, end:str)->int:
+    """Value every account's positions on each quote and snapshot day between start and end
+
+    Quantities are replayed from trades back from today's positions, a day before an asset's
+    first quote uses its stored market value. Returns the snapshot rows written.
+    """
+    asset_ids, account_ids, symbols, quantities, market_values = load_positions()
+    if not symbols:
+        return 0
+    distinct = sorted(set(symbols))
+    histories = {}
+    days = set()
+    for symbol in distinct:
+        history = sql_get(SELECT_HISTORY_STATEMENT, [symbol, end])
+        histories[symbol] = (np.array([row[0] for row in history], dtype="datetime64[D]"),
+                             np.array([row[1] for row in history], dtype=float))
+        days.update(row[0] for row in history if row[0] >= start)
+    accounts, account_index = np.unique(account_ids, return_inverse=True)
+    sql_statement = f"SELECT DISTINCT as_of FROM balance_snapshots \
+        WHERE as_of BETWEEN ? AND ? AND account_id IN ({', '.join('?' * len(accounts))});"
+    days.update(row[0] for row in sql_get(sql_statement, [start, end, *accounts.tolist()]))
+    if not days:
+        return 0
+    days = np.array(sorted(days), dtype="datetime64[D]")
+
+    # quantity held at the end of each day, what trades do not explain was held before them
+    columns = {int(asset_id): index for index, asset_id in enumerate(asset_ids)}
+    trades = [row for row in sql_get(SELECT_TRADES_STATEMENT, []) if row[0] in columns]
+    changes = np.zeros((len(days) + 1, len(asset_ids)))
+    opening = quantities.copy()
+    if trades:
+        trade_columns = np.array([columns[row[0]] for row in trades])
+        trade_days = np.array([row[1] for row in trades], dtype="datetime64[D]")
+        trade_quantities = np.array([row[2] or 0.0 for row in trades], dtype=float)
+        np.add.at(changes, (np.searchsorted(days, trade_days), trade_columns), trade_quantities)
+        opening -= np.bincount(trade_columns, weights=trade_quantities, minlength=len(asset_ids))
+    held = opening + np.cumsum(changes, axis=0)[:len(days)]
+
+    # each day's price is the newest quote on or before it
+    prices = np.empty((len(days), len(asset_ids)))
+    for column, symbol in enumerate(symbols):
+        quote_days, quote_prices = histories[symbol]
+        latest = np.searchsorted(quote_days, days, side="right") - 1
+        prices[:, column] = np.where(latest >= 0, quote_prices[np.maximum(latest, 0)]
+                                     if len(quote_prices) else 0.0, market_values[column])
+    worth = np.zeros((len(days), len(accounts)))
+    np.add.at(worth.T, account_index, (held * prices).T)
+
+    # an account's history starts at its opening snapshot, accounts without one are skipped
+    first_days = dict(sql_get("SELECT account_id, MIN(as_of) FROM balance_snapshots \
+        GROUP BY account_id;", []))
+    day_strings = days.astype(str).tolist()
+    rows = [(day, int(account_id), round(float(worth[row, column]), 2))
+            for column, account_id in enumerate(accounts) for row, day in enumerate(day_strings)
+            if int(account_id) in first_days and day >= first_days[int(account_id)]]
+    with db_session():
+        # days without a snapshot start from the one before them
+        sql_update_many(INSERT_SNAPSHOT_STATEMENT, [[day, account_id, account_id, day, account_id]
+                                                    for day, account_id, _ in rows])
+        sql_update_many("UPDATE balance_snapshots SET investment_worth = ? \
+            WHERE account_id = ? AND as_of = ?;",
+                        [[value, account_id, day] for day, account_id, value in rows])
+    return len(rows)
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Mark asset positions to market")
+    parser.add_argument("-q", "--quotes", nargs="+", default=[],
+                        help='CSV quote files to load, named by symbol if they have no column')
+    parser.add_argument("-d", "--date", default=datetime.now().strftime("%Y-%m-%d"),
+                        help='YYYY-MM-DD to value positions at, today by default')
+    parser.add_argument("-b", "--backfill", action="store_true",
+                        help='Write valuations into balance snapshots from --start to --end')
+    parser.add_argument("-s", "--start", default="0000-01-01", help='First YYYY-MM-DD backfilled')
+    parser.add_argument("-e", "--end", default=datetime.now().strftime("%Y-%m-%d"),
+                        help='Last YYYY-MM-DD backfilled')
+    args = parser.parse_args()
+    load_dotenv()
+    migrate()
+    for quote_file in args.quotes:
+        print(f"--------{load_quotes(quote_file)} prices loaded from {quote_file}")
+    if args.backfill:
+        print(f"--------Valued {backfill(args.start, args.end)} account days")
+        return
+    for account_id, change in revalue(datetime.strptime(args.date, "%Y-%m-%d")):
+        account = Account(account_id)
+        print(f"{account.account}: investments {account.investment_worth} ({change:+.2f})")
+
+if __name__ == "__main__":
+    main()
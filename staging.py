@@ -0,0 +1,348 @@
+"""In memory staging area that merges a parsed export into the ledger with set based statements"""
+from datetime import datetime
+from typing import Iterable
+from db_helper import sql_get, sql_update, sql_update_many, get_connection, db_session
+from db_classes import (Record, RecordChangeType, BatchResult, categorize_by_business,
+                        record_fingerprint, normalize_symbol)
+from instrumentation import timed_phase
+
+STAGING_SCHEMA = "staging"
+DIFF_EXAMPLES = 10
+# columns a staged row carries beyond the ones records has
+STAGING_COLUMNS = ("symbol TEXT", "asset TEXT", "market_value FLOAT", "asset_note TEXT",
+                   "position_quantity FLOAT", "value_change FLOAT")
+INSERT_STAGED_STATEMENT = "INSERT INTO staging.records \
+    (record_id, account_id, amount, business, quantity, note, transaction_date, \
+    symbol, asset, market_value, asset_note) \
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+# first categorization of each business and note wins, the way CategoryIndex keeps them
+LOAD_HISTORY_STATEMENT = "INSERT OR IGNORE INTO staging.category_history \
+        (account_id, business, note, category, change_type) \
+    SELECT account_id, lower(business), lower(note), category, change_type \
+    FROM main.records \
+    WHERE account_id IN (SELECT DISTINCT account_id FROM staging.records) \
+    GROUP BY account_id, business, note, category, change_type \
+    ORDER BY MIN(record_id);"
+FILL_CATEGORIES_STATEMENT = "UPDATE staging.records AS staged \
+    SET category = history.category, change_type = history.change_type \
+    FROM staging.category_history AS history \
+    WHERE staged.category IS NULL AND history.account_id = staged.account_id \
+        AND history.business = lower(staged.business) AND history.note = lower(staged.note);"
+FINGERPRINT_STATEMENT = "UPDATE staging.records SET fingerprint = record_fingerprint( \
+    account_id, transaction_date, amount, business, note, change_type);"
+# one anti-join against the ledger, then the first copy of rows repeated within the export
+DROP_EXISTING_STATEMENT = "DELETE FROM staging.records AS staged \
+    WHERE EXISTS (SELECT 1 FROM main.records AS live WHERE live.fingerprint = staged.fingerprint);"
+DROP_REPEATED_STATEMENT = "DELETE FROM staging.records AS staged \
+    WHERE EXISTS (SELECT 1 FROM staging.records AS earlier \
+        WHERE earlier.fingerprint = staged.fingerprint AND earlier.record_id < staged.record_id);"
+LOAD_POSITIONS_STATEMENT = "INSERT INTO staging.assets \
+        (asset_id, account_id, asset, quantity, market_value, note, symbol, is_new, \
+        opening_quantity) \
+    SELECT asset_id, account_id, asset, quantity, market_value, note, symbol, 0, quantity \
+    FROM (SELECT *, normalize_symbol(asset) AS symbol, ROW_NUMBER() OVER ( \
+            PARTITION BY account_id, normalize_symbol(asset) ORDER BY asset_id) AS position \
+        FROM main.assets \
+        WHERE account_id IN (SELECT account_id FROM staging.records WHERE symbol IS NOT NULL)) \
+    WHERE position = 1;"
+# the first trade of an asset opens the position whatever its side, like Asset.insert_asset
+TRADES_STATEMENT = "UPDATE staging.records AS staged \
+    SET position_quantity = trades.position_quantity, value_change = trades.value_change \
+    FROM (SELECT record_id, position_quantity, position_quantity * market_value - COALESCE( \
+                LAG(position_quantity * market_value) OVER trade_order, \
+                opening_quantity * opening_value, 0) AS value_change \
+            FROM (SELECT *, COALESCE(opening_quantity, 0) \
+                    + SUM(quantity_change) OVER trade_order AS position_quantity \
+                FROM (SELECT record_id, account_id, symbol, staged.market_value, \
+                        held.quantity AS opening_quantity, held.market_value AS opening_value, \
+                        CASE WHEN held.asset_id IS NULL AND ROW_NUMBER() OVER trade_order = 1 \
+                                THEN COALESCE(staged.quantity, 0) \
+                            WHEN change_type = 'SELL_ASSET' THEN -staged.quantity \
+                            ELSE staged.quantity END AS quantity_change \
+                    FROM staging.records AS staged \
+                    LEFT JOIN staging.assets AS held USING (account_id, symbol) \
+                    WHERE symbol IS NOT NULL \
+                    WINDOW trade_order AS (PARTITION BY account_id, symbol ORDER BY record_id)) \
+                WINDOW trade_order AS (PARTITION BY account_id, symbol ORDER BY record_id)) \
+            WINDOW trade_order AS (PARTITION BY account_id, symbol ORDER BY record_id)) AS trades \
+    WHERE trades.record_id = staged.record_id;"
+OPEN_POSITIONS_STATEMENT = "INSERT INTO staging.assets \
+        (asset_id, account_id, asset, quantity, market_value, note, symbol, is_new, \
+        opening_quantity) \
+    SELECT (SELECT COALESCE(MAX(asset_id), 0) FROM main.assets) \
+            + ROW_NUMBER() OVER (ORDER BY record_id), \
+        account_id, asset, 0, 0, asset_note, symbol, 1, 0 \
+    FROM (SELECT record_id, account_id, symbol, asset, asset_note, ROW_NUMBER() OVER ( \
+            PARTITION BY account_id, symbol ORDER BY record_id) AS trade \
+        FROM staging.records WHERE symbol IS NOT NULL) AS first_trade \
+    WHERE trade = 1 AND NOT EXISTS (SELECT 1 FROM staging.assets AS held \
+        WHERE held.account_id = first_trade.account_id AND held.symbol = first_trade.symbol);"
+# the last trade of an asset leaves its quantity and price
+MOVE_POSITIONS_STATEMENT = "UPDATE staging.assets AS held \
+    SET quantity = last_trade.position_quantity, market_value = last_trade.market_value, \
+        changed = 1 \
+    FROM (SELECT account_id, symbol, position_quantity, market_value, \
+            ROW_NUMBER() OVER (PARTITION BY account_id, symbol ORDER BY record_id DESC) AS trade \
+        FROM staging.records WHERE symbol IS NOT NULL) AS last_trade \
+    WHERE last_trade.trade = 1 AND last_trade.account_id = held.account_id \
+        AND last_trade.symbol = held.symbol;"
+LINK_ASSETS_STATEMENT = "UPDATE staging.records AS staged SET asset_id = held.asset_id \
+    FROM staging.assets AS held \
+    WHERE held.account_id = staged.account_id AND held.symbol = staged.symbol;"
+ACCOUNT_CHANGES = "(SELECT account_id, \
+            SUM(CASE WHEN change_type IN ('DEBIT_ACCOUNT', 'SELL_ASSET') THEN amount \
+                ELSE -amount END) AS cash, \
+            SUM(COALESCE(value_change, 0)) AS investments \
+        FROM staging.records GROUP BY account_id) AS changes"
+STAGE_TOTALS_STATEMENT = f"UPDATE staging.accounts AS account \
+    SET cash_funds = ROUND(account.cash_funds + changes.cash, 2), \
+        investment_worth = ROUND(account.investment_worth + changes.investments, 2) \
+    FROM {ACCOUNT_CHANGES} WHERE changes.account_id = account.account_id;"
+# live totals move by the staged changes, another writer may have moved them since staging
+MERGE_TOTALS_STATEMENT = f"UPDATE main.accounts AS account \
+    SET cash_funds = ROUND(account.cash_funds + changes.cash, 2), \
+        investment_worth = ROUND(account.investment_worth + changes.investments, 2) \
+    FROM {ACCOUNT_CHANGES} WHERE changes.account_id = account.account_id;"
+COPY_ACCOUNTS_STATEMENT = "INSERT INTO staging.accounts SELECT * FROM main.accounts \
+    WHERE account_id IN (SELECT DISTINCT account_id FROM staging.records);"
+DAILY_CHANGES_STATEMENT = "SELECT account_id, substr(transaction_date, 1, 10), \
+        SUM(CASE WHEN change_type IN ('DEBIT_ACCOUNT', 'SELL_ASSET') THEN amount \
+            ELSE -amount END), \
+        SUM(COALESCE(value_change, 0)) \
+    FROM staging.records GROUP BY 1, 2 ORDER BY 1, 2;"
+
+def attach_staging()->None:
+    """Attach an empty in memory schema mirroring the ledger tables to this thread's connection"""
+    db_connection = get_connection()
+    db_connection.create_function("record_fingerprint", 6, record_fingerprint, deterministic=True)
+    db_connection.create_function("normalize_symbol", 1, normalize_symbol, deterministic=True)
+    if any(row[1] == STAGING_SCHEMA for row in sql_get("PRAGMA database_list;", [])):
+        return
+    sql_update(f"ATTACH DATABASE ':memory:' AS {STAGING_SCHEMA};", [])
+    # copying the live columns keeps migrations in step, constraints are left behind so a row
+    # can sit uncategorized until the merge
+    for table in ("records", "accounts", "assets"):
+        sql_update(f"CREATE TABLE staging.{table} AS SELECT * FROM main.{table} WHERE 0;", [])
+    for column in STAGING_COLUMNS:
+        sql_update(f"ALTER TABLE staging.records ADD COLUMN {column};", [])
+    sql_update("ALTER TABLE staging.assets ADD COLUMN symbol TEXT;", [])
+    sql_update("ALTER TABLE staging.assets ADD COLUMN is_new INTEGER;", [])
+    sql_update("ALTER TABLE staging.assets ADD COLUMN opening_quantity FLOAT;", [])
+    sql_update("ALTER TABLE staging.assets ADD COLUMN changed INTEGER NOT NULL DEFAULT 0;", [])
+    sql_update("CREATE TABLE staging.category_history ( \
+        account_id          INTEGER     NOT NULL, \
+        business            TEXT        NOT NULL, \
+        note                TEXT        NOT NULL, \
+        category            TEXT        NOT NULL, \
+        change_type         TEXT        NOT NULL, \
+        PRIMARY KEY (account_id, business, note));", [])
+    sql_update("CREATE INDEX staging.records_account_symbol \
+        ON records (account_id, symbol, record_id);", [])
+    sql_update("CREATE INDEX staging.records_fingerprint ON records (fingerprint);", [])
+
+class StagingArea:
+    """One export's rows, categorized, deduplicated and costed in memory before they merge"""
+    def __init__(self):
+        attach_staging()
+        self.records = []
+        self.accounts = {}
+        self.result = BatchResult()
+        self.newest_date = None
+        self.data_version = None
+
+    @timed_phase("stage load")
+    def load(self, chunks:Iterable[list[Record]])->None:
+        """Copy parsed rows into the staging tables, emptying them first"""
+        for table in ("records", "accounts", "assets", "category_history"):
+            sql_update(f"DELETE FROM staging.{table};", [])
+        for records in chunks:
+            rows = []
+            for record in records:
+                asset = record.changed_asset if record.changed_asset.account else None
+                rows.append([len(self.records) + len(rows), record.account.account_id,
+                             record.amount, record.business, record.quantity, record.note,
+                             record.transaction_date,
+                             normalize_symbol(asset.asset) if asset else None,
+                             asset.asset if asset else None,
+                             asset.market_value if asset else None,
+                             asset.note if asset else None])
+                self.accounts[record.account.account_id] = record.account
+            self.records.extend(records)
+            sql_update_many(INSERT_STAGED_STATEMENT, rows)
+            self.newest_date = records[-1].transaction_date if records else self.newest_date
+        sql_update(COPY_ACCOUNTS_STATEMENT, [])
+
+    @timed_phase("stage categorize")
+    def categorize(self, group_prompts:bool=True, ask:bool=True)->None:
+        """Fill categories from history in one join, then suggest or ask for what is left"""
+        sql_update(LOAD_HISTORY_STATEMENT, [])
+        sql_update(FILL_CATEGORIES_STATEMENT, [])
+        sql_statement = "SELECT record_id FROM staging.records WHERE category IS NULL \
+            ORDER BY record_id;"
+        unknown = {row[0]: self.records[row[0]] for row in sql_get(sql_statement, [])}
+        if ask and group_prompts:
+            categorize_by_business(list(unknown.values()))
+        elif ask:
+            for record in unknown.values():
+                record.get_category()
+        else:
+            # a dry run takes close suggestions but never stops to ask
+            for account_id in {record.account.account_id for record in unknown.values()}:
+                group = [record for record in unknown.values()
+                         if record.account.account_id == account_id]
+                suggestions = group[0].account.get_category_index().suggest(
+                    [(record.business, record.note) for record in group])
+                for record, suggested in zip(group, suggestions):
+                    if not record.auto_categorize():
+                        record.accept_suggestion(suggested)
+        sql_statement = "UPDATE staging.records SET category = ?, change_type = ? \
+            WHERE record_id = ?;"
+        sql_update_many(sql_statement, [[record.category, record.change_type.name, record_id]
+                                        for record_id, record in unknown.items()
+                                        if record.category is not None])
+        # rows still without a category cannot be merged, the next import reads them again
+        sql_statement = "SELECT record_id FROM staging.records WHERE category IS NULL;"
+        self.result.failed = [self.records[row[0]] for row in sql_get(sql_statement, [])]
+        sql_update("DELETE FROM staging.records WHERE category IS NULL;", [])
+
+    @timed_phase("stage dedup")
+    def deduplicate(self)->None:
+        """Drop rows the ledger already holds and repeats within the export"""
+        staged = sql_get("SELECT COUNT(*) FROM staging.records;", [])[0][0]
+        sql_update(FINGERPRINT_STATEMENT, [])
+        sql_update(DROP_EXISTING_STATEMENT, [])
+        sql_update(DROP_REPEATED_STATEMENT, [])
+        self.result.inserted = sql_get("SELECT COUNT(*) FROM staging.records;", [])[0][0]
+        self.result.skipped += staged - self.result.inserted
+
+    @timed_phase("stage positions")
+    def cost(self)->None:
+        """Running positions, value changes and new account totals of the staged rows"""
+        sql_update(LOAD_POSITIONS_STATEMENT, [])
+        sql_update(TRADES_STATEMENT, [])
+        sql_update(OPEN_POSITIONS_STATEMENT, [])
+        sql_update(MOVE_POSITIONS_STATEMENT, [])
+        sql_update(LINK_ASSETS_STATEMENT, [])
+        sql_update(STAGE_TOTALS_STATEMENT, [])
+
+    def prepare(self, chunks:Iterable[list[Record]], group_prompts:bool=True,
+                ask:bool=True)->None:
+        """Stage an export up to the point where it can be diffed or merged"""
+        self.load(chunks)
+        self.categorize(group_prompts, ask)
+        self.deduplicate()
+        self.cost()
+        # another connection committing after this point means the ledger moved under us
+        self.data_version = sql_get("PRAGMA data_version;", [])[0][0]
+
+    def restage(self)->None:
+        """Deduplicate and cost the staged rows again against the ledger as it is now"""
+        sql_update("DELETE FROM staging.assets;", [])
+        sql_update("DELETE FROM staging.accounts;", [])
+        sql_update("UPDATE staging.records \
+            SET asset_id = NULL, position_quantity = NULL, value_change = NULL;", [])
+        self.deduplicate()
+        sql_update(COPY_ACCOUNTS_STATEMENT, [])
+        self.cost()
+
+    def diff(self)->list[str]:
+        """What merging the staged rows would change, account by account"""
+        lines = []
+        sql_statement = "SELECT live.account_id, live.account, live.cash_funds, \
+                live.investment_worth, staged.cash_funds, staged.investment_worth \
+            FROM staging.accounts AS staged JOIN main.accounts AS live USING (account_id) \
+            ORDER BY live.account_id;"
+        for account_id, name, live_cash, live_worth, new_cash, new_worth \
+                in sql_get(sql_statement, []):
+            failed = [record for record in self.result.failed
+                      if record.account.account_id == account_id]
+            sql_statement = "SELECT COUNT(*) FROM staging.records WHERE account_id = ?;"
+            new_rows = sql_get(sql_statement, [account_id])[0][0]
+            lines.append(f"{name}: {new_rows} new records, {len(failed)} without a category")
+            lines.append(f"    cash {round(live_cash, 2)} -> {round(new_cash, 2)}, "
+                         f"investments {round(live_worth, 2)} -> {round(new_worth, 2)}")
+            sql_statement = "SELECT category, change_type, COUNT(*), ROUND(SUM(amount), 2) \
+                FROM staging.records WHERE account_id = ? \
+                GROUP BY category, change_type ORDER BY SUM(amount) DESC;"
+            for category, change_type, record_count, total in sql_get(sql_statement,
+                                                                      [account_id]):
+                lines.append(f"    {category} - {RecordChangeType[change_type].value}: "
+                             f"{record_count} records, {total}")
+            sql_statement = "SELECT held.asset, ROUND(live.quantity, 6), \
+                    ROUND(held.quantity, 6), held.is_new \
+                FROM staging.assets AS held \
+                LEFT JOIN main.assets AS live USING (asset_id) \
+                WHERE held.account_id = ? AND held.changed ORDER BY held.asset;"
+            for asset, old_quantity, new_quantity, is_new in sql_get(sql_statement,
+                                                                     [account_id]):
+                lines.append(f"    {'new position' if is_new else 'position'} {asset}: "
+                             f"{old_quantity or 0} -> {new_quantity}")
+            for record in failed[:DIFF_EXAMPLES]:
+                lines.append(f"    no category: {record.transaction_date.date()} "
+                             f"{record.amount} {record.business} {record.note}")
+        return lines
+
+    @timed_phase("stage merge")
+    def merge(self)->BatchResult:
+        """Move the staged rows, positions and totals into the ledger in one transaction"""
+        with db_session():
+            # another writer committed since staging, its rows and positions are seen now that
+            # the write lock is held
+            if sql_get("PRAGMA data_version;", [])[0][0] != self.data_version:
+                self.restage()
+            sql_update("INSERT INTO main.assets \
+                    (asset_id, account_id, asset, quantity, market_value, note) \
+                SELECT asset_id, account_id, asset, quantity, market_value, note \
+                FROM staging.assets WHERE is_new ORDER BY asset_id;", [])
+            sql_update("UPDATE main.assets AS live \
+                SET quantity = live.quantity + held.quantity - held.opening_quantity, \
+                    market_value = held.market_value \
+                FROM staging.assets AS held \
+                WHERE held.asset_id = live.asset_id AND held.changed AND NOT held.is_new;", [])
+            sql_update("INSERT INTO main.records \
+                    (account_id, asset_id, liability_id, amount, business, category, quantity, \
+                    change_type, note, transaction_date, fingerprint) \
+                SELECT account_id, asset_id, liability_id, amount, business, category, quantity, \
+                    change_type, note, transaction_date, fingerprint \
+                FROM staging.records ORDER BY record_id;", [])
+            # WHERE true keeps the ON CONFLICT from being read as part of the join
+            sql_update("INSERT INTO main.monthly_rollups \
+                    (account_id, month, category, change_type, total, record_count) \
+                SELECT account_id, substr(transaction_date, 1, 7), category, change_type, \
+                    SUM(amount), COUNT(*) \
+                FROM staging.records WHERE true GROUP BY 1, 2, 3, 4 \
+                ON CONFLICT (account_id, month, category, change_type) DO UPDATE \
+                SET total = total + excluded.total, \
+                    record_count = record_count + excluded.record_count;", [])
+            sql_update(MERGE_TOTALS_STATEMENT, [])
+            for account in self.accounts.values():
+                account.refresh_totals()
+            for account_id, day, cash_change, investment_change \
+                    in sql_get(DAILY_CHANGES_STATEMENT, []):
+                self.accounts[account_id].balance_changes.append(
+                    (day, cash_change, investment_change))
+            for account in self.accounts.values():
+                account.flush_snapshots()
+        self.refresh_accounts()
+        return self.result
+
+    def refresh_accounts(self)->None:
+        """Bring the accounts' caches in line with what was merged"""
+        sql_statement = "SELECT account_id, fingerprint FROM staging.records;"
+        for account_id, fingerprint in sql_get(sql_statement, []):
+            if self.accounts[account_id].fingerprints is not None:
+                self.accounts[account_id].fingerprints.add(fingerprint)
+        for account in self.accounts.values():
+            # positions reload from the DB the next time a row needs them
+            account.position_ledger = None
+
+def write_staged(chunks:Iterable[list[Record]], group_prompts:bool,
+                 dry_run:bool=False)->tuple[BatchResult, datetime|None]:
+    """Stage an export and merge it, or only print what would change, returns like write_records"""
+    staging = StagingArea()
+    staging.prepare(chunks, group_prompts, not dry_run)
+    if dry_run:
+        for line in staging.diff():
+            print(line)
+        return staging.result, staging.newest_date
+    return staging.merge(), staging.newest_date
@@ -0,0 +1,219 @@
+"""Runs parallel writers and readers against one DB file and checks nothing was lost"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+from benchmark import build_db
+
+WRITERS = 4
+READERS = 2
+ACCOUNTS = 2
+ROWS_PER_WRITER = 2000
+BATCH_SIZE = 100
+# every writer also inserts these rows, exactly one copy of each should be kept
+SHARED_ROWS = 200
+FIRST_DAY = datetime(2024, 1, 1)
+# every fifth row buys one of these, whole shares keep the worth in exact cents
+STRESS_FUNDS = ("STRESS FUND A", "STRESS FUND B")
+TRADE_EVERY = 5
+
+def stress_rows(writer:int, rows:int,
+                accounts:int)->list[tuple[int, int, float, str, str|None, int, float]]:
+    """Account, day offset, amount, business, fund, shares and price of a writer's rows
+
+    Writer -1 is the set every writer inserts.
+    """
+    generator = random.Random(writer)
+    planned = []
+    for row in range(rows):
+        account_id, day = generator.randrange(accounts) + 1, generator.randrange(365)
+        if row % TRADE_EVERY:
+            planned.append((account_id, day, round(generator.uniform(1, 500), 2),
+                            f"STRESS {writer} ROW {row}", None, 0, 0.0))
+            continue
+        shares, price = generator.randint(1, 20), round(generator.uniform(10, 100), 2)
+        planned.append((account_id, day, round(shares * price, 2), f"STRESS {writer} ROW {row}",
+                        generator.choice(STRESS_FUNDS), shares, price))
+    return planned
+
+def stress_record(account:"Account", planned:tuple)->"Record":
+    """Record of a planned row, a buy of its fund when it has one"""
+    # pylint: disable-next=import-outside-toplevel
+    from db_classes import Asset, Record, RecordChangeType
+    _, day, amount, business, fund, shares, price = planned
+    record = Record(account=account, amount=amount, business=business, category="Stress",
+                    change_type=RecordChangeType.DEBIT_ACCOUNT if amount < 250
+                    else RecordChangeType.CREDIT_ACCOUNT,
+                    note="", transaction_date=FIRST_DAY + timedelta(days=day))
+    if fund:
+        record.change_type = RecordChangeType.BUY_ASSET
+        record.add_changed_asset(Asset(account=account, asset=fund, quantity=shares,
+                                       market_value=price, note=fund))
+    return record
+
+def run_writer(db_file:str, writer:int, rows:int, accounts:int, batch_size:int)->dict:
+    """Insert a writer's rows and the shared rows in batches of one transaction each"""
+    os.environ["DB_NAME"] = db_file
+    # pylint: disable-next=import-outside-toplevel
+    from db_classes import Account, insert_records
+    # pylint: disable-next=import-outside-toplevel
+    from db_helper import DatabaseError
+    account_objects = {account_id: Account(account_id) for account_id in range(1, accounts + 1)}
+    planned = stress_rows(writer, rows, accounts) + stress_rows(-1, SHARED_ROWS, accounts)
+    random.Random(writer).shuffle(planned)
+    counts = {"inserted": 0, "skipped": 0, "failed": 0, "errors": 0}
+    with open(os.devnull, "w", encoding="utf-8") as devnull, redirect_stdout(devnull):
+        for start in range(0, len(planned), batch_size):
+            records = [stress_record(account_objects[row[0]], row)
+                       for row in planned[start:start + batch_size]]
+            try:
+                result = insert_records(records)
+            except DatabaseError:
+                counts["errors"] += 1
+                continue
+            counts["inserted"] += result.inserted
+            counts["skipped"] += result.skipped
+            counts["failed"] += len(result.failed)
+    return counts
+
+def run_reader(db_file:str, done:"multiprocessing.Event")->dict:
+    """Run report queries over and over until the writers finish"""
+    os.environ["DB_NAME"] = db_file
+    # pylint: disable-next=import-outside-toplevel
+    from reports import month_summary, net_worth_history
+    # pylint: disable-next=import-outside-toplevel
+    from db_helper import DatabaseError
+    counts = {"reports": 0, "errors": 0}
+    while not done.is_set():
+        try:
+            month_summary("2024-06")
+            net_worth_history()
+            counts["reports"] += 1
+        except DatabaseError:
+            counts["errors"] += 1
+    return counts
+
+def check_db(writers:int, rows:int, accounts:int)->list[str]:
+    """Ways the DB disagrees with what the writers were asked to insert, empty when it agrees"""
+    # pylint: disable-next=import-outside-toplevel
+    from db_helper import sql_get
+    # pylint: disable-next=import-outside-toplevel
+    from db_classes import get_balance_drift
+    problems = []
+    planned = {row[3]: row for writer in [-1, *range(writers)]
+               for row in stress_rows(writer, SHARED_ROWS if writer < 0 else rows, accounts)}
+    expected = len(planned)
+    found = sql_get("SELECT COUNT(*), COUNT(DISTINCT business) FROM records \
+        WHERE category = 'Stress';", [])[0]
+    if found != (expected, expected):
+        problems.append(f"{found[0]} records ({found[1]} distinct), expected {expected}")
+    shares = {}
+    for account_id, _, _, _, fund, quantity, _ in planned.values():
+        if fund:
+            shares[(account_id, fund)] = shares.get((account_id, fund), 0) + quantity
+    held = sql_get("SELECT account_id, asset, SUM(quantity), COUNT(*) FROM assets \
+        GROUP BY account_id, asset;", [])
+    for account_id, fund, quantity, positions in held:
+        if positions != 1 or quantity != shares.get((account_id, fund)):
+            problems.append(f"account {account_id} holds {quantity} {fund} in {positions} "
+                            f"positions, its trades add up to {shares.get((account_id, fund))}")
+    if len(held) != len(shares):
+        problems.append(f"{len(held)} positions, trades were made in {len(shares)}")
+    for account, cash_drift, investment_drift in get_balance_drift():
+        if cash_drift or investment_drift:
+            problems.append(f"{account} totals drift from its records by {cash_drift}, "
+                            f"{investment_drift}")
+    sql_statement = "SELECT records.account_id, records.total, records.count, \
+            rollups.total, rollups.count \
+        FROM (SELECT account_id, ROUND(SUM(amount), 2) AS total, COUNT(*) AS count \
+            FROM records GROUP BY account_id) AS records \
+        LEFT JOIN (SELECT account_id, ROUND(SUM(total), 2) AS total, \
+                SUM(record_count) AS count \
+            FROM monthly_rollups GROUP BY account_id) AS rollups USING (account_id);"
+    for account_id, total, count, rollup_total, rollup_count in sql_get(sql_statement, []):
+        if (total, count) != (rollup_total, rollup_count):
+            problems.append(f"account {account_id} rollups hold {rollup_count} records "
+                            f"({rollup_total}), records hold {count} ({total})")
+    sql_statement = "SELECT accounts.account, accounts.cash_funds, snapshots.cash_funds \
+        FROM accounts JOIN balance_snapshots AS snapshots USING (account_id) \
+        WHERE snapshots.as_of = (SELECT MAX(as_of) FROM balance_snapshots \
+            WHERE account_id = accounts.account_id);"
+    for account, cash_funds, snapshot_cash in sql_get(sql_statement, []):
+        if round(cash_funds - snapshot_cash, 2):
+            problems.append(f"{account} last snapshot holds {snapshot_cash} not {cash_funds}")
+    return problems
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Stress one DB file with parallel writers")
+    parser.add_argument("-w", "--writers", type=int, default=WRITERS, help='Writer processes')
+    parser.add_argument("-r", "--readers", type=int, default=READERS,
+                        help='Processes running reports while the writers work')
+    parser.add_argument("-a", "--accounts", type=int, default=ACCOUNTS,
+                        help='Accounts the writers share')
+    parser.add_argument("-n", "--rows", type=int, default=ROWS_PER_WRITER,
+                        help='Rows each writer inserts besides the shared ones')
+    parser.add_argument("-b", "--batch-size", type=int, default=BATCH_SIZE,
+                        help='Rows per transaction')
+    parser.add_argument("-o", "--output", help='DB file to keep, a temporary one by default')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        db_file = args.output or os.path.join(folder, "stress.db")
+        if os.path.exists(db_file):
+            print(db_file, "already exists")
+            sys.exit()
+        build_db(db_file)
+        os.environ["DB_NAME"] = db_file
+        # pylint: disable-next=import-outside-toplevel
+        from db_helper import sql_insert_many, db_session, close_connection
+        # pylint: disable-next=import-outside-toplevel
+        from db_migrations import migrate
+        migrate()
+        with db_session():
+            sql_insert_many("INSERT INTO accounts VALUES (?, 1, ?, 'Stress', 0, 0, 0);",
+                            [[account_id, f"Stress {account_id}"]
+                             for account_id in range(2, args.accounts + 1)])
+        close_connection()
+
+        started = time.perf_counter()
+        with multiprocessing.Manager() as manager, \
+                multiprocessing.Pool(args.writers + args.readers) as pool:
+            done = manager.Event()
+            readers = [pool.apply_async(run_reader, (db_file, done))
+                       for _ in range(args.readers)]
+            writers = [pool.apply_async(run_writer, (db_file, writer, args.rows, args.accounts,
+                                                     args.batch_size))
+                       for writer in range(args.writers)]
+            written = [writer.get() for writer in writers]
+            done.set()
+            read = [reader.get() for reader in readers]
+        elapsed = time.perf_counter() - started
+
+        for writer, counts in enumerate(written):
+            print(f"writer {writer}: {counts['inserted']} inserted, {counts['skipped']} skipped, "
+                  f"{counts['failed']} failed, {counts['errors']} batches rolled back")
+        for reader, counts in enumerate(read):
+            print(f"reader {reader}: {counts['reports']} reports, {counts['errors']} errors")
+        problems = check_db(args.writers, args.rows, args.accounts)
+        close_connection()
+        problems += [f"writer {writer} had {counts['failed']} failed rows and "
+                     f"{counts['errors']} rolled back batches"
+                     for writer, counts in enumerate(written)
+                     if counts["failed"] or counts["errors"]]
+        problems += [f"reader {reader} had {counts['errors']} errors"
+                     for reader, counts in enumerate(read) if counts["errors"]]
+        for problem in problems:
+            print("Problem:", problem)
+        print(f"--------{args.writers} writers and {args.readers} readers took {elapsed:.1f}s")
+        if problems:
+            sys.exit(1)
+        print("Every row, position, total, rollup and snapshot agrees")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Writes realistic synthetic exports for every supported institute"""
+import os
+import csv
+import random
+import argparse
+from datetime import date, timedelta
+from typing import Callable, Iterator
+
+EXPORT_DAYS = 3 * 365
+LAST_EXPORT_DATE = date(2024, 12, 31)
+MERCHANTS = (
+    ("AMAZON MKTPL*{code}", "Shopping"),
+    ("STARBUCKS STORE {store}", "Dining"),
+    ("SHELL OIL {store}", "Gas"),
+    ("KROGER #{store}", "Groceries"),
+    ("TARGET T-{store}", "Shopping"),
+    ("CHIPOTLE {store}", "Dining"),
+    ("NETFLIX.COM", "Entertainment"),
+    ("COMCAST CABLE COMM", "Utilities"),
+    ("DUKE ENERGY {code}", "Utilities"),
+    ("UBER *TRIP {code}", "Travel"),
+)
+INCOME = (("PAYROLL ACME CORP", "Income"), ("ZELLE FROM J SMITH", "Transfers"),
+          ("INTEREST PAYMENT", "Income"))
+FUNDS = (("VTI", "VANGUARD TOTAL STOCK MARKET ETF"), ("VXUS", "VANGUARD TOTAL INTL STOCK ETF"),
+         ("BND", "VANGUARD TOTAL BOND MARKET ETF"), ("SCHD", "SCHWAB US DIVIDEND EQUITY ETF"))
+RETIREMENT_FUNDS = ("2055 TARGET DATE TRUST", "STABLE VALUE FUND", "S&P 500 INDEX TRUST")
+PROVIDERS = ("CVS PHARMACY", "DR SMITH FAMILY MEDICINE", "QUEST DIAGNOSTICS", "WALGREENS")
+
+def export_dates(rows:int)->Iterator[str]:
+    """Dates of the rows, newest first like the banks export them"""
+    for row in range(rows):
+        yield (LAST_EXPORT_DATE - timedelta(days=row * EXPORT_DAYS // rows)).strftime("%m/%d/%Y")
+
+def merchant(rng:random.Random)->tuple[str, str]:
+    """A merchant with a store number or reference code, and its category"""
+    name, category = rng.choice(MERCHANTS)
+    return name.format(store=rng.randint(100, 9999), code=rng.randint(10**5, 10**6)), category
+
+def money(amount:float)->str:
+    """Format an amount the way the export writes it"""
+    return f"${amount:,.2f}"
+
+def write_navy_federal_csv(path:str, rows:int, rng:random.Random)->None:
+    """Navy Federal checking or credit card csv"""
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Posting Date", "Transaction Date", "Amount", "Credit Debit Indicator",
+                         "type", "Type Group", "Reference", "Instructed Currency",
+                         "Currency Exchange Rate", "Instructed Amount", "Description",
+                         "Category"])
+        for reference, transaction_date in enumerate(export_dates(rows)):
+            if rng.random() < 0.08:
+                business, category = rng.choice(INCOME)
+                indicator, amount = "Credit", rng.uniform(200, 4000)
+            else:
+                business, category = merchant(rng)
+                indicator, amount = "Debit", rng.uniform(1, 400)
+            writer.writerow([transaction_date, transaction_date, f"{amount:.2f}", indicator,
+                             "POS", "Card", f"{reference:012d}", "USD", "1.0", "",
+                             business, category])
+
+def write_charles_schwab_checking_csv(path:str, rows:int, rng:random.Random)->None:
+    """Charles Schwab checking csv, the newest rows are still pending"""
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Date", "Status", "Type", "CheckNumber", "Description", "Withdrawal",
+                         "Deposit", "RunningBalance"])
+        for row, transaction_date in enumerate(export_dates(rows)):
+            status = "Pending" if row < 5 else "Posted"
+            if rng.random() < 0.1:
+                business, _ = rng.choice(INCOME)
+                withdrawal, deposit = "", money(rng.uniform(200, 4000))
+            else:
+                business, _ = merchant(rng)
+                withdrawal, deposit = money(rng.uniform(1, 400)), ""
+            writer.writerow([transaction_date, status, "ACH", "", business, withdrawal,
+                             deposit, money(rng.uniform(1000, 20000))])
+
+def write_charles_schwab_investment_csv(path:str, rows:int, rng:random.Random)->None:
+    """Charles Schwab brokerage or Roth csv, journals can leave the amount empty"""
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Date", "Action", "Symbol", "Description", "Quantity", "Price",
+                         "Fees & Comm", "Amount"])
+        for transaction_date in export_dates(rows):
+            symbol, description = rng.choice(FUNDS)
+            action = rng.choices(("Buy", "Sell", "Reinvest Shares", "Qualified Dividend",
+                                  "Journal"), (5, 2, 2, 2, 1))[0]
+            quantity = rng.randint(1, 40)
+            price = rng.uniform(20, 300)
+            amount = quantity * price
+            if action == "Journal":
+                writer.writerow([transaction_date, action, "", "JOURNAL FRM ...123", "", "", "",
+                                 money(amount) if rng.random() < 0.5 else ""])
+                continue
+            if rng.random() < 0.05:
+                transaction_date += f" as of {transaction_date}"
+            traded = action in ("Buy", "Sell", "Reinvest Shares")
+            signed = f"-{money(amount)}" if action in ("Buy", "Reinvest Shares") else money(amount)
+            writer.writerow([transaction_date, action, symbol, description,
+                             str(quantity) if traded else "", money(price) if traded else "",
+                             "", signed])
+
+def write_t_rowe_price_401k_csv(path:str, rows:int, rng:random.Random)->None:
+    """T Rowe Price 401k history, four title rows come before the data"""
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Account History Details"])
+        writer.writerow(["ACME CORP 401(K) PLAN"])
+        writer.writerow([f"01/01/{LAST_EXPORT_DATE.year - 3} - "
+                         f"{LAST_EXPORT_DATE.strftime('%m/%d/%Y')}"])
+        writer.writerow(["Date", "Activity", "Investment", "Source", "Amount", "Shares",
+                         "Share Price"])
+        for transaction_date in export_dates(rows):
+            activity = rng.choices(("Contribution", "Exchange In", "Exchange Out",
+                                    "Market Fluctuation", "Dividend", "Fee"),
+                                   (6, 1, 1, 3, 1, 1))[0]
+            price = rng.uniform(10, 120)
+            shares = rng.uniform(0.5, 25)
+            # fee rows without a minus sign are rebates, real fees stop the parser
+            writer.writerow([transaction_date, activity, rng.choice(RETIREMENT_FUNDS),
+                             rng.choice(("Employee Deferral", "Employer Match")),
+                             money(shares * price), f"{shares:.4f}", money(price)])
+
+def write_optum_hsa_xlsx(path:str, rows:int, rng:random.Random)->None:
+    """Optum HSA transaction detail sheet, written with openpyxl"""
+    # only needed when Optum sheets are generated
+    from openpyxl import Workbook  # pylint: disable=import-outside-toplevel
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Transaction Detail Report")
+    sheet.append(["Date", "Activity", "Type", "Account", "Status", "Amount"])
+    for row, transaction_date in enumerate(export_dates(rows)):
+        if rng.random() < 0.2:
+            activity, kind, amount = "Contribution", "Deposit", money(rng.uniform(50, 500))
+        else:
+            activity = f"{transaction_date} {rng.choice(PROVIDERS)}"
+            kind, amount = "Payment", f"({money(rng.uniform(5, 600))})"
+        sheet.append([transaction_date, activity, kind, "HSA",
+                      "Pending" if row < 3 else "Settled", amount])
+    workbook.save(path)
+
+# name: (institute, file name, writer)
+EXPORT_FORMATS:dict[str, tuple[str, str, Callable[[str, int, random.Random], None]]] = {
+    "navy_federal": ("NAVY_FEDERAL", "checking-transactions.csv", write_navy_federal_csv),
+    "schwab_checking": ("CHARLES_SCHWAB", "Checking_Transactions.csv",
+                        write_charles_schwab_checking_csv),
+    "schwab_brokerage": ("CHARLES_SCHWAB", "Individual_Transactions.csv",
+                         write_charles_schwab_investment_csv),
+    "t_rowe_price": ("T_ROWE_PRICE", "acc_history_details.csv", write_t_rowe_price_401k_csv),
+    "optum": ("OPTUM", "transactionsReportExport.xlsx", write_optum_hsa_xlsx),
+}
+
+def write_export(export_format:str, folder:str, rows:int, seed:int=0)->str:
+    """Write one synthetic export into folder, returns its path"""
+    _, file_name, writer = EXPORT_FORMATS[export_format]
+    name, ext = os.path.splitext(file_name)
+    path = os.path.join(folder, f"{name}-{rows}-{seed}{ext}")
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    writer(path, rows, random.Random(f"{export_format}-{seed}"))
+    return path
+
+def main()->None:
+    """Main Driver"""
+    parser = argparse.ArgumentParser(description="Write synthetic bank exports")
+    parser.add_argument("-o", "--output", default="synthetic", help='Folder for the exports')
+    parser.add_argument("-r", "--rows", type=int, default=1000, help='Rows in each export')
+    parser.add_argument("-f", "--format", action="append", choices=list(EXPORT_FORMATS),
+                        help='Export format, all of them if left out')
+    parser.add_argument("-s", "--seed", type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    for export_format in args.format or EXPORT_FORMATS:
+        print(write_export(export_format, args.output, args.rows, args.seed))
+
+if __name__ == "__main__":
+    main()